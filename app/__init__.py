@@ -1,3 +1,28 @@
-from app.downloader import GolemioApiDownloader
-from app.traffic import Traffic
-from app.visualizer import Visualizer
\ No newline at end of file
+import importlib
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from app.downloader import GolemioApiDownloader
+    from app.traffic import Traffic
+    from app.visualizer import Visualizer
+
+# ~ the classes are imported on first use, so that e.g. the downloader does not import pandas and plotly
+_LAZY_IMPORTS = {
+    'GolemioApiDownloader': 'app.downloader',
+    'Traffic': 'app.traffic',
+    'Visualizer': 'app.visualizer',
+}
+
+__all__ = list(_LAZY_IMPORTS)
+
+
+def __getattr__(name: str):
+    if name not in _LAZY_IMPORTS:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(_LAZY_IMPORTS[name]), name)
+    globals()[name] = value  # ~ later lookups do not go through __getattr__
+    return value
+
+
+def __dir__() -> list:
+    return sorted(set(globals()) | set(_LAZY_IMPORTS))
@@ -0,0 +1,86 @@
+import json
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from app.store import StationIndex
+
+try:
+    import orjson  # ~ optional, parses the stop count files several times faster than json
+except ImportError:
+    orjson = None
+
+_worker_index: Optional[StationIndex] = None
+
+
+def load_json_file(path: str):
+    """
+    Load the json file with orjson if it is installed, otherwise with json.
+    """
+    with open(path, 'rb') as input_f:
+        content = input_f.read()
+    return orjson.loads(content) if orjson is not None else json.loads(content)
+
+
+def sum_stop_count_file(station_index: StationIndex, path: str) -> Tuple[np.ndarray, int]:
+    """
+    Aggregate the stop counts from one `all_stop_count_{date}_{n}.json` file to the parent stations.
+    :param station_index: the child-parent index
+    :param path: path to the file
+    :return: array of the partial stop counts of all the parent stations; and the number of the skipped stops missing
+    in the index
+    """
+    stops = load_json_file(path)
+    rows = station_index.rows_of(stops.keys())
+    counts = np.fromiter(stops.values(), dtype=np.int64, count=len(stops))
+    known = rows >= 0
+    partial = np.bincount(station_index.parent_rows[rows[known]], weights=counts[known],
+                          minlength=station_index.n_parents)
+    return partial.astype(np.int64), int(len(rows) - known.sum())
+
+
+def sum_stop_hours_file(station_index: StationIndex, path: str) -> Tuple[np.ndarray, int]:
+    """
+    Aggregate the departures by hour from one `all_stop_hours_{date}_{n}.npz` file to the parent stations.
+    :param station_index: the child-parent index
+    :param path: path to the file
+    :return: array of the partial departures of all the parent stations of shape (number of the parent stations, 24);
+    and the number of the skipped stops missing in the index
+    """
+    with np.load(path) as stops:
+        rows = station_index.rows_of(stops['stop_ids'].tolist())
+        hours = stops['hours']
+    known = rows >= 0
+    partial = np.zeros((station_index.n_parents, 24), dtype=np.int64)
+    np.add.at(partial, station_index.parent_rows[rows[known]], hours[known])
+    return partial, int(len(rows) - known.sum())
+
+
+def _init_worker(station_index_path: str):
+    global _worker_index
+    _worker_index = StationIndex.load(station_index_path)
+
+
+def _sum_stop_count_file_in_worker(path: str) -> Tuple[np.ndarray, int]:
+    return sum_stop_count_file(_worker_index, path)
+
+
+def sum_stop_count_files(station_index: StationIndex, station_index_path: str, paths: List[str],
+                         workers: Optional[int] = 1) -> Iterator[Tuple[np.ndarray, int]]:
+    """
+    Aggregate the stop counts from the files to the parent stations, file by file, either in this process or fanned
+    out to a pool of processes, each loading the child-parent index once.
+    :param station_index: the child-parent index
+    :param station_index_path: path to the saved child-parent index, loaded by the processes of the pool
+    :param paths: paths to the files
+    :param workers: number of the processes, None for the number of the cores, 1 to aggregate in this process
+    :return: Iterator of the results of `sum_stop_count_file` in the order of the paths
+    """
+    if workers == 1 or len(paths) < 2:
+        for path in paths:
+            yield sum_stop_count_file(station_index, path)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(station_index_path,)) as executor:
+        yield from executor.map(_sum_stop_count_file_in_worker, paths)
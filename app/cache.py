@@ -0,0 +1,205 @@
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Callable, Hashable, Iterable, NamedTuple, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+
+class CacheEntry(NamedTuple):
+    body: bytes
+    etag: Optional[str]
+    last_modified: Optional[str]
+    fresh: bool
+
+
+class HttpCache:
+    """
+    Persistent cache of HTTP responses in a SQLite file, with zlib compressed bodies keyed by the normalized url.
+    Entries are fresh for the TTL of the first key of `ttls` found in the url (or `default_ttl`), stale entries are
+    revalidated with `If-None-Match`/`If-Modified-Since` when the server sent `ETag`/`Last-Modified`, and the least
+    recently used entries are evicted once the bodies exceed `max_size` bytes. Counts hits, misses and revalidations.
+    """
+
+    def __init__(self, path: str, ttls: dict = None, default_ttl: float = 24 * 3600, max_size: int = 512 * 2 ** 20,
+                 busy_timeout: float = 60.):
+        """
+        :param path: path to the SQLite file
+        :param ttls: seconds for which the responses are fresh, by a part of their url
+        :param default_ttl: seconds for which the responses of the other urls are fresh
+        :param max_size: bytes of the bodies above which the least recently used entries are evicted
+        :param busy_timeout: seconds to wait for a write of another connection to the same file (e.g. of `Traffic`
+        and `GolemioApiDownloader` run concurrently by the `Pipeline`) before failing with "database is locked"
+        """
+        self.path = path
+        self.ttls = ttls or {}
+        self.default_ttl = default_ttl
+        self.max_size = max_size
+        self.busy_timeout = busy_timeout
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self._connection = None
+        self._size = 0
+        self._lock = threading.Lock()  # ~ shared by the threads prefetching pages
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, body BLOB, size INTEGER, etag TEXT, '
+                'last_modified TEXT, stored_at REAL, accessed_at REAL)'
+            )
+            self._connection.execute('CREATE INDEX IF NOT EXISTS accessed ON responses (accessed_at)')
+            self._size = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        return self._connection
+
+    @staticmethod
+    def normalize_url(url: str) -> str:
+        """
+        Normalize the url so that equivalent urls share a cache entry: lower-case scheme and host, sorted parameters.
+        :param url: the url
+        :return: the normalized url
+        """
+        parts = urlsplit(url)
+        query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+        return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, query, ''))
+
+    def ttl_for(self, url: str) -> float:
+        return next((ttl for key, ttl in self.ttls.items() if key in url), self.default_ttl)
+
+    def lookup(self, url: str) -> Optional[CacheEntry]:
+        """
+        Look up the cached response for the url, counting a hit if it is fresh and a miss otherwise.
+        :param url: the url
+        :return: the cached response, None if there is none
+        """
+        key = self.normalize_url(url)
+        with self._lock:
+            row = self.connection.execute(
+                'SELECT body, etag, last_modified, stored_at FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            fresh = time.time() - row[3] < self.ttl_for(url)
+            if fresh:
+                self.hits += 1
+                with self.connection:
+                    self.connection.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (time.time(), key))
+            else:
+                self.misses += 1
+        return CacheEntry(zlib.decompress(row[0]), row[1], row[2], fresh)
+
+    @staticmethod
+    def revalidation_headers(entry: Optional[CacheEntry]) -> dict:
+        """
+        :param entry: the stale cached response, if any
+        :return: headers making the request conditional on the cached response being outdated
+        """
+        headers = {}
+        if entry is not None and entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry is not None and entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def refresh(self, url: str):
+        """
+        Mark the cached response for the url fresh again, after the server confirmed it is not modified (304).
+        :param url: the url
+        """
+        with self._lock, self.connection:
+            self.revalidated += 1
+            now = time.time()
+            self.connection.execute('UPDATE responses SET stored_at = ?, accessed_at = ? WHERE key = ?',
+                                    (now, now, self.normalize_url(url)))
+
+    def store(self, url: str, body: bytes, headers):
+        """
+        Cache the response for the url, evicting the least recently used responses if the cache is full.
+        :param url: the url
+        :param body: the raw body of the response
+        :param headers: the headers of the response
+        """
+        compressed = zlib.compress(body)
+        now = time.time()
+        key = self.normalize_url(url)
+        with self._lock, self.connection:
+            replaced = self.connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.connection.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, compressed, len(compressed), headers.get('ETag'), headers.get('Last-Modified'), now, now)
+            )
+            self._size += len(compressed) - (replaced[0] if replaced else 0)
+            if self._size > self.max_size:
+                self._evict(self._size - self.max_size)
+
+    def _evict(self, excess: int):
+        freed = 0
+        keys = []
+        for key, size in self.connection.execute('SELECT key, size FROM responses ORDER BY accessed_at'):
+            if freed >= excess:
+                break
+            keys.append((key,))
+            freed += size
+        self.connection.executemany('DELETE FROM responses WHERE key = ?', keys)
+        self._size -= freed
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'revalidated': self.revalidated}
+
+
+class DatasetCache:
+    """
+    In-process cache of the data loaded from files, keyed by any hashable key and invalidated as soon as any of the
+    files the data was loaded from changes its modification time or size (or appears or disappears). Counts hits and
+    misses.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+
+    @staticmethod
+    def signature(paths: Iterable[str]) -> tuple:
+        """
+        :param paths: paths to the files
+        :return: the modification times and sizes of the files, None for missing files
+        """
+        signature = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                signature.append((path, stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                signature.append((path, None))
+        return tuple(signature)
+
+    def get(self, key: Hashable, paths: Iterable[str], loader: Callable):
+        """
+        Get the data for the key, loading it again if any of the files changed since it was loaded.
+        :param key: key of the data
+        :param paths: paths to the files the data is loaded from
+        :param loader: function without arguments loading the data
+        :return: the data
+        """
+        signature = self.signature(paths)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == signature:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        data = loader()
+        self._entries[key] = (signature, data)
+        return data
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
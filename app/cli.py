@@ -0,0 +1,177 @@
+"""
+Command line interface running the steps of the pipeline, e.g. from cron:
+
+    golemio-frequency download --key golemio_api_key.json
+    golemio-frequency filter
+    golemio-frequency crawl 2020-01-02 2020-01-03 --key golemio_api_key.json
+    golemio-frequency crawl 2020-01-02 --shard 1/4 --key golemio_api_key.json  # ~ one of 4 processes or machines
+    golemio-frequency merge 2020-01-02 --shards 4
+    golemio-frequency assign 2020-01-02 2020-01-03
+    golemio-frequency export
+    golemio-frequency traffic
+    golemio-frequency run 2020-01-02 2020-01-03 --key golemio_api_key.json
+
+Also runs as `python -m app.cli`. Each command imports only the modules its step needs, so e.g. the crawl and the
+assignment of the stop counts do not import pandas and plotly.
+"""
+import argparse
+from typing import List, Optional, Tuple
+
+TRAFFIC_STEPS = ['download', 'process_traffic', 'process_stops', 'merge']
+
+
+def _metrics(args: argparse.Namespace):
+    if not args.metrics_json and not args.metrics_prometheus:
+        return None
+    from app.metrics import Metrics
+    return Metrics(json_path=args.metrics_json, prometheus_path=args.metrics_prometheus)
+
+
+def _downloader(args: argparse.Namespace, api: bool = False):
+    """
+    :param api: bool whether the step requests the API and needs the key
+    """
+    from app.downloader import GolemioApiDownloader
+    golemio = GolemioApiDownloader(args.key if api else None)
+    golemio.metrics = _metrics(args)
+    return golemio
+
+
+def _traffic(args: argparse.Namespace):
+    from app.traffic import Traffic
+    traffic = Traffic()
+    traffic.metrics = _metrics(args)
+    return traffic
+
+
+def download(args: argparse.Namespace):
+    _downloader(args, api=True).download_all_stations()
+
+
+def filter_stations(args: argparse.Namespace):
+    _downloader(args).filter_station_ids_enriched()
+
+
+def crawl(args: argparse.Namespace):
+    golemio = _downloader(args, api=True)
+    golemio.hourly_stop_times = args.hourly
+    golemio.shard = args.shard
+    golemio.count_stop_times_for_dates(args.dates, resume=args.resume, assign=False)
+
+
+def shard(value: str) -> Tuple[int, int]:
+    """
+    Parse the shard in format i/n.
+    """
+    try:
+        i, n = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid shard {value!r}, expected i/n, e.g. 1/4')
+    if not 1 <= i <= n:
+        raise argparse.ArgumentTypeError(f'Invalid shard {value!r}, expected 1 <= i <= n')
+    return i, n
+
+
+def workers(value: str) -> int:
+    """
+    Parse the number of the processes, 0 for all the cores.
+    """
+    try:
+        n = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid number of workers {value!r}')
+    if n < 0:
+        raise argparse.ArgumentTypeError(f'Invalid number of workers {value!r}, expected 0 or more')
+    return n
+
+
+def merge(args: argparse.Namespace):
+    _downloader(args).merge_shards(args.dates, args.shards)
+
+
+def assign(args: argparse.Namespace):
+    golemio = _downloader(args)
+    golemio.hourly_stop_times = args.hourly
+    golemio.aggregate_workers = args.workers or None  # ~ 0 for all the cores
+    golemio.assign_stop_counts(args.dates, initial=args.initial)
+
+
+def export(args: argparse.Namespace):
+    _downloader(args).export_stop_count_json()
+
+
+def traffic(args: argparse.Namespace):
+    traffic = _traffic(args)
+    steps = {
+        'download': traffic.download_data,
+        'process_traffic': traffic.process_traffic,
+        'process_stops': traffic.process_stops,
+        'merge': traffic.merge_panda,
+    }
+    for step in args.steps:
+        steps[step]()
+
+
+def run(args: argparse.Namespace):
+    from app.pipeline import Pipeline, golemio_steps, traffic_steps
+    golemio = _downloader(args, api=True)
+    golemio.hourly_stop_times = args.hourly
+    steps = golemio_steps(golemio, args.dates)
+    if not args.no_traffic:
+        steps += traffic_steps(_traffic(args))
+    Pipeline(steps, state_path=args.state).run(targets=args.targets, force=args.force)
+
+
+def parser() -> argparse.ArgumentParser:
+    main_parser = argparse.ArgumentParser(prog='golemio-frequency', description=__doc__,
+                                          formatter_class=argparse.RawDescriptionHelpFormatter)
+    main_parser.add_argument('--metrics-json', help='path to save the metrics of the steps as JSON')
+    main_parser.add_argument('--metrics-prometheus', help='path to save the metrics in the Prometheus text format')
+    commands = main_parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    def command(name: str, function, description: str, api: bool = False) -> argparse.ArgumentParser:
+        command_parser = commands.add_parser(name, help=description, description=description)
+        command_parser.set_defaults(function=function)
+        if api:
+            command_parser.add_argument('--key', default='golemio_api_key.json',
+                                        help='path to the Golemio API key (default: %(default)s)')
+        return command_parser
+
+    command('download', download, 'step 1, download all the stations', api=True)
+    command('filter', filter_stations, 'step 2, restructure the stations into parent stations with children')
+    crawl_parser = command('crawl', crawl, 'step 3, download the stop counts for the dates', api=True)
+    crawl_parser.add_argument('dates', nargs='+', help='dates in format YYYY-MM-DD')
+    crawl_parser.add_argument('--resume', action='store_true', help='continue an interrupted or failed crawl')
+    crawl_parser.add_argument('--hourly', action='store_true', help='also count the departures by hour')
+    crawl_parser.add_argument('--shard', type=shard, metavar='i/n', help='crawl only the share i of n of the stations')
+    merge_parser = command('merge', merge, 'step 3 crawled in shards, merge the stop counts of all the shards')
+    merge_parser.add_argument('dates', nargs='+', help='dates in format YYYY-MM-DD')
+    merge_parser.add_argument('--shards', type=int, required=True, help='number of the shards')
+    assign_parser = command('assign', assign, 'step 4, assign the stop counts for the dates to the parent stations')
+    assign_parser.add_argument('dates', nargs='+', help='dates in format YYYY-MM-DD')
+    assign_parser.add_argument('--initial', action='store_true', help='create the store, dropping the other dates')
+    assign_parser.add_argument('--hourly', action='store_true', help='also assign the departures by hour')
+    assign_parser.add_argument('--workers', type=workers, default=1,
+                               help='processes parsing the stop count files, 0 for all the cores')
+    command('export', export, 'step 5, export the stop counts into final-stations_with_count.json')
+    traffic_parser = command('traffic', traffic, 'download and process the traffic data')
+    traffic_parser.add_argument('--steps', nargs='+', choices=TRAFFIC_STEPS, default=TRAFFIC_STEPS,
+                                help='steps to run, all by default')
+    run_parser = command('run', run, 'run the steps with inputs changed since their last run', api=True)
+    run_parser.add_argument('dates', nargs='+', help='dates in format YYYY-MM-DD')
+    run_parser.add_argument('--hourly', action='store_true', help='also count the departures by hour')
+    run_parser.add_argument('--targets', nargs='+', help='steps to run with the steps they wait for')
+    run_parser.add_argument('--force', action='store_true', help='run the steps even if they are up to date')
+    run_parser.add_argument('--no-traffic', action='store_true', help='run the steps of the downloader only')
+    run_parser.add_argument('--state', default='data/pipeline_state.json', help='path to the state of the steps')
+    return main_parser
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parser().parse_args(argv)
+    args.function(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,65 @@
+import asyncio
+import glob
 import json
 import os
 import time
+import zlib
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 from itertools import islice
-from typing import Generator, Tuple
+from typing import TYPE_CHECKING, Generator, Iterable, Optional, Tuple
 
-import grequests
+import numpy as np
 import requests
 
+from app.aggregation import load_json_file, sum_stop_count_files, sum_stop_hours_file
+from app.cache import HttpCache
+from app.hierarchy import StationHierarchy
+from app.journal import CrawlJournal
+from app.metrics import Metrics, stage, staged
+from app.parsing import count_array_items, count_departures_by_hour
+from app.ratelimit import RetryPolicy, TokenBucket
+from app.registry import StationRegistry
+from app.store import StationIndex, StopCountStore, atomic_write, save_npz
+
+if TYPE_CHECKING:  # ~ the engine (and aiohttp) is imported only by the crawl
+    from app.engine import AsyncDownloadEngine
+
 
 class GolemioApiDownloader:
-    def __init__(self, api_key_path: str):
-        self.api_key = self._load_api_key(api_key_path)
+    def __init__(self, api_key_path: Optional[str]):
+        # ~ the key is not needed by the steps which do not request the API (e.g. filter, assign), can be None for them
+        self.api_key = self._load_api_key(api_key_path) if api_key_path is not None else ''
         self.headers = {'X-Access-Token': self.api_key}
         self.limit_per_page = 1000
+        self.prefetch_pages = 4  # number of pages requested concurrently by `_download_all_pages`
         self.base_uri = 'https://api.golemio.cz/v1/'
         self.all_stations_path = 'data/all_stations.json'
+        self.all_stations_stream_path = 'data/all_stations.ndjson'
         self.all_stations_ids_path = 'data/all_stations_ids.json'
+        self.station_index_path = 'data/station_index.npz'
+        self.orphaned_stations_path = 'data/orphaned_stations.json'
         self.all_stop_count_path = 'data/all_stop_count'  # need to append '_date.json'
+        self.all_stop_hours_path = 'data/all_stop_hours'  # need to append '_date_n.npz'
         self.parent_ids_with_count_path = 'data/final-stations_with_count.json'
-        self.__counted_stops = {}
+        self.stop_count_store_path = 'data/stop_count_store'
+        self.crawl_journal_path = 'data/crawl_journal.sqlite'
+        self.stations_per_chunk = 4000  # parent stations per stop count file
+        # crawl only the share (i, n) of the stations, shard i of n (1 <= i <= n), see `count_stop_times_for_dates`
+        self.shard: Optional[Tuple[int, int]] = None
+        self.json_indent = 4  # pretty-print the json outputs, set to None for compact files
+        self.initial_concurrency = 5
+        self.max_concurrency = 64
+        self.count_only_parsing = True  # count the stop times in the responses without parsing them into dicts
+        self.hourly_stop_times = False  # also count the departures of the stop times by hour during the crawl
+        self.aggregate_workers = 1  # processes parsing the stop count files when aggregating, None for all the cores
+        self.rate_limiter = TokenBucket(rate=50)  # requests per second, shared by all the requests to the API
+        self.retry_policy = RetryPolicy()
+        self.cache = HttpCache('data/http_cache.sqlite', ttls={  # seconds for which the responses are reused
+            'gtfs/stoptimes': 12 * 3600,
+            'gtfs/stops': 7 * 24 * 3600,
+        })
+        self.metrics: Optional[Metrics] = None  # set to `Metrics()` to measure the steps, requests and progress
 
     @staticmethod
     def _load_api_key(api_key_path: str) -> str:
@@ -29,7 +70,9 @@ class GolemioApiDownloader:
     def _download_page(self, endpoint: str, offset: int, debug: bool = False, **kwargs) -> dict:
         """
         Download one page of data for the selected endpoint of Golemio API with the selected parameters as arguments.
-        Page size set by attribute `limit_per_page`, by default to 1000.
+        Page size set by attribute `limit_per_page`, by default to 1000. Requests are limited by the shared
+        `rate_limiter`, and rate limited (429) or failed (5xx) requests are retried according to `retry_policy`.
+        Responses are cached in `cache` (set to None to always download).
         :param endpoint: the selected endpoint to download data from
         :param offset: skip this number of first items (sth. like paging)
         :param debug: set to True if you need to see responses in the console
@@ -40,221 +83,288 @@ class GolemioApiDownloader:
         for arg, value in kwargs.items():
             parameters += f'{arg}={value}&'
         uri = f'{self.base_uri}{endpoint}?{parameters}limit={self.limit_per_page}&offset={offset}'
-        response = requests.get(uri, headers=self.headers)
-        if debug:
-            print(f'code: {response.status_code}, text: {response.text}')
-        if str(response.status_code)[0] != '2':
-            raise ConnectionError(f'Request failed with status code: {response.status_code}')
-        return response.json()
+        cached = self.cache.lookup(uri) if self.cache is not None else None
+        if cached is not None and cached.fresh:
+            return json.loads(cached.body)
+        headers = {**self.headers, **HttpCache.revalidation_headers(cached)}
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            start = time.monotonic()
+            try:
+                response = requests.get(uri, headers=headers)
+                status, retry_after = response.status_code, response.headers.get('Retry-After')
+                if debug:
+                    print(f'code: {response.status_code}, text: {response.text}')
+            except requests.exceptions.RequestException:
+                response, status, retry_after = None, 0, None
+            if self.metrics is not None:
+                self.metrics.record_request(endpoint, status, len(response.content) if response is not None else 0,
+                                            time.monotonic() - start)
+            if status == 304 and cached is not None:  # ~ the cached response is still valid
+                self.cache.refresh(uri)
+                return json.loads(cached.body)
+            if str(status)[0] == '2':
+                if self.cache is not None:
+                    self.cache.store(uri, response.content, response.headers)
+                return response.json()
+            if not self.retry_policy.should_retry(status, attempt):
+                raise ConnectionError(f'Request failed with status code: {status}')
+            self.retry_policy.record_retry(endpoint)
+            if self.metrics is not None:
+                self.metrics.record_retry(endpoint)
+            time.sleep(self.retry_policy.delay(attempt, retry_after))
+            attempt += 1
 
     def _download_all_pages(self, endpoint: str, features: bool, debug: bool = False, **kwargs) -> Generator:
         """
         Download all pages of data for the selected endpoint of Golemio API with the selected parameters as arguments.
-        Page size set by attribute `limit_per_page`, by default to 1000.
+        Page size set by attribute `limit_per_page`, by default to 1000. Up to `prefetch_pages` following pages are
+        requested in advance while the caller processes the current one, at offsets one page size apart. The page size
+        is taken from the pages actually returned, so that a server capping its pages below the limit is read without
+        gaps; the download stops at the first empty page.
         :param endpoint: the selected endpoint to download data from
         :param features: bool whether the data coming in response from Golemio API is under features key
         :param debug: set to True if you need to see responses in the console
         :param kwargs: selected parameters for querying the endpoint
-        :return: Generator yielding the data for individual pages
-        """
-        n = 0
-        while True:
-            json_response = self._download_page(endpoint, offset=n, debug=debug, **kwargs)
-            json_response = json_response['features'] if features else json_response
-            n += len(json_response)
-            if len(json_response) == 0:
-                break
-            yield json_response
+        :return: Generator yielding the data for individual pages, in order
+        """
+        with ThreadPoolExecutor(max_workers=self.prefetch_pages) as executor:
+            pages = deque()  # ~ (offset, future) of the requested pages
+            page_size = self.limit_per_page
+            next_offset = 0
+            try:
+                while True:
+                    while len(pages) < self.prefetch_pages:
+                        pages.append((next_offset, executor.submit(self._download_page, endpoint, offset=next_offset,
+                                                                   debug=debug, **kwargs)))
+                        next_offset += page_size
+                    offset, page = pages.popleft()
+                    json_response = page.result()
+                    json_response = json_response['features'] if features else json_response
+                    if len(json_response) == 0:
+                        break
+                    yield json_response
+                    end = offset + len(json_response)
+                    if (pages[0][0] if pages else next_offset) != end:
+                        # ~ a short page, the last one or capped by the server: request again from where it ended
+                        for _, speculative in pages:
+                            speculative.cancel()
+                        pages.clear()
+                        page_size, next_offset = len(json_response), end
+            finally:
+                for _, page in pages:  # ~ speculative requests past the last page
+                    page.cancel()
 
-    @staticmethod
-    def _save_into_json(data: list or dict, file_path: str):
+    def _save_into_json(self, data: list or dict, file_path: str):
         with open(file_path, 'w', encoding='utf8') as output_f:
-            json.dump(data, output_f, ensure_ascii=False, indent=4)
+            json.dump(data, output_f, ensure_ascii=False, indent=self.json_indent)
 
-    def download_all_stations(self):
+    @staged('download')
+    def download_all_stations(self, stream: bool = True):
         """
         Step 1 of the GolemioApiDonwloader. Download all available public transport stops from the Golemio API,
         and save with all information into json file named `all_stations`.
+        :param stream: write each page to the json lines file `all_stations.ndjson` (one stop per line) as soon as it
+        is downloaded, keeping the memory use flat; set to False to save all the stops into `all_stations.json` at once
         """
         endpoint = 'gtfs/stops'
         json_responses = self._download_all_pages(endpoint, features=True)
+        if stream:
+            # ~ an interrupted download leaves the previous file
+            with atomic_write(self.all_stations_stream_path) as output_f:
+                for response in json_responses:
+                    output_f.writelines(json.dumps(station, ensure_ascii=False) + '\n' for station in response)
+            return
         all_stations = []
         for response in json_responses:
             all_stations.extend(response)
         self._save_into_json(all_stations, self.all_stations_path)
 
-    @staticmethod
-    def _save_parents_into_ids_dict(all_ids: dict, children: dict, parent_station_id: str, station_id: str,
-                                    station_location: dict, station_name: str) -> Tuple[dict, dict]:
-        """
-        Save only the parent stations into a dict containing just the required information.
-        :param all_ids: dict containing the already saved parent stations
-        :param children: dict containing the already saved child stations
-        :param parent_station_id: id of the parent station if this is a child station
-        :param station_id: id of this station
-        :param station_location: location of this station
-        :param station_name: name of this station
-        :return: dict containing the parent stations as all_ids and dict containing the child stations
-        """
-        if parent_station_id:  # ~ if is a child station
-            if parent_station_id in children:  # ~ if this child station`s parent is already saved in children
-                if station_id not in children[parent_station_id]['children']:  # prevent duplication of children
-                    children[parent_station_id]['children'].append(station_id)
-            else:  # ~ if no parent for this child station was found, then save the parent
-                children[parent_station_id] = {
-                    'children': [station_id],
-                }
-        else:  # ~ if this is the parent station itself
-            all_ids[station_id] = {
-                'name': station_name,
-                'location': station_location,
-                'children': [],
-            }
-        return all_ids, children
+    def _load_all_stations(self, stream: bool) -> Iterable[dict]:
+        """
+        Load the stops saved by `download_all_stations`.
+        :param stream: whether the stops were saved in the streaming mode
+        :return: Iterable of the stops, read one by one from the json lines file in the streaming mode
+        """
+        if not stream:
+            with open(self.all_stations_path, encoding='utf8') as input_f:
+                yield from json.load(input_f)
+            return
+        with open(self.all_stations_stream_path, encoding='utf8') as input_f:
+            for line in input_f:
+                yield json.loads(line)
 
-    @staticmethod
-    def _save_children_into_ids_dict(all_ids: dict, children: dict) -> dict:
-        """
-        Extend the dict of parent stations (all_ids) by all their children and children of children.
-        :param all_ids: the parent stations dict
-        :param children: the child stations dict
-        :return: parent station dict complemented by all the child stations
-        """
-        children_of_children = {}
-        child_parent = {}
-        for parent_station_id, children in children.items():
-            if parent_station_id in all_ids:
-                all_ids[parent_station_id]['children'] = children['children']
-                this_children = {child: parent_station_id for child in children['children']}
-                child_parent = {**child_parent, **this_children}
-            else:
-                children_of_children[parent_station_id] = children['children']
-        for parent_station_id, children in children_of_children.items():
-            in_first = set(all_ids[child_parent[parent_station_id]]['children'])
-            in_second = set(children)
-            in_second_but_not_in_first = in_second - in_first
-            all_ids[child_parent[parent_station_id]]['children'].extend(in_second_but_not_in_first)
-        return all_ids
-
-    def filter_station_ids_enriched(self):
+    @staged('filter')
+    def filter_station_ids_enriched(self, stream: bool = True):
         """
         Step 2 of the GolemioApiDonwloader. Transform information about all stations into a json named
-        `all_stations_ids` containing just the required information for parent stations with list of child stations.
-        """
-        with open(self.all_stations_path) as input_f:
-            all_stations = json.load(input_f)
-        all_ids = {}
-        children = {}
-        for station in all_stations:
-            parent_station_id = station['properties']['parent_station']
-            station_id = station['properties']['stop_id']
+        `all_stations_ids` containing just the required information for parent stations with list of child stations
+        (including children of children at any depth), and save the compact `StationRegistry` of the stations into
+        `station_index`, which is also the child-parent index used for aggregating the stop counts. Child stations
+        whose parent stations are missing are reported and saved into json named `orphaned_stations`.
+        :param stream: whether the stations were downloaded in the streaming mode of `download_all_stations`
+        """
+        hierarchy = StationHierarchy()
+        for station in self._load_all_stations(stream):
             station_location = {
                 'lat': station['properties']['stop_lat'],
                 'lon': station['properties']['stop_lon'],
             }
-            station_name = station['properties']['stop_name']
-            all_ids, children = self._save_parents_into_ids_dict(all_ids, children, parent_station_id, station_id,
-                                                                 station_location, station_name)
-        all_ids = self._save_children_into_ids_dict(all_ids, children)
+            hierarchy.add(station['properties']['stop_id'], station['properties']['parent_station'], station_location,
+                          station['properties']['stop_name'])
+        all_ids, orphans = hierarchy.resolve()
+        if orphans:
+            print(f'{len(orphans)} child stations without any known parent station, saved into '
+                  f'{self.orphaned_stations_path}')
+            self._save_into_json(orphans, self.orphaned_stations_path)
         self._save_into_json(all_ids, self.all_stations_ids_path)
+        StationRegistry.from_ids(all_ids).save(self.station_index_path)
 
-    def _build_list_of_urls_for_count_stop(self, all_ids: dict, date: str) -> list:
+    def _build_url_for_count_stop(self, station_id: str, date: str, offset: int) -> str:
         """
-        Build list of urls for async requests to retrieve number of stops by all public transportation for all the
-        stations and the selected date from Golemio API.
-        :param all_ids: dict of all the stations in parent-children format
+        Build url for requesting one page of stop times of the selected station and date from Golemio API.
+        :param station_id: id of the station
         :param date: the selected date
-        :return: list of urls
+        :param offset: skip this number of first stop times (sth. like paging)
+        :return: the url
         """
-        urls = []
-        offset = 0
-
-        kwargs = {
-            'date': date
-        }
-        parameters = ''
-        for arg, value in kwargs.items():
-            parameters += f'{arg}={value}&'
+        return f'{self.base_uri}gtfs/stoptimes/{station_id}?date={date}&limit={self.limit_per_page}&offset={offset}'
 
+    @staticmethod
+    def _list_station_ids(all_ids: dict) -> list:
+        """
+        List ids of all the parent stations and their child stations.
+        :param all_ids: dict of all the stations in parent-children format
+        :return: list of the station ids
+        """
+        station_ids = []
         for station, properties in all_ids.items():
-            station_id = station
-            endpoint = f'gtfs/stoptimes/{station_id}'
-            uri = f'{self.base_uri}{endpoint}?{parameters}limit={self.limit_per_page}&offset={offset}'
-            urls.append(uri)
-            for child_station in properties['children']:
-                station_id = child_station
-                endpoint = f'gtfs/stoptimes/{station_id}'
-                uri = f'{self.base_uri}{endpoint}?{parameters}limit={self.limit_per_page}&offset={offset}'
-                urls.append(uri)
-        return urls
-
-    def _build_list_of_urls_for_count_stop_cont(self, date: str) -> list:
-        """
-        Build list of urls for async requests to retrieve number of stops by all public transportation for all the
-        stations and the selected date from Golemio API.
-        THIS BUILDS URIS LIST FROM THE REMAINING requests after the last async requesting of the data!
+            station_ids.append(station)
+            station_ids.extend(properties['children'])
+        return station_ids
+
+    async def _count_stop_times_page(self, engine: 'AsyncDownloadEngine', journal: CrawlJournal, date: str,
+                                     station_id: str, offset: int) -> Optional[int]:
+        """
+        Download one page of the stop times of the selected station and date, and record its count into the journal.
+        A failed page is left in the journal for a resumed crawl.
+        :param engine: the engine to download the page with
+        :param journal: the crawl journal
         :param date: the selected date
-        :return: list of urls
+        :param station_id: id of the station
+        :param offset: offset of the page
+        :return: offset of the next page of the station, None if this is the last page or it failed
         """
-        urls = []
-        kwargs = {
-            'date': date
-        }
-        parameters = ''
-        for arg, value in kwargs.items():
-            parameters += f'{arg}={value}&'
+        if self.hourly_stop_times:
+            parser = count_departures_by_hour
+        else:
+            parser = count_array_items if self.count_only_parsing else lambda body: len(json.loads(body))
+        result = await engine.fetch(self._build_url_for_count_stop(station_id, date, offset),
+                                    endpoint='gtfs/stoptimes', parser=parser)
+        if not result.ok:
+            print(f'Problem: {result.url}: {result.error}')
+            journal.mark_failed(date, station_id, offset, str(result.error))
+            return None
+        n, hours = result.data if self.hourly_stop_times else (result.data, None)
+        # ~ the server may return fewer stop times than `limit_per_page` on any page, only an empty page is the last
+        next_offset = offset + n if n else None
+        journal.mark_done(date, station_id, offset, n, next_offset, hours)
+        if next_offset is None and self.metrics is not None:
+            self.metrics.record_pages(journal.count_pages(date, station_id))
+        return next_offset
 
-        for station in self.__remaining_async:
-            station_id = station['stop_id']
-            offset = station['offset']
-            endpoint = f'gtfs/stoptimes/{station_id}'
-            uri = f'{self.base_uri}{endpoint}?{parameters}limit={self.limit_per_page}&offset={offset}'
-            urls.append(uri)
-        return urls
+    @staticmethod
+    def _shard_of(station_id: str, n_shards: int) -> int:
+        """
+        :param station_id: id of the parent station
+        :param n_shards: number of the shards
+        :return: the shard (1 to n_shards) of the station, the same in any process or machine
+        """
+        return zlib.crc32(station_id.encode('utf8')) % n_shards + 1
 
     @staticmethod
-    def __exception(request: requests.models.Response, exception):
-        """
-        Exception handling of each individual request.
-        :param request: the request
-        :param exception: the exception of the request
-        """
-        print("Problem: {}: {}".format(request.url, exception))
-
-    def __callback(self, res: requests.models.Response, **kwargs):
-        """
-        Callback for each of the individual requests. Add the number of stops for the individual station into
-        `self.__counted_stops` dict and append data for requesting the next page of stops into the `__remaining_async`.
-        :param res: the response
-        :param kwargs: the kwargs
-        """
-        responses = res.json()
-        n = len(responses)
-        if n and self.__counted_stops.get(responses[0]['stop_id']):
-            self.__remaining_async.append(
-                {
-                    'stop_id': [responses[0]['stop_id']],
-                    'offset': n + self.__counted_stops[responses[0]['stop_id']],
-                }
-            )
-            self.__counted_stops[responses[0]['stop_id']] += n
-        elif n:
-            self.__counted_stops[responses[0]['stop_id']] = n
-            self.__remaining_async.append(
-                {
-                    'stop_id': [responses[0]['stop_id']],
-                    'offset': n,
-                }
-            )
-
-    def __async_requests(self, urls: list):
-        """
-        Async request the urls, handling responses with `__callback` and `__exception`.
-        :param urls: list of the urls to request
-        """
-        self.__remaining_async = []
-        req = (grequests.get(u, headers=self.headers, hooks=dict(response=self.__callback)) for u in urls)
-        grequests.map(req, exception_handler=self.__exception, size=5)
+    def _shard_suffix(shard: Optional[Tuple[int, int]]) -> str:
+        return f'_shard{shard[0]}of{shard[1]}' if shard is not None else ''
+
+    def _save_stop_count_chunk(self, journal: CrawlJournal, date: str, n: int):
+        suffix = self._shard_suffix(self.shard)
+        self._save_into_json(journal.stop_counts(date, n), f'{self.all_stop_count_path}{suffix}_{date}_{n}.json')
+        if self.hourly_stop_times:
+            station_ids, hours = journal.stop_hours(date, n)
+            save_npz(f'{self.all_stop_hours_path}{suffix}_{date}_{n}.npz', stop_ids=np.array(station_ids, dtype=str),
+                     hours=hours)
+        failed = journal.count_failed(date, n)
+        if failed:
+            print(f'{failed} pages of chunk {n} for {date} failed, run again with `resume=True` to retry them')
+
+    async def _count_stop_times_worker(self, engine: 'AsyncDownloadEngine', journal: CrawlJournal,
+                                       queue: asyncio.Queue, remaining: Counter):
+        """
+        Take the pages (date, chunk number, station id, offset) from the queue until cancelled, putting back the
+        next page of the station, and save each chunk of a date as soon as its last page is counted.
+        :param engine: the engine to download the pages with
+        :param journal: the crawl journal
+        :param queue: the queue of the pages
+        :param remaining: number of the pages remaining in the queue by (date, chunk number)
+        """
+        while True:
+            date, n, station_id, offset = await queue.get()
+            try:
+                next_offset = await self._count_stop_times_page(engine, journal, date, station_id, offset)
+                if next_offset is not None:
+                    remaining[date, n] += 1
+                    queue.put_nowait((date, n, station_id, next_offset))
+                elif self.metrics is not None:  # ~ the station is done
+                    self.metrics.advance('crawl')
+                remaining[date, n] -= 1
+                if not remaining[date, n]:
+                    self._save_stop_count_chunk(journal, date, n)
+            finally:
+                queue.task_done()
+
+    async def _count_stop_times(self, chunks: list, dates: list, resume: bool):
+        """
+        Count stop times of the stations from all the chunks for all the dates in one queue of pages processed by
+        workers sharing one engine, saving each chunk of a date into json file `all_stop_count_{date}_{chunk_number}`
+        as soon as it is done.
+        :param chunks: list of dicts of the stations in parent-children format
+        :param dates: the selected dates
+        :param resume: whether to continue the crawl recorded in the journal instead of starting over
+        """
+        from app.engine import AsyncDownloadEngine  # ~ aiohttp is imported only by the crawl
+        journal_path, extension = os.path.splitext(self.crawl_journal_path)
+        with CrawlJournal(f'{journal_path}{self._shard_suffix(self.shard)}{extension}') as journal:
+            queue = asyncio.Queue()
+            remaining = Counter()
+            for date in dates:
+                if not resume:
+                    journal.reset(date)
+                for n, chunk in enumerate(chunks, start=1):
+                    journal.add_stations(date, n, self._list_station_ids(chunk))
+                    for station_id, offset in journal.unfinished_pages(date, n):
+                        queue.put_nowait((date, n, station_id, offset))
+                        remaining[date, n] += 1
+                    if not remaining[date, n]:  # ~ the chunk was already done by the resumed crawl
+                        self._save_stop_count_chunk(journal, date, n)
+            if self.metrics is not None:
+                self.metrics.start_progress('crawl', queue.qsize())  # ~ one page in the queue for each station
+            async with AsyncDownloadEngine(self.headers, initial_concurrency=self.initial_concurrency,
+                                           max_concurrency=self.max_concurrency, rate_limiter=self.rate_limiter,
+                                           retry_policy=self.retry_policy, cache=self.cache,
+                                           metrics=self.metrics) as engine:
+                workers = [asyncio.ensure_future(self._count_stop_times_worker(engine, journal, queue, remaining))
+                           for _ in range(self.max_concurrency)]
+                joined = asyncio.ensure_future(queue.join())
+                done, _ = await asyncio.wait([joined, *workers], return_when=asyncio.FIRST_COMPLETED)
+                for task in [joined, *workers]:
+                    task.cancel()
+                for task in done:
+                    task.result()  # ~ re-raise the error of a failed worker
+        if self.retry_policy.retries:
+            print(f'Retries by endpoint: {dict(self.retry_policy.retries)}')
+        if self.cache is not None:
+            print(f'Cache: {self.cache.stats()}')
 
     @staticmethod
     def _split_dict_into_n_sized_chunks(d: dict, n: int) -> Generator:
@@ -262,117 +372,218 @@ class GolemioApiDownloader:
         for i in range(0, len(d), n):
             yield {k: d[k] for k in islice(it, n)}
 
-    def count_stop_times_per_day(self, date: str):
+    def count_stop_times_per_day(self, date: str, resume: bool = False):
         """
         Step 3 of the GolemioApiDonwloader. Download all stop counts for all the stations from `all_stations_ids.json`
         and save into json files by the selected date, `all_stop_count_{date}_{page_number}.
+        Progress is recorded page by page in the crawl journal `crawl_journal.sqlite`.
         :param date: the selected date
+        :param resume: set to True to continue an interrupted or partially failed crawl of the date, downloading only
+        the pages that are not done yet
+        """
+        self.count_stop_times_for_dates([date], resume=resume, assign=False)
+
+    def count_stop_times_for_dates(self, dates: list, resume: bool = False, assign: bool = True,
+                                   initial: bool = False):
+        """
+        Steps 3 and 4 of the GolemioApiDonwloader for several dates at once (e.g. the whole window of today and 10
+        days in advance served by the API). Download all stop counts for all the stations and all the dates in one
+        pass, save them into json files by date like `count_stop_times_per_day`, and assign them all to the parent
+        stations in one write of the store.
+        With the `shard` attribute set to (i, n), only the parent stations (with their children) of shard i of n,
+        selected by a stable hash of their id, are downloaded, into the files `all_stop_count_shard{i}of{n}_{date}_*`
+        with their own crawl journal, so that the n shards can run in separate processes or on separate machines (each
+        with its own rate limit) at once. The stop counts of a shard are not assigned; the outputs of all the shards
+        are combined by `merge_shards` first.
+        :param dates: the selected dates
+        :param resume: set to True to continue an interrupted or partially failed crawl of the dates
+        :param assign: set to False to only download the stop counts, without assigning them
+        :param initial: bool whether there are already any data for stop counts, as in `assign_stop_count`
         """
         with open(self.all_stations_ids_path) as input_f:
             all_ids = json.load(input_f)
-        n = 1
-        for chunk in self._split_dict_into_n_sized_chunks(all_ids, 4000):
-            urls = self._build_list_of_urls_for_count_stop(chunk, date)
-            self.__async_requests(urls)
-            while self.__remaining_async:
-                urls = self._build_list_of_urls_for_count_stop_cont(date)
-                self.__async_requests(urls)
-            self._save_into_json(self.__counted_stops, f'{self.all_stop_count_path}_{date}_{n}.json')
-
-            n += 1
-            self.__counted_stops = {}
-            print('Sleeping...')
-            time.sleep(30)  # prevent possible timeout
-            print('Sleeping done...')
+        if self.shard is not None:
+            shard, n_shards = self.shard
+            if not 1 <= shard <= n_shards:
+                raise ValueError(f'Invalid shard {shard}/{n_shards}')
+            all_ids = {station_id: properties for station_id, properties in all_ids.items()
+                       if self._shard_of(station_id, n_shards) == shard}
+        chunks = list(self._split_dict_into_n_sized_chunks(all_ids, self.stations_per_chunk))
+        from app.engine import run_coroutine  # ~ aiohttp is imported only by the crawl
+        with stage(self.metrics, 'crawl'):
+            run_coroutine(self._count_stop_times(chunks, dates, resume))
+        if assign and self.shard is not None:
+            print(f'The stop counts of shard {self.shard[0]}/{self.shard[1]} are not assigned, run `merge_shards` '
+                  f'when all the shards are done and assign them then')
+        elif assign:
+            self.assign_stop_counts(dates, initial)
 
-    @staticmethod
-    def _copy_dict_without_keys(d: dict, invalid_keys: list) -> dict:
-        return {x: d[x] for x in d if x not in invalid_keys}
+    def _list_shard_files(self, path: str, shard: Tuple[int, int], date: str, extension: str) -> list:
+        return sorted(glob.glob(f'{glob.escape(path)}{self._shard_suffix(shard)}_{date}_*{extension}'))
 
-    @staticmethod
-    def _get_child_parent_dict(all_ids: dict) -> dict:
+    @staged('merge')
+    def merge_shards(self, dates: list, n_shards: int):
         """
-        Get dict of child-parent relations in the format: {child1: parent1, child2: parent1, child3: parent2, ...}.
-        :param all_ids: all parent stations with their children
-        :return: dict in the mentioned format
+        Step 3 of the GolemioApiDonwloader crawled in n_shards shards (see `count_stop_times_for_dates`). Combine the
+        stop counts (and the departures by hour, if crawled) downloaded by all the shards for the selected dates into
+        the files `all_stop_count_{date}_{n}` exactly as a crawl without shards would save them, replacing any files of
+        a former crawl of the dates. The result does not depend on the order in which the shards finished. The files of
+        the shards are kept.
+        :param dates: the selected dates
+        :param n_shards: number of the shards
         """
-        child_parent = {}
-        for parent_station, properties in all_ids.items():
-            for child_station in properties['children']:
-                child_parent[child_station] = parent_station
-        return child_parent
+        with open(self.all_stations_ids_path) as input_f:
+            all_ids = json.load(input_f)
+        shards = sorted({self._shard_of(station_id, n_shards) for station_id in all_ids})  # ~ shards with stations
+        for date in dates:
+            stop_counts, stop_hours, shards_with_hours = {}, {}, 0
+            for shard in shards:
+                file_paths = self._list_shard_files(self.all_stop_count_path, (shard, n_shards), date, '.json')
+                if not file_paths:
+                    raise FileNotFoundError(f'No stop counts of shard {shard}/{n_shards} for {date}')
+                for file_path in file_paths:
+                    stop_counts.update(load_json_file(file_path))
+                file_paths = self._list_shard_files(self.all_stop_hours_path, (shard, n_shards), date, '.npz')
+                shards_with_hours += bool(file_paths)
+                for file_path in file_paths:
+                    with np.load(file_path) as stops:
+                        stop_hours.update(zip(stops['stop_ids'].tolist(), stops['hours']))
+            if shards_with_hours not in (0, len(shards)):
+                raise ValueError(f'Only {shards_with_hours} of {len(shards)} shards counted the departures by hour for '
+                                 f'{date}, crawl the others with `hourly_stop_times` set')
+            for file_path in self._list_stop_count_files(date) + \
+                    self._list_shard_files(self.all_stop_hours_path, None, date, '.npz'):
+                os.remove(file_path)  # ~ a former crawl may have saved more chunks
+            for n, chunk in enumerate(self._split_dict_into_n_sized_chunks(all_ids, self.stations_per_chunk), start=1):
+                station_ids = sorted(self._list_station_ids(chunk))  # ~ in the order of the crawl journal
+                self._save_into_json({station_id: stop_counts[station_id] for station_id in station_ids
+                                      if station_id in stop_counts}, f'{self.all_stop_count_path}_{date}_{n}.json')
+                if shards_with_hours:
+                    station_ids = [station_id for station_id in station_ids if station_id in stop_hours]
+                    hours = np.array([stop_hours[station_id] for station_id in station_ids], dtype=np.uint16)
+                    save_npz(f'{self.all_stop_hours_path}_{date}_{n}.npz', stop_ids=np.array(station_ids, dtype=str),
+                             hours=hours.reshape(-1, 24))
 
-    def _aggregate_stop_count_per_file(self, stops: dict, all_ids: dict, all_stops: dict) -> dict:
+    def _station_index(self) -> StationIndex:
         """
-        Aggregate the stop count for the selected file.
-        :param stops: stop count from the selected file
-        :param all_ids: all parent stations with their children as in the `all_stations_ids.json`
-        :param all_stops: CURRENT all parent stations dict with the corresponding stop count
-        :return: UPDATED all parent stations dict with the corresponding stop count
+        Load the child-parent index saved by `filter_station_ids_enriched`, building it from `all_stations_ids.json`
+        if it is missing.
         """
-        child_parent = self._get_child_parent_dict(all_ids)
-        for station, count in stops.items():
-            station = child_parent[station] if station not in all_ids else station
-            if station in all_stops:
-                all_stops[station] += count
-            else:
-                all_stops[station] = count
-        return all_stops
+        if os.path.exists(self.station_index_path):
+            return StationIndex.load(self.station_index_path)
+        with open(self.all_stations_ids_path) as input_f:
+            station_index = StationIndex.from_ids(json.load(input_f))
+        station_index.save(self.station_index_path)
+        return station_index
+
+    def _list_stop_count_files(self, date: str) -> list:
+        return sorted(glob.glob(f'{glob.escape(self.all_stop_count_path)}_{date}_*.json'))
+
+    @staged('aggregate')
+    def aggregate_stop_counts(self, dates: list) -> Tuple[np.ndarray, list]:
+        """
+        Aggregate all stop count (including that of child stations) for all the parent stations for the selected dates
+        in one pass over all their `all_stop_count_{date}_{n}.json` files, as a group-by of the stops by their parent
+        station row from the child-parent index. The files are parsed and summed in `aggregate_workers` processes,
+        with orjson if it is installed.
+        :param dates: the selected dates
+        :return: array of the aggregated stop counts of shape (number of dates, number of parent stations); and list
+        of the ids of the parent stations in the order of the columns
+        """
+        station_index = self._station_index()
+        files = [(date_row, file_path) for date_row, date in enumerate(dates)
+                 for file_path in self._list_stop_count_files(date)]
+        all_stops = np.zeros((len(dates), station_index.n_parents), dtype=np.int64)
+        unknown = 0
+        partial_sums = sum_stop_count_files(station_index, self.station_index_path, [path for _, path in files],
+                                            workers=self.aggregate_workers)
+        for (date_row, _), (partial, skipped) in zip(files, partial_sums):
+            all_stops[date_row] += partial
+            unknown += skipped
+        if unknown:
+            print(f'Skipping {unknown} stop counts of stations missing in `all_stations_ids.json`')
+        return all_stops, station_index.parent_ids
 
-    def aggregate_stop_count(self, date: str) -> Tuple[dict, dict]:
+    def aggregate_stop_hours(self, dates: list) -> Tuple[np.ndarray, list]:
+        """
+        Aggregate the departures by hour of all the stops (including the child stations) for all the parent stations
+        for the selected dates from their `all_stop_hours_{date}_{n}.npz` files, saved by the crawl with
+        `hourly_stop_times` set.
+        :param dates: the selected dates
+        :return: array of the aggregated departures of shape (number of dates, number of parent stations, 24); and
+        list of the ids of the parent stations in the order of the rows
+        """
+        station_index = self._station_index()
+        all_hours = np.zeros((len(dates), station_index.n_parents, 24), dtype=np.int64)
+        unknown = 0
+        for date_row, date in enumerate(dates):
+            file_paths = self._list_shard_files(self.all_stop_hours_path, None, date, '.npz')
+            if not file_paths:
+                raise FileNotFoundError(f'No departures by hour for {date}, crawl it with `hourly_stop_times` set')
+            for file_path in file_paths:
+                partial, skipped = sum_stop_hours_file(station_index, file_path)
+                all_hours[date_row] += partial
+                unknown += skipped
+        if unknown:
+            print(f'Skipping {unknown} departures by hour of stations missing in `all_stations_ids.json`')
+        return all_hours, station_index.parent_ids
+
+    def aggregate_stop_count(self, date: str) -> dict:
         """
         Aggregate all stop count (including that of child stations) for all the parent stations for the selected date.
         :param date: the selected date
-        :return: dict of all the parent stations and the corresponding aggregated stop count; and dict of all parent
-        stations with their children as in the `all_stations_ids.json`
+        :return: dict of all the parent stations and the corresponding aggregated stop count
         """
-        with open(self.all_stations_ids_path) as input_f:
-            all_ids = json.load(input_f)
-        all_stops = {}
-        for file in os.scandir('data'):
-            if f'{self.all_stop_count_path.split("/")[1]}_{date}' in file.name:
-                with open(file.path) as stops_f:
-                    stops = json.load(stops_f)
-                    all_stops = self._aggregate_stop_count_per_file(stops, all_ids, all_stops)
-        return all_stops, all_ids
-
-    def _assign_stop_count(self, all_ids: dict, all_stops: dict, parent_stations_with_count: dict, date: str,
-                           initial: bool) -> dict:
-        """
-        Create dict of parent stations with the necessary information if initial, otherwise take the already loaded
-        data and enriched by aggregated stop count for the selected date
-        :param all_ids: all parent stations with their children as in the `all_stations_ids.json`
-        :param all_stops: all parent stations dict with the corresponding stop count
-        :param parent_stations_with_count: the dict containing already assigned stop counts or empty dict
-        :param date: the selected date
-        :param initial: bool whether there are already any data for stop counts
-        :return: dict of updated (or newly created if `initial=False`) assigned stop counts
+        all_stops, parent_ids = self.aggregate_stop_counts([date])
+        return dict(zip(parent_ids, all_stops[0].tolist()))
+
+    def _stop_count_store(self) -> StopCountStore:
+        return StopCountStore(self.stop_count_store_path)
+
+    @staged('assign')
+    def assign_stop_counts(self, dates: list, initial: bool):
+        """
+        Step 4 of the GolemioApiDonwloader. Assign the aggregated already downloaded all stop counts for the selected
+        dates to all the parent stations from `all_stations_ids.json`, and save them as columns of the columnar store
+        `stop_count_store` (see `StopCountStore`) in one write, leaving the other dates untouched. With
+        `hourly_stop_times` set, the departures by hour are aggregated and saved for the dates as well.
+        :param dates: the selected dates
+        :param initial: bool whether there are already any data for stop counts or this is the initial assignment
         """
-        for station, properties in all_ids.items():
-            if initial:
-                __temp_properties = self._copy_dict_without_keys(all_ids[station], ['children'])
-                __temp_properties['count'] = {date: all_stops.get(station, 0)}
-                parent_stations_with_count[station] = __temp_properties
-            else:
-                parent_stations_with_count[station]['count'][date] = all_stops.get(station, 0)
-        return parent_stations_with_count
+        all_stops, parent_ids = self.aggregate_stop_counts(dates)
+        store = self._stop_count_store()
+        if initial:
+            with open(self.all_stations_ids_path) as input_f:
+                store.create(json.load(input_f))
+        elif not store.exists():  # ~ continue from the stop counts assigned into json before the store existed
+            with open(self.parent_ids_with_count_path, encoding='utf8') as f:
+                store.import_json(json.load(f))
+        if parent_ids != store.index['ids']:  # ~ the store was created from a different version of the stations
+            columns = {parent_id: i for i, parent_id in enumerate(parent_ids)}
+            rows = np.array([columns.get(station, -1) for station in store.index['ids']], dtype=np.int64)
+            all_stops = np.where(rows >= 0, all_stops[:, rows], 0)
+        store.write_columns(dict(zip(dates, all_stops)))
+        if self.hourly_stop_times:
+            all_hours, _ = self.aggregate_stop_hours(dates)
+            if parent_ids != store.index['ids']:
+                all_hours = np.where((rows >= 0)[:, None], all_hours[:, rows], 0)
+            store.write_hour_columns(dict(zip(dates, all_hours)))
 
     def assign_stop_count(self, date: str, initial: bool):
         """
-        Step 3 of the GolemioApiDonwloader. Assign the aggregated already downloaded all stop counts for the selected
-        date to all the parent stations from `all_stations_ids.json`,
-         and save into json file named `final-stations_with_count`.
+        Step 4 of the GolemioApiDonwloader for one date, see `assign_stop_counts`.
         :param date: the selected date
         :param initial: bool whether there are already any data for stop counts or this is the initial assignment
         """
-        if initial:
-            parent_ids_count = {}
-        else:
-            with open(self.parent_ids_with_count_path) as f:
-                parent_ids_count = json.load(f)
-        all_stops, all_ids = self.aggregate_stop_count(date)
-        parent_ids_count = self._assign_stop_count(all_ids, all_stops, parent_ids_count, date, initial)
-        self._save_into_json(parent_ids_count, self.parent_ids_with_count_path)
+        self.assign_stop_counts([date], initial)
+
+    @staged('export')
+    def export_stop_count_json(self):
+        """
+        Step 5 of the GolemioApiDonwloader (optional). Export all the assigned stop counts from the columnar store
+        into json file named `final-stations_with_count`.
+        """
+        self._save_into_json(self._stop_count_store().export_json(), self.parent_ids_with_count_path)
 
 
 if __name__ == '__main__':
@@ -383,3 +594,4 @@ if __name__ == '__main__':
     # golemio.filter_station_ids_enriched()
     # golemio.count_stop_times_per_day(my_date)
     # golemio.assign_stop_count(my_date, initial=False)
+    # golemio.export_stop_count_json()
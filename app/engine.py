@@ -0,0 +1,174 @@
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Coroutine, NamedTuple, Optional, Tuple
+
+import aiohttp
+
+from app.cache import CacheEntry, HttpCache
+from app.metrics import Metrics
+from app.ratelimit import RetryPolicy, TokenBucket
+
+
+class FetchResult(NamedTuple):
+    url: str
+    status: int
+    data: Any
+    error: Optional[Exception]
+    latency: float
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Limit on the number of requests in flight, adjusted with AIMD (additive increase, multiplicative decrease).
+    The limit grows by one per window of successful requests while the smoothed latency stays under
+    `target_latency`, and is cut by `decrease_factor` on errors or when the latency exceeds the target.
+    """
+
+    def __init__(self, initial: int = 5, minimum: int = 1, maximum: int = 64, target_latency: float = 1.0,
+                 decrease_factor: float = 0.5, smoothing: float = 0.2):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.decrease_factor = decrease_factor
+        self.smoothing = smoothing
+        self.latency = None
+        self.in_flight = 0
+        self._last_decrease = 0.
+        self._condition = None
+
+    async def acquire(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, latency: float, ok: bool):
+        self.latency = latency if self.latency is None else \
+            self.smoothing * latency + (1 - self.smoothing) * self.latency
+        if not ok or self.latency > self.target_latency:
+            self._decrease()
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def _decrease(self):
+        # decrease at most once per round trip, a burst of failures from one window counts as a single signal
+        now = time.monotonic()
+        if now - self._last_decrease < (self.latency or 0.):
+            return
+        self._last_decrease = now
+        self.limit = max(self.minimum, self.limit * self.decrease_factor)
+
+
+class AsyncDownloadEngine:
+    """
+    Asyncio HTTP client sharing one keep-alive connection pool across all requests, with the number of concurrent
+    requests driven by `AdaptiveConcurrencyLimiter`, the request rate by an optional shared `TokenBucket`, and
+    responses optionally cached in `HttpCache`. Requests are recorded in the optional `Metrics`. Use as an async
+    context manager.
+    """
+
+    def __init__(self, headers: dict, max_connections: int = 64, initial_concurrency: int = 5,
+                 max_concurrency: int = 64, target_latency: float = 1.0, timeout: float = 60.,
+                 rate_limiter: TokenBucket = None, retry_policy: RetryPolicy = None, cache: HttpCache = None,
+                 metrics: Metrics = None):
+        self.headers = headers
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.limiter = AdaptiveConcurrencyLimiter(initial=initial_concurrency, maximum=max_concurrency,
+                                                  target_latency=target_latency)
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.cache = cache
+        self.metrics = metrics
+        self._session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.max_connections)
+        self._session = aiohttp.ClientSession(headers=self.headers, connector=connector,
+                                              timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._session.close()
+
+    async def _fetch_once(self, url: str, endpoint: str, parser: Callable[[bytes], Any],
+                          cached: Optional[CacheEntry]) -> Tuple[FetchResult, Optional[str]]:
+        """
+        Request the url once, within the rate and concurrency limits, conditionally on the stale cached response.
+        :return: FetchResult and the value of the `Retry-After` header of the response
+        """
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire_async()
+        await self.limiter.acquire()
+        start = time.monotonic()
+        status, data, error, retry_after, size = 0, None, None, None, 0
+        try:
+            async with self._session.get(url, headers=HttpCache.revalidation_headers(cached)) as response:
+                status = response.status
+                retry_after = response.headers.get('Retry-After')
+                body = await response.read()
+                size = len(body)
+            if status == 304 and cached is not None:  # ~ the cached response is still valid
+                self.cache.refresh(url)
+                body = cached.body
+            elif str(status)[0] != '2':
+                raise ConnectionError(f'Request failed with status code: {status}')
+            elif self.cache is not None:
+                self.cache.store(url, body, response.headers)
+            data = parser(body)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError, ValueError) as e:
+            error = e
+        latency = time.monotonic() - start
+        if self.metrics is not None:
+            self.metrics.record_request(endpoint, status, size, latency)
+        await self.limiter.release(latency, ok=error is None)
+        return FetchResult(url, status, data, error, latency), retry_after
+
+    async def fetch(self, url: str, endpoint: str = '', parser: Callable[[bytes], Any] = json.loads) -> FetchResult:
+        """
+        Request the url and parse the body of the response, retrying rate limited and failed requests with backoff
+        given by the retry policy. Fresh responses from the cache are returned without any request.
+        :param url: the url to request
+        :param endpoint: name of the endpoint the requests and retries are counted under
+        :param parser: function turning the raw body into the returned data, `json.loads` by default
+        :return: FetchResult with the parsed data, or with the error if the request failed even after the retries
+        """
+        cached = self.cache.lookup(url) if self.cache is not None else None
+        if cached is not None and cached.fresh:
+            return FetchResult(url, 200, parser(cached.body), None, 0.)
+        attempt = 0
+        while True:
+            result, retry_after = await self._fetch_once(url, endpoint, parser, cached)
+            if result.ok or not self.retry_policy.should_retry(result.status, attempt):
+                return result
+            self.retry_policy.record_retry(endpoint)
+            if self.metrics is not None:
+                self.metrics.record_retry(endpoint)
+            await asyncio.sleep(self.retry_policy.delay(attempt, retry_after))
+            attempt += 1
+
+
+def run_coroutine(coroutine: Coroutine) -> Any:
+    """
+    Run the coroutine to completion from synchronous code, also when called from within a running event loop
+    (e.g. in Jupyter Notebook), in which case it runs in a separate thread with its own loop.
+    :param coroutine: the coroutine to run
+    :return: the result of the coroutine
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
@@ -0,0 +1,71 @@
+from typing import List, Tuple
+
+
+class StationHierarchy:
+    """
+    Hierarchy of the public transport stops, resolving every stop to its root parent station (a stop without
+    `parent_station`) through any number of nesting levels. Stops are added one by one in O(1), and `resolve` finds
+    all the roots in O(n) by following the parent links with path compression, so each link is walked only once.
+    """
+
+    def __init__(self):
+        self.roots = {}
+        self._parents = {}
+
+    def add(self, station_id: str, parent_station_id: str, station_location: dict, station_name: str):
+        """
+        Add the stop into the hierarchy.
+        :param station_id: id of this station
+        :param parent_station_id: id of the parent station if this is a child station
+        :param station_location: location of this station
+        :param station_name: name of this station
+        """
+        if parent_station_id:  # ~ if is a child station
+            self._parents[station_id] = parent_station_id
+        else:  # ~ if this is the parent station itself
+            self.roots[station_id] = {
+                'name': station_name,
+                'location': station_location,
+                'children': [],
+            }
+
+    def _find_root(self, station_id: str, root_of: dict) -> str:
+        """
+        Find the root parent station of the child station, remembering the root of every station on the way.
+        :param station_id: id of the child station
+        :param root_of: the already resolved roots of child stations, None for orphaned stations
+        :return: id of the root parent station, None if the chain of parents ends at an unknown station or in a cycle
+        """
+        path = []
+        on_path = set()
+        station = station_id
+        while station not in self.roots and station not in root_of:
+            if station not in self._parents or station in on_path:
+                root = None
+                break
+            path.append(station)
+            on_path.add(station)
+            station = self._parents[station]
+        else:
+            root = station if station in self.roots else root_of[station]
+        for station in path:
+            root_of[station] = root
+        return root
+
+    def resolve(self) -> Tuple[dict, List[str]]:
+        """
+        Assign all the child stations to their root parent stations.
+        :return: dict of the root parent stations with all their (also indirect) child stations in the order they
+        were added, as in `all_stations_ids.json`; and list of the orphaned child stations that have no known root
+        """
+        root_of = {}
+        orphans = []
+        for station_id in self._parents:
+            if station_id in self.roots:  # ~ the same stop also listed without parent station
+                continue
+            root = self._find_root(station_id, root_of)
+            if root is None:
+                orphans.append(station_id)
+            else:
+                self.roots[root]['children'].append(station_id)
+        return self.roots, orphans
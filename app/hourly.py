@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+
+from app.store import save_npz
+
+
+class HourlyTrafficAggregates:
+    """
+    Per-station and per-hour aggregates of the traffic records, computed once from the merged traffic data (the output
+    of `Traffic.merge_panda`). For each station (a distinct id, name, lat and lon) and each hour of the scheduled
+    departure, the sums of delay, flow and load and the number of departures are kept as prefix sums over the 24
+    hours, so the mean over any `[start, end)` hour range is two lookups per station instead of a scan of the records.
+    Saved as `.npz`.
+    """
+    OUTPUTS = ('delay', 'flow', 'load')
+
+    def __init__(self, stations: pd.DataFrame, prefix_counts: np.ndarray, prefix_sums: dict):
+        """
+        :param stations: DataFrame with the id, name, lat and lon of the stations
+        :param prefix_counts: array (stations x 25) of the number of departures before each hour
+        :param prefix_sums: dict of arrays (stations x 25) of the sums of the outputs before each hour by output
+        """
+        self.stations = stations
+        self.prefix_counts = prefix_counts
+        self.prefix_sums = prefix_sums
+
+    @classmethod
+    def from_frame(cls, data: pd.DataFrame) -> 'HourlyTrafficAggregates':
+        """
+        :param data: traffic records merged with the stops, with parsed departure times
+        """
+        keys = ['id', 'name', 'lat', 'lon']
+        # ~ missing departures and stations without any of the keys are left out, as by the mean of the groupby
+        data = data.loc[data['realTime'].notna() & data['schTime'].notna() & data[keys].notna().all(axis=1)]
+        grouped = data.groupby(keys, sort=True, observed=True)
+        stations = grouped.size().index.to_frame(index=False)
+        n = len(stations)
+        bins = grouped.ngroup().to_numpy() * 24 + data['schTime'].dt.hour.to_numpy()
+        delay = (data['realTime'] - data['schTime']).dt.total_seconds().to_numpy()
+        values = {
+            'delay': np.maximum(delay, 0),  # ~ early departure treated as on time
+            'flow': (data['entry'] + data['exit']).to_numpy(dtype=np.float64),
+            'load': (data['aftDep'] + data['befArr']).to_numpy(dtype=np.float64) / 2,
+        }
+
+        def prefix(hourly: np.ndarray) -> np.ndarray:
+            cumulative = np.zeros((n, 25), dtype=hourly.dtype)
+            np.cumsum(hourly.reshape(n, 24), axis=1, out=cumulative[:, 1:])
+            return cumulative
+
+        return cls(
+            stations,
+            prefix(np.bincount(bins, minlength=n * 24)),
+            {out: prefix(np.bincount(bins, weights=values[out], minlength=n * 24)) for out in cls.OUTPUTS},
+        )
+
+    def means(self, start: int, end: int, out: str) -> np.ndarray:
+        """
+        Mean of the output by station for the departures scheduled in the selected hour range.
+        :param start: starting hour (inclusive)
+        :param end: ending hour (exclusive)
+        :param out: delay, flow or load
+        :return: array of the means in the order of `stations`, NaN for stations without departures in the hour range
+        """
+        if out not in self.prefix_sums:
+            raise ValueError('Invalid request')
+        first, last = (min(max(int(np.ceil(hour)), 0), 24) for hour in (start, end))
+        last = max(first, last)
+        counts = self.prefix_counts[:, last] - self.prefix_counts[:, first]
+        sums = self.prefix_sums[out][:, last] - self.prefix_sums[out][:, first]
+        means = np.full(len(counts), np.nan)
+        np.divide(sums, counts, out=means, where=counts > 0)
+        return means
+
+    def query(self, start: int, end: int, out: str) -> pd.DataFrame:
+        """
+        Mean of the output by station for the departures scheduled in the selected hour range.
+        :param start: starting hour (inclusive)
+        :param end: ending hour (exclusive)
+        :param out: delay, flow or load
+        :return: DataFrame indexed by the station id with the name, lat, lon and output of the stations having any
+        departures in the hour range, as returned by `Traffic.output_col`
+        """
+        means = self.means(start, end, out)
+        present = ~np.isnan(means)
+        query = self.stations.loc[present, ['name', 'lat', 'lon']].set_index(self.stations['id'][present])
+        query['output'] = means[present]
+        return query
+
+    def save(self, path: str):
+        save_npz(
+            path, ids=self.stations['id'].to_numpy(dtype=str), names=self.stations['name'].to_numpy(dtype=str),
+            lat=self.stations['lat'].to_numpy(dtype=np.float64), lon=self.stations['lon'].to_numpy(dtype=np.float64),
+            counts=self.prefix_counts, **{f'sum_{out}': sums for out, sums in self.prefix_sums.items()},
+        )
+
+    @classmethod
+    def load(cls, path: str) -> 'HourlyTrafficAggregates':
+        with np.load(path) as aggregates:
+            stations = pd.DataFrame({'id': aggregates['ids'].tolist(), 'name': aggregates['names'].tolist(),
+                                     'lat': aggregates['lat'], 'lon': aggregates['lon']})
+            return cls(stations, aggregates['counts'], {out: aggregates[f'sum_{out}'] for out in cls.OUTPUTS})
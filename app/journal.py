@@ -0,0 +1,156 @@
+import sqlite3
+from typing import List, Tuple
+
+import numpy as np
+
+
+class CrawlJournal:
+    """
+    Durable record of the stop-time crawl in a SQLite file. Every requested page (date, station, offset) is a row
+    that is `pending` until its response is counted (`done`) or the request fails (`failed`), so an interrupted
+    crawl can be resumed by requesting only the pages that are not done. The departures of a page may also be
+    recorded by hour, as 24 uint16 counts in a blob.
+    """
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')  # WAL keeps the journal consistent after a crash
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS pages ('
+            'date TEXT, station_id TEXT, offset INTEGER, chunk INTEGER, status TEXT, count INTEGER, error TEXT, '
+            'PRIMARY KEY (date, station_id, offset))'
+        )
+        columns = [row[1] for row in self._connection.execute('PRAGMA table_info(pages)')]
+        if 'hours' not in columns:  # ~ journal of a crawl from before the departures were recorded by hour
+            self._connection.execute('ALTER TABLE pages ADD COLUMN hours BLOB')
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def reset(self, date: str):
+        """
+        Forget all the pages of the selected date.
+        :param date: the selected date
+        """
+        with self._connection:
+            self._connection.execute('DELETE FROM pages WHERE date = ?', (date,))
+
+    def add_stations(self, date: str, chunk: int, station_ids: list):
+        """
+        Add the first page of each of the stations as pending, keeping the state of the pages already journaled.
+        :param date: the selected date
+        :param chunk: number of the chunk the stations belong to
+        :param station_ids: ids of the stations
+        """
+        with self._connection:
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO pages VALUES (?, ?, 0, ?, ?, NULL, NULL, NULL)',
+                ((date, station_id, chunk, self.PENDING) for station_id in station_ids)
+            )
+
+    def unfinished_pages(self, date: str, chunk: int) -> List[Tuple[str, int]]:
+        """
+        List the pending and failed pages of the selected chunk.
+        :param date: the selected date
+        :param chunk: number of the chunk
+        :return: list of (station_id, offset)
+        """
+        return self._connection.execute(
+            'SELECT station_id, offset FROM pages WHERE date = ? AND chunk = ? AND status != ?',
+            (date, chunk, self.DONE)
+        ).fetchall()
+
+    def mark_done(self, date: str, station_id: str, offset: int, count: int, next_offset: int = None,
+                  hours: np.ndarray = None):
+        """
+        Record the number of stop times on the page, and add the next page as pending if there is one.
+        :param date: the selected date
+        :param station_id: id of the station
+        :param offset: offset of the page
+        :param count: number of stop times on the page
+        :param next_offset: offset of the next page, None if this is the last page of the station
+        :param hours: optional number of the departures on the page in each of the 24 hours
+        """
+        hours = np.asarray(hours, dtype='<u2').tobytes() if hours is not None else None
+        with self._connection:
+            self._connection.execute(
+                'UPDATE pages SET status = ?, count = ?, hours = ?, error = NULL '
+                'WHERE date = ? AND station_id = ? AND offset = ?',
+                (self.DONE, count, hours, date, station_id, offset)
+            )
+            if next_offset is not None:
+                self._connection.execute(
+                    'INSERT OR IGNORE INTO pages SELECT date, station_id, ?, chunk, ?, NULL, NULL, NULL FROM pages '
+                    'WHERE date = ? AND station_id = ? AND offset = ?',
+                    (next_offset, self.PENDING, date, station_id, offset)
+                )
+
+    def mark_failed(self, date: str, station_id: str, offset: int, error: str):
+        """
+        Record that the request for the page failed.
+        :param date: the selected date
+        :param station_id: id of the station
+        :param offset: offset of the page
+        :param error: description of the failure
+        """
+        with self._connection:
+            self._connection.execute(
+                'UPDATE pages SET status = ?, error = ? WHERE date = ? AND station_id = ? AND offset = ?',
+                (self.FAILED, error, date, station_id, offset)
+            )
+
+    def count_failed(self, date: str, chunk: int) -> int:
+        return self._connection.execute(
+            'SELECT COUNT(*) FROM pages WHERE date = ? AND chunk = ? AND status = ?', (date, chunk, self.FAILED)
+        ).fetchone()[0]
+
+    def count_pages(self, date: str, station_id: str) -> int:
+        return self._connection.execute(
+            'SELECT COUNT(*) FROM pages WHERE date = ? AND station_id = ?', (date, station_id)
+        ).fetchone()[0]
+
+    def stop_counts(self, date: str, chunk: int) -> dict:
+        """
+        Sum the stop times of the done pages by station.
+        :param date: the selected date
+        :param chunk: number of the chunk
+        :return: dict in the format {station_id: stop_count}, only for stations with any stop times
+        """
+        return dict(self._connection.execute(
+            'SELECT station_id, SUM(count) FROM pages WHERE date = ? AND chunk = ? AND status = ? '
+            'GROUP BY station_id HAVING SUM(count) > 0',
+            (date, chunk, self.DONE)
+        ).fetchall())
+
+    def stop_hours(self, date: str, chunk: int) -> Tuple[list, np.ndarray]:
+        """
+        Sum the departures of the done pages by station and hour. Pages counted without the hours are left out.
+        :param date: the selected date
+        :param chunk: number of the chunk
+        :return: list of the station ids with any departures; and uint16 array of their departures of shape (number
+        of the stations, 24)
+        """
+        rows = self._connection.execute(
+            'SELECT station_id, hours FROM pages WHERE date = ? AND chunk = ? AND status = ? AND hours IS NOT NULL',
+            (date, chunk, self.DONE)
+        ).fetchall()
+        if not rows:
+            return [], np.zeros((0, 24), dtype=np.uint16)
+        station_ids, rows_of_pages = np.unique([station_id for station_id, _ in rows], return_inverse=True)
+        pages = np.frombuffer(b''.join(hours for _, hours in rows), dtype='<u2').reshape(-1, 24)
+        hours = np.zeros((len(station_ids), 24), dtype=np.int64)
+        np.add.at(hours, rows_of_pages, pages)
+        departing = hours.any(axis=1)
+        return station_ids[departing].tolist(), np.minimum(hours[departing], np.iinfo(np.uint16).max).astype(np.uint16)
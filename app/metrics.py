@@ -0,0 +1,288 @@
+import functools
+import json
+import math
+import threading
+import time
+import tracemalloc
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Optional
+
+from app.store import atomic_write
+
+try:
+    import resource
+except ImportError:  # ~ not available on Windows
+    resource = None
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., math.inf)
+PAGES_BUCKETS = (1, 2, 3, 5, 10, 20, 50, math.inf)
+
+
+class Histogram:
+    """
+    Histogram with fixed upper bounds of the buckets, as in Prometheus.
+    """
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list:
+        """
+        :return: list of the upper bounds of the buckets with the number of the values less than or equal to them
+        """
+        total, cumulative = 0, []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+    def to_dict(self) -> dict:
+        return {'count': self.count, 'sum': self.sum,
+                'buckets': {('+Inf' if math.isinf(bound) else bound): n for bound, n in self.cumulative()}}
+
+
+def _peak_rss() -> Optional[int]:
+    """
+    :return: peak resident memory of the process in bytes, None if unknown
+    """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # ~ kilobytes on Linux
+
+
+class Metrics:
+    """
+    Instrumentation of the pipeline, shared by `GolemioApiDownloader` (and its download engine) and `Traffic` through
+    their `metrics` attribute, which is None by default so that disabled instrumentation costs one attribute check.
+    Collects:
+    - wall time of each stage of the pipeline (stages may nest, e.g. aggregate within assign), how much the stage
+      raised the peak resident memory of the process, and optionally the peak memory allocated by Python in the stage,
+    - peak resident memory of the whole process,
+    - number of requests by status code, bytes, latency histogram and retries by endpoint,
+    - histogram of the number of pages per station of the crawl,
+    - progress of the crawl, printed with the ETA every `progress_interval` seconds.
+    The summary is saved as JSON into `json_path` and in the Prometheus text format into `prometheus_path` (e.g. for
+    the textfile collector of the node exporter) after every stage and progress report, if the paths are set.
+    """
+
+    def __init__(self, json_path: str = None, prometheus_path: str = None, progress_interval: float = 10.,
+                 trace_memory: bool = False):
+        """
+        :param json_path: path to save the JSON summary to
+        :param prometheus_path: path to save the Prometheus text format to
+        :param progress_interval: seconds between the progress reports of the crawl
+        :param trace_memory: measure the peak memory allocated by Python in each stage with `tracemalloc`, which
+        slows the pipeline down; the growth of the peak resident memory of the process is measured always
+        """
+        self.json_path = json_path
+        self.prometheus_path = prometheus_path
+        self.progress_interval = progress_interval
+        self.trace_memory = trace_memory and hasattr(tracemalloc, 'reset_peak')
+        self.stages = {}
+        self.requests = Counter()  # ~ by endpoint and status
+        self.response_bytes = Counter()
+        self.retries = Counter()
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.pages_per_station = Histogram(PAGES_BUCKETS)
+        self.progress = {}
+        self._stage_stack = []
+        self._lock = threading.Lock()  # ~ requests are recorded also from the threads prefetching pages
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Measure the wall time and memory of the stage of the pipeline. The peak resident memory is only known for the
+        whole process, so the stage records by how much it raised it: a stage running after a heavier one records 0.
+        :param name: name of the stage
+        """
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            if self._stage_stack:  # ~ keep the peak of the enclosing stage before resetting it
+                self._stage_stack[-1] = max(self._stage_stack[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self._stage_stack.append(0)
+        rss_start = _peak_rss()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            peak_traced = self._stage_stack.pop()
+            stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.})
+            stage['calls'] += 1
+            stage['seconds'] += seconds
+            if rss_start is not None:
+                stage['peak_rss_growth_bytes'] = max(stage.get('peak_rss_growth_bytes', 0), _peak_rss() - rss_start)
+            if self.trace_memory:
+                peak_traced = max(peak_traced, tracemalloc.get_traced_memory()[1])
+                stage['peak_traced_bytes'] = max(stage.get('peak_traced_bytes', 0), peak_traced)
+                if self._stage_stack:
+                    self._stage_stack[-1] = max(self._stage_stack[-1], peak_traced)
+            self.flush()
+
+    def record_request(self, endpoint: str, status: int, size: int, latency: float):
+        """
+        :param endpoint: the endpoint requested
+        :param status: status code of the response, 0 if the request failed without a response
+        :param size: bytes of the body of the response
+        :param latency: seconds from the request to the whole response
+        """
+        with self._lock:
+            self.requests[endpoint, status] += 1
+            self.response_bytes[endpoint] += size
+            self.latency[endpoint].observe(latency)
+
+    def record_retry(self, endpoint: str):
+        with self._lock:
+            self.retries[endpoint] += 1
+
+    def record_pages(self, pages: int):
+        """
+        :param pages: number of the pages of a station downloaded by the crawl
+        """
+        self.pages_per_station.observe(pages)
+
+    def start_progress(self, name: str, total: int):
+        """
+        Start tracking the progress of the work with known total amount, e.g. the stations of the crawl.
+        """
+        now = time.monotonic()
+        self.progress[name] = {'done': 0, 'total': total, 'started': now, 'reported': now}
+
+    def advance(self, name: str, done: int = 1):
+        progress = self.progress[name]
+        progress['done'] += done
+        now = time.monotonic()
+        if now - progress['reported'] >= self.progress_interval or progress['done'] == progress['total']:
+            progress['reported'] = now
+            print(self.format_progress(name))
+            self.flush()
+
+    def format_progress(self, name: str) -> str:
+        progress = self.progress[name]
+        done, total = progress['done'], progress['total']
+        elapsed = time.monotonic() - progress['started']
+        line = f'{name}: {done}/{total} ({done / total:.1%})' if total else f'{name}: {done}'
+        if done and total:
+            eta = elapsed / done * (total - done)
+            line += f', {done / elapsed:.1f}/s, ETA {time.strftime("%H:%M:%S", time.gmtime(eta))}'
+        return line
+
+    def summary(self) -> dict:
+        endpoints = sorted({endpoint for endpoint, _ in self.requests} | set(self.retries))
+        return {
+            'stages': self.stages,
+            'process_peak_rss_bytes': _peak_rss(),
+            'requests': {endpoint: {
+                'count': sum(n for (e, _), n in self.requests.items() if e == endpoint),
+                'statuses': {status: n for (e, status), n in sorted(self.requests.items()) if e == endpoint},
+                'bytes': self.response_bytes[endpoint],
+                'retries': self.retries[endpoint],
+                'latency_seconds': self.latency[endpoint].to_dict(),
+            } for endpoint in endpoints},
+            'pages_per_station': self.pages_per_station.to_dict(),
+            'progress': {name: {'done': p['done'], 'total': p['total'], 'seconds': time.monotonic() - p['started']}
+                         for name, p in self.progress.items()},
+        }
+
+    def to_prometheus(self) -> str:
+        """
+        :return: the metrics in the Prometheus text exposition format
+        """
+        lines = []
+
+        def metric(name: str, kind: str, description: str, samples: list):
+            lines.extend([f'# HELP pipeline_{name} {description}', f'# TYPE pipeline_{name} {kind}'])
+            for suffix, labels, value in samples:
+                labels = ','.join(f'{label}="{value}"' for label, value in labels.items())
+                lines.append(f'pipeline_{name}{suffix}{{{labels}}} {value}' if labels else
+                             f'pipeline_{name}{suffix} {value}')
+
+        def histogram(name: str, description: str, histograms: dict):
+            samples = []
+            for labels, h in histograms.items():
+                labels = dict(labels)
+                samples.extend(('_bucket', {**labels, 'le': '+Inf' if math.isinf(bound) else bound}, n)
+                               for bound, n in h.cumulative())
+                samples.extend([('_sum', labels, h.sum), ('_count', labels, h.count)])
+            metric(name, 'histogram', description, samples)
+
+        metric('stage_seconds_total', 'counter', 'Wall time spent in the stage.',
+               [('', {'stage': name}, stage['seconds']) for name, stage in self.stages.items()])
+        metric('stage_calls_total', 'counter', 'Runs of the stage.',
+               [('', {'stage': name}, stage['calls']) for name, stage in self.stages.items()])
+        metric('stage_peak_rss_growth_bytes', 'gauge',
+               'Growth of the peak resident memory of the process during the stage (largest of its runs).',
+               [('', {'stage': name}, stage['peak_rss_growth_bytes']) for name, stage in self.stages.items()
+                if 'peak_rss_growth_bytes' in stage])
+        if _peak_rss() is not None:
+            metric('process_peak_rss_bytes', 'gauge', 'Peak resident memory of the process.', [('', {}, _peak_rss())])
+        if self.trace_memory:
+            metric('stage_peak_traced_bytes', 'gauge', 'Peak memory allocated by Python during the stage.',
+                   [('', {'stage': name}, stage['peak_traced_bytes']) for name, stage in self.stages.items()])
+        metric('requests_total', 'counter', 'Requests by endpoint and status code (0 without response).',
+               [('', {'endpoint': endpoint, 'status': status}, n)
+                for (endpoint, status), n in sorted(self.requests.items())])
+        metric('response_bytes_total', 'counter', 'Bytes of the bodies of the responses.',
+               [('', {'endpoint': endpoint}, n) for endpoint, n in sorted(self.response_bytes.items())])
+        metric('retries_total', 'counter', 'Retried requests.',
+               [('', {'endpoint': endpoint}, n) for endpoint, n in sorted(self.retries.items())])
+        histogram('request_latency_seconds', 'Latency of the requests.',
+                  {(('endpoint', endpoint),): h for endpoint, h in sorted(self.latency.items())})
+        histogram('pages_per_station', 'Pages of stop times downloaded per station.',
+                  {(): self.pages_per_station})
+        metric('progress_done', 'gauge', 'Amount of the work done.',
+               [('', {'task': name}, p['done']) for name, p in self.progress.items()])
+        metric('progress_total', 'gauge', 'Total amount of the work.',
+               [('', {'task': name}, p['total']) for name, p in self.progress.items()])
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _write(path: str, text: str):
+        with atomic_write(path) as output_f:  # ~ collectors never read a half written file
+            output_f.write(text)
+
+    def flush(self):
+        """
+        Save the metrics into the files set by `json_path` and `prometheus_path`.
+        """
+        if self.json_path:
+            self._write(self.json_path, json.dumps(self.summary(), indent=2))
+        if self.prometheus_path:
+            self._write(self.prometheus_path, self.to_prometheus())
+
+
+def stage(metrics: Optional[Metrics], name: str):
+    """
+    :param metrics: the metrics, None if disabled
+    :param name: name of the stage
+    :return: context manager measuring the stage, doing nothing if the metrics are disabled
+    """
+    return metrics.stage(name) if metrics is not None else nullcontext()
+
+
+def staged(name: str):
+    """
+    Decorator measuring the method as the stage of the pipeline, if the `metrics` attribute of its instance is set.
+    :param name: name of the stage
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.metrics is None:
+                return method(self, *args, **kwargs)
+            with self.metrics.stage(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,69 @@
+import re
+from typing import Tuple
+
+import numpy as np
+
+_STRING = re.compile(rb'"(?:[^"\\]|\\.)*"', re.DOTALL)
+_NOT_QUOTES_OR_BRACKETS = bytes(b for b in range(256) if b not in b'"\\{}[]')
+_NOT_BRACKETS = bytes(b for b in range(256) if b not in b'{}[]')
+
+
+def _structure(body: bytes) -> bytes:
+    """
+    Reduce the JSON body to its brackets outside of strings.
+    """
+    reduced = body.translate(None, _NOT_QUOTES_OR_BRACKETS)
+    if b'\\' not in reduced:
+        # ~ without escapes the quotes alternate, and a string without brackets is reduced to an adjacent pair
+        structure = reduced.replace(b'""', b'')
+        if b'"' not in structure:
+            return structure
+    # ~ some strings contain brackets or escaped characters, skip the strings properly
+    structure = _STRING.sub(b'', body)
+    if b'"' in structure:
+        raise ValueError('Unterminated string in the response body')
+    return structure.translate(None, _NOT_BRACKETS)
+
+
+def count_array_items(body: bytes) -> int:
+    """
+    Count the objects of the top-level JSON array in the body without building them, as a count-only replacement of
+    `len(json.loads(body))` for the responses of Golemio API, which are arrays of objects (scalar elements are not
+    counted). Only the brackets outside of strings are kept, using C-level bytes operations, so that the common
+    case of an array of flat objects is recognized without walking the body in Python. The body is not validated
+    beyond its brackets.
+    :param body: raw body of the response
+    :return: number of the objects in the array
+    """
+    structure = _structure(body)
+    if structure[:1] != b'[' or structure[-1:] != b']':
+        raise ValueError('The response body is not a JSON array')
+    items = structure[1:-1]
+    n = len(items) // 2
+    if items == b'{}' * n:  # ~ fast path for an array of flat objects
+        return n
+    depth = count = 0
+    for character in items:
+        if character in b'{[':
+            if depth == 0:
+                count += 1
+            depth += 1
+        else:
+            depth -= 1
+    return count
+
+
+_DEPARTURE_HOUR = re.compile(rb'"departure_time"\s*:\s*"(\d+):')
+
+
+def count_departures_by_hour(body: bytes) -> Tuple[int, np.ndarray]:
+    """
+    Count the stop times in the body as `count_array_items`, and bucket their departures into the hours of the day
+    by the hour of their `departure_time` (e.g. "07:45:00"), found with one regular expression over the raw body
+    instead of parsing the objects. Departures after midnight of the next day (e.g. "25:10:00") fall into the early
+    hours. Stop times without a departure time are counted, but not bucketed.
+    :param body: raw body of the response
+    :return: number of the stop times; and array of the number of the departures in each of the 24 hours
+    """
+    hours = np.fromiter(map(int, _DEPARTURE_HOUR.findall(body)), dtype=np.int64)
+    return count_array_items(body), np.bincount(hours % 24, minlength=24).astype(np.uint16)
@@ -0,0 +1,278 @@
+import glob
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional, Sequence, Union
+
+from app.store import atomic_write
+
+if TYPE_CHECKING:  # ~ the steps of the downloader do not import pandas of the Traffic
+    from app.downloader import GolemioApiDownloader
+    from app.traffic import Traffic
+
+Paths = Union[Sequence[str], Callable[[Optional[str]], Sequence[str]]]
+
+
+class Step:
+    """
+    Step of the `Pipeline`, declaring the files it reads and writes. The paths may be glob patterns (e.g. all the stop
+    count files of a date). A step may be split into partitions (e.g. dates), each with its own inputs, outputs and
+    recorded state, so that only the partitions whose inputs changed are run again, all in one call.
+    """
+
+    def __init__(self, name: str, run: Callable, inputs: Paths = (), outputs: Paths = (), params: dict = None,
+                 partitions: Sequence[str] = None, after: Iterable[str] = (), volatile: bool = False):
+        """
+        :param name: unique name of the step
+        :param run: function running the step, called without arguments, or with the list of the partitions to run
+        if the step is partitioned
+        :param inputs: paths to the files read by the step, or function of the partition returning them
+        :param outputs: paths to the files written by the step, or function of the partition returning them
+        :param params: parameters of the step (JSON serializable), the step runs again when they change
+        :param partitions: keys of the partitions (e.g. dates), None if the step is not partitioned
+        :param after: names of the steps to wait for, typically the steps writing the inputs of this one
+        :param volatile: bool whether the outputs depend on more than the inputs (e.g. on the API), so that the step
+        runs every time; the steps after it still run only if the content of its outputs changed
+        """
+        self.name = name
+        self.run = run
+        self.inputs = inputs
+        self.outputs = outputs
+        self.params = params or {}
+        self.partitions = partitions
+        self.after = list(after)
+        self.volatile = volatile
+
+    def paths(self, paths: Paths, partition: Optional[str]) -> list:
+        return list(paths(partition) if callable(paths) else paths)
+
+
+class Pipeline:
+    """
+    Runner of the steps of `GolemioApiDownloader` and `Traffic` which runs a step only if the content of its inputs,
+    its parameters or its outputs changed since it last ran. The content hashes (SHA-256) of the inputs and outputs
+    of each step (and partition) are recorded in the JSON state file; a file is hashed again only when its
+    modification time or size changes. Steps that do not wait for each other (e.g. the Golemio and Traffic branches)
+    run concurrently in `workers` threads.
+    """
+
+    def __init__(self, steps: Iterable[Step], state_path: str = 'data/pipeline_state.json', workers: int = 2):
+        """
+        :param steps: the steps, in any order
+        :param state_path: path to the JSON file recording the state of the steps between the runs
+        :param workers: number of the steps run at once
+        """
+        self.steps = {step.name: step for step in steps}
+        self.state_path = state_path
+        self.workers = workers
+        for step in self.steps.values():
+            unknown = [name for name in step.after if name not in self.steps]
+            if unknown:
+                raise ValueError(f'Step {step.name} waits for unknown steps: {unknown}')
+        cycle = self._find_cycle()
+        if cycle:
+            raise ValueError(f'Steps wait for each other in a cycle: {" -> ".join(cycle)}')
+        self._lock = threading.Lock()  # ~ guards the state shared by the threads running the steps
+        self.state = self._load_state()
+
+    def _find_cycle(self) -> Optional[List[str]]:
+        """
+        :return: names of the steps waiting for each other in a cycle (the first one repeated at the end), None if the
+        steps have no cycle
+        """
+        done, path = set(), []
+        on_path = {}  # ~ position of each step on the current path
+
+        def visit(name: str) -> Optional[List[str]]:
+            on_path[name] = len(path)
+            path.append(name)
+            for dependency in self.steps[name].after:
+                if dependency in on_path:
+                    return path[on_path[dependency]:] + [dependency]
+                if dependency not in done:
+                    cycle = visit(dependency)
+                    if cycle:
+                        return cycle
+            del on_path[path.pop()]
+            done.add(name)
+            return None
+
+        for name in self.steps:
+            if name not in done:
+                cycle = visit(name)
+                if cycle:
+                    return cycle
+        return None
+
+    def _load_state(self) -> dict:
+        if not os.path.exists(self.state_path):
+            return {'files': {}, 'steps': {}}
+        with open(self.state_path, encoding='utf8') as input_f:
+            return json.load(input_f)
+
+    def _save_state(self):
+        with atomic_write(self.state_path) as output_f:  # ~ an interrupted run leaves the previous state
+            json.dump(self.state, output_f, indent=1)
+
+    def _file_hash(self, path: str) -> str:
+        """
+        :param path: path to the file
+        :return: SHA-256 of the content of the file, reused from the state if its modification time and size match
+        """
+        stat = os.stat(path)
+        with self._lock:
+            known = self.state['files'].get(path)
+        if known is not None and known[:2] == [stat.st_mtime_ns, stat.st_size]:
+            return known[2]
+        sha = hashlib.sha256()
+        with open(path, 'rb') as input_f:
+            for block in iter(lambda: input_f.read(1 << 20), b''):
+                sha.update(block)
+        with self._lock:
+            self.state['files'][path] = [stat.st_mtime_ns, stat.st_size, sha.hexdigest()]
+        return sha.hexdigest()
+
+    def _hashes(self, patterns: list) -> Optional[dict]:
+        """
+        :param patterns: paths or glob patterns
+        :return: dict of the content hashes of the files by path, None if any of the patterns matches no file
+        """
+        hashes = {}
+        for pattern in patterns:
+            paths = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+            paths = [path for path in paths if os.path.isfile(path)]
+            if not paths:
+                return None
+            hashes.update((path, self._file_hash(path)) for path in paths)
+        return hashes
+
+    def _is_stale(self, step: Step, partition: Optional[str], force: bool) -> bool:
+        with self._lock:
+            recorded = self.state['steps'].get(step.name, {}).get(str(partition))
+        if force or step.volatile or recorded is None or recorded['params'] != step.params:
+            return True
+        return self._hashes(step.paths(step.inputs, partition)) != recorded['inputs'] or \
+            self._hashes(step.paths(step.outputs, partition)) != recorded['outputs']
+
+    def _run_step(self, step: Step, force: bool) -> bool:
+        """
+        Run the stale partitions of the step and record their state.
+        :return: bool whether the step ran
+        """
+        partitions = step.partitions if step.partitions is not None else [None]
+        stale = [partition for partition in partitions if self._is_stale(step, partition, force)]
+        if not stale:
+            return False
+        inputs = {partition: self._hashes(step.paths(step.inputs, partition)) for partition in stale}
+        step.run(stale) if step.partitions is not None else step.run()
+        with self._lock:
+            recorded = self.state['steps'].setdefault(step.name, {})
+        for partition in stale:
+            outputs = self._hashes(step.paths(step.outputs, partition))
+            with self._lock:
+                recorded[str(partition)] = {'params': step.params, 'inputs': inputs[partition], 'outputs': outputs}
+        with self._lock:
+            self._save_state()
+        return True
+
+    def run(self, targets: Iterable[str] = None, force: bool = False) -> Dict[str, str]:
+        """
+        Run the steps in the order given by their `after`, each as soon as the steps it waits for are done, skipping
+        the steps which are up to date. A failed step does not stop the steps which do not wait for it; the first
+        error is raised when they are done.
+        :param targets: names of the steps to run (with all the steps they wait for), all the steps by default
+        :param force: set to True to run the steps even if they are up to date
+        :return: dict of the outcome of each step, 'ran', 'skipped', 'failed' or 'blocked' (waiting for a failed step)
+        """
+        selected = set()
+        pending = list(targets) if targets is not None else list(self.steps)
+        while pending:
+            name = pending.pop()
+            if name not in selected:
+                selected.add(name)
+                pending.extend(self.steps[name].after)
+        outcomes, errors, running = {}, [], {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while len(outcomes) < len(selected):
+                for name in sorted(selected - set(outcomes) - set(running.values())):
+                    after = [outcomes.get(dependency) for dependency in self.steps[name].after]
+                    if any(outcome in ('failed', 'blocked') for outcome in after):
+                        outcomes[name] = 'blocked'
+                    elif all(outcome is not None for outcome in after):
+                        running[executor.submit(self._run_step, self.steps[name], force)] = name
+                if not running:
+                    continue  # ~ only blocked steps were left
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        outcomes[name] = 'ran' if future.result() else 'skipped'
+                    except Exception as e:
+                        print(f'Step {name} failed: {e!r}')
+                        outcomes[name] = 'failed'
+                        errors.append(e)
+                    print(f'{name}: {outcomes[name]}')
+        if errors:
+            raise errors[0]
+        return outcomes
+
+
+def golemio_steps(golemio: 'GolemioApiDownloader', dates: List[str]) -> List[Step]:
+    """
+    Steps 1 to 4 of the GolemioApiDonwloader. The stations are downloaded on every run (mostly from the HTTP cache),
+    while the stop times are downloaded and assigned only for the dates which were not done yet or whose stations
+    changed.
+    :param golemio: the downloader
+    :param dates: the selected dates
+    """
+    store = golemio._stop_count_store()
+
+    def stop_count_files(date: str) -> list:
+        return [f'{glob.escape(golemio.all_stop_count_path)}_{date}_*.json']
+
+    def assign(dates_to_assign: list):
+        initial = not store.exists() and not os.path.exists(golemio.parent_ids_with_count_path)
+        golemio.assign_stop_counts(dates_to_assign, initial=initial)
+
+    return [
+        Step('download', golemio.download_all_stations, outputs=[golemio.all_stations_stream_path], volatile=True),
+        Step('filter', golemio.filter_station_ids_enriched, inputs=[golemio.all_stations_stream_path],
+             outputs=[golemio.all_stations_ids_path, golemio.station_index_path], after=['download']),
+        Step('crawl', lambda dates_to_crawl: golemio.count_stop_times_for_dates(dates_to_crawl, assign=False),
+             inputs=[golemio.all_stations_ids_path], outputs=stop_count_files, partitions=dates, after=['filter']),
+        Step('assign', assign, inputs=lambda date: [golemio.station_index_path] + stop_count_files(date),
+             outputs=lambda date: store.files([date])[-1:],  # ~ only the column of the date
+             partitions=dates, after=['crawl']),
+    ]
+
+
+def traffic_steps(traffic: 'Traffic') -> List[Step]:
+    """
+    Steps 1 to 4 of the Traffic.
+    :param traffic: the traffic
+    """
+    return [
+        Step('traffic_download', traffic.download_data, outputs=[traffic.traffic_csv_path, traffic.stops_json_path],
+             volatile=True),
+        Step('process_traffic', traffic.process_traffic, inputs=[traffic.traffic_csv_path],
+             outputs=[traffic.traffic_out_path], after=['traffic_download']),
+        Step('process_stops', traffic.process_stops, inputs=[traffic.stops_json_path],
+             outputs=[traffic.stops_out_path], after=['traffic_download']),
+        Step('merge_panda', traffic.merge_panda, inputs=[traffic.traffic_out_path, traffic.stops_out_path],
+             outputs=[traffic.final_output_path, traffic.hourly_output_path],
+             after=['process_traffic', 'process_stops']),
+    ]
+
+
+if __name__ == '__main__':
+    from app.downloader import GolemioApiDownloader
+    from app.traffic import Traffic
+
+    my_api_key_path = 'golemio_api_key.json'  # path to your Golemio API key
+    my_dates = ['2020-01-02']
+    pipeline = Pipeline(golemio_steps(GolemioApiDownloader(my_api_key_path), my_dates) + traffic_steps(Traffic()))
+    pipeline.run()
+    # pipeline.run(targets=['assign'])
+    # pipeline.run(force=True)
@@ -0,0 +1,143 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+from app.registry import StationRegistry
+from app.spatial import StationGrid
+from app.store import StopCountStore
+
+
+class StopCountQueries:
+    """
+    Queries over the stop counts of all the collected dates, answered from indexes built once from a
+    `StationRegistry` instead of scanning the stations:
+    - time series of a station, through the id -> row lookup of the registry,
+    - top-k stations for a date (from the stations sorted by their stop counts for each date) or a range of dates
+      (from the prefix sums of the stop counts over the dates),
+    - stations within a bounding box or a radius, through the `StationGrid` spatial index,
+    - day-over-day deltas of the stop counts, precomputed for all the dates.
+    The dates are sorted, a date range includes both its ends.
+    """
+
+    def __init__(self, registry: StationRegistry, cell_degrees: float = 0.01):
+        """
+        :param registry: the stations with their stop counts
+        :param cell_degrees: size of a cell of the spatial index
+        """
+        self.registry = registry
+        self.dates = sorted(registry.dates)
+        # ~ stop counts of the parent stations (rows) by date (columns), with the dates in order
+        self.history = registry.counts_frame()[self.dates]
+        self.counts = self.history.to_numpy()
+        self._date_columns = {date: i for i, date in enumerate(self.dates)}
+        self._prefix_sums = np.concatenate([np.zeros((len(self.counts), 1), dtype=np.int64),
+                                            np.cumsum(self.counts, axis=1, dtype=np.int64)], axis=1)
+        # ~ stations from the largest stop count for each date, stable so that ties keep the order of the stations
+        self._ranking = np.argsort(-self.counts.T.astype(np.int64), axis=1, kind='stable').astype(np.int32)
+        self.deltas = np.diff(self.counts.astype(np.int64), axis=1)  # ~ of each date from the previous one
+        self.grid = StationGrid(registry.latitude, registry.longitude, cell_degrees)
+        registry.rows_of([])  # ~ build the id -> row lookup now, not on the first query
+
+    @classmethod
+    def from_store(cls, store_path: str = 'data/stop_count_store') -> 'StopCountQueries':
+        return cls(StationRegistry.from_store(StopCountStore(store_path)))
+
+    @classmethod
+    def from_json(cls, data_path: str = 'data/final-stations_with_count.json') -> 'StopCountQueries':
+        with open(data_path, encoding='utf-8') as data:
+            return cls(StationRegistry.from_json(json.load(data)))
+
+    def _column(self, date: str) -> int:
+        if date not in self._date_columns:
+            raise KeyError(f'No stop counts for {date}')
+        return self._date_columns[date]
+
+    def _stations(self, rows: np.ndarray, **columns) -> pd.DataFrame:
+        """
+        :return: Pandas dataframe with the id, name and location of the parent stations of the rows, and the columns
+        """
+        registry = self.registry
+        return pd.DataFrame({
+            'id': registry.stop_ids[rows],
+            'name': registry.distinct_names[registry.name_codes[rows]],
+            'latitude': registry.latitude[rows],
+            'longitude': registry.longitude[rows],
+            **columns,
+        })
+
+    def time_series(self, station_id: str) -> pd.Series:
+        """
+        :param station_id: id of the parent station, or of any of its child stations
+        :return: Pandas series of the stop counts of the parent station indexed by the dates
+        """
+        return self.history.iloc[self.registry.parent_rows[self.registry.index_of(station_id)]]
+
+    def range_counts(self, start_date: str, end_date: str = None) -> np.ndarray:
+        """
+        :param start_date: the first date of the range
+        :param end_date: the last date of the range, the start date by default
+        :return: sums of the stop counts of all the parent stations over the dates of the range
+        """
+        end = self._column(end_date if end_date is not None else start_date) + 1
+        return self._prefix_sums[:, end] - self._prefix_sums[:, self._column(start_date)]
+
+    def top_k(self, k: int, start_date: str, end_date: str = None) -> pd.DataFrame:
+        """
+        :param k: number of the stations
+        :param start_date: the selected date, or the first date of the range
+        :param end_date: optional last date of the range
+        :return: Pandas dataframe of the k stations with the most stop counts (summed over the range), from the most
+        """
+        if end_date is None or end_date == start_date:
+            rows = self._ranking[self._column(start_date), :k]
+            return self._stations(rows, stop_count=self.counts[rows, self._column(start_date)])
+        counts = self.range_counts(start_date, end_date)
+        k = min(k, len(counts))
+        rows = np.argpartition(-counts, k - 1)[:k] if k else np.zeros(0, dtype=np.int64)
+        rows = rows[np.lexsort((rows, -counts[rows]))]  # ~ ties in the order of the stations, as for one date
+        return self._stations(rows, stop_count=counts[rows])
+
+    def within_bbox(self, bbox: tuple, date: str = None) -> pd.DataFrame:
+        """
+        :param bbox: bounding box (min lon, min lat, max lon, max lat)
+        :param date: optional date of the stop counts to include
+        :return: Pandas dataframe of the parent stations inside the bounding box
+        """
+        rows = np.sort(self.grid.within_bbox(bbox))
+        columns = {'stop_count': self.counts[rows, self._column(date)]} if date is not None else {}
+        return self._stations(rows, **columns)
+
+    def within_radius(self, latitude: float, longitude: float, radius: float, date: str = None) -> pd.DataFrame:
+        """
+        :param latitude: latitude of the center
+        :param longitude: longitude of the center
+        :param radius: radius in meters
+        :param date: optional date of the stop counts to include
+        :return: Pandas dataframe of the parent stations within the radius with their distance in meters, from the
+        nearest
+        """
+        rows, distances = self.grid.within_radius(latitude, longitude, radius)
+        columns = {'stop_count': self.counts[rows, self._column(date)]} if date is not None else {}
+        return self._stations(rows, distance=distances, **columns)
+
+    def day_over_day(self, date: str, k: int = None) -> pd.DataFrame:
+        """
+        :param date: the selected date, compared with the previous collected date
+        :param k: optional number of the stations with the largest changes (in absolute value) to return, from the
+        largest, all the stations in their order by default
+        :return: Pandas dataframe of the stations with their stop counts for the date and the previous date, and the
+        delta
+        """
+        column = self._column(date)
+        if column == 0:
+            raise KeyError(f'No stop counts before {date}')
+        deltas = self.deltas[:, column - 1]
+        if k is None:
+            rows = np.arange(len(deltas))
+        else:
+            k = min(k, len(deltas))
+            rows = np.argpartition(-np.abs(deltas), k - 1)[:k] if k else np.zeros(0, dtype=np.int64)
+            rows = rows[np.lexsort((rows, -np.abs(deltas[rows])))]
+        return self._stations(rows, previous=self.counts[rows, column - 1], stop_count=self.counts[rows, column],
+                              delta=deltas[rows])
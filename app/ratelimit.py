@@ -0,0 +1,98 @@
+import asyncio
+import random
+import threading
+import time
+from collections import Counter
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+
+class TokenBucket:
+    """
+    Token bucket limiting the rate of requests to `rate` per second, allowing bursts of up to `capacity` requests.
+    Shared by synchronous and asynchronous callers: a request reserves its token under a lock and then waits, with
+    `time.sleep` or `asyncio.sleep` respectively, until the token becomes available.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1., rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """
+        Take one token, possibly going into debt.
+        :return: seconds to wait until the taken token is covered
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(0., -self._tokens / self.rate)
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = self._reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Parse the `Retry-After` header, given either in seconds or as an HTTP date.
+    :param value: value of the header
+    :return: seconds to wait, None if the header is missing or invalid
+    """
+    if not value:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0., parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter for rate limited (429) and failed (5xx) requests, honouring `Retry-After`.
+    Counts the retries by endpoint in `retries`.
+    """
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, max_retries: int = 5, base_delay: float = 1., max_delay: float = 60.):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = Counter()
+
+    def should_retry(self, status: int, attempt: int) -> bool:
+        """
+        :param status: status code of the response, 0 if the request failed without a response
+        :param attempt: number of retries already made
+        :return: bool whether to retry the request
+        """
+        return attempt < self.max_retries and (status == 0 or status in self.RETRY_STATUSES)
+
+    def delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """
+        :param attempt: number of retries already made
+        :param retry_after: value of the `Retry-After` header of the response, if any
+        :return: seconds to wait before the next retry
+        """
+        seconds = parse_retry_after(retry_after)
+        if seconds is not None:
+            return min(seconds, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def record_retry(self, endpoint: str):
+        self.retries[endpoint] += 1
@@ -0,0 +1,179 @@
+from typing import TYPE_CHECKING, List, Sequence
+
+import numpy as np
+
+from app.store import StationIndex, StopCountStore, save_npz
+
+if TYPE_CHECKING:  # ~ pandas is imported only by the conversions to dataframes, not by the steps of the downloader
+    import pandas as pd
+
+
+class StationRegistry(StationIndex):
+    """
+    Compact model of the stations, replacing the nested dicts of `all_stations_ids.json` and
+    `final-stations_with_count.json` with typed arrays. The stop ids are interned to dense integer rows as in
+    `StationIndex` (the parent stations first, each stop pointing to the row of its parent station in `parent_rows`),
+    and the parent stations have:
+    - `names` (each distinct name is held once, as many stops share it), `latitude` and `longitude` (NaN for
+      stations without location) in the order of their rows,
+    - their child stations as CSR index arrays: the rows of the children of the parent station p are
+      `children[child_offsets[p]:child_offsets[p + 1]]`,
+    - the stop counts as an int32 array of shape (number of the parent stations, number of the `dates`).
+    Saved as `.npz` which also loads as `StationIndex`, so it can replace `station_index.npz`.
+    """
+
+    def __init__(self, stop_ids: np.ndarray, parent_rows: np.ndarray, n_parents: int, names: np.ndarray,
+                 latitude: np.ndarray, longitude: np.ndarray, dates: Sequence[str] = (), counts: np.ndarray = None):
+        super().__init__(stop_ids, parent_rows, n_parents)
+        self.distinct_names, self.name_codes = np.unique(np.asarray(names, dtype=str), return_inverse=True)
+        self.name_codes = self.name_codes.astype(np.int32).reshape(-1)
+        self.latitude = latitude
+        self.longitude = longitude
+        self.dates = list(dates)
+        self.counts = counts if counts is not None else np.zeros((n_parents, 0), dtype=np.int32)
+        self._date_columns = {date: i for i, date in enumerate(self.dates)}
+        # ~ children are grouped by their parent station, in the order they were added
+        self.children = (np.argsort(parent_rows[n_parents:], kind='stable') + n_parents).astype(np.int32)
+        self.child_offsets = np.concatenate([[0], np.cumsum(np.bincount(parent_rows[n_parents:],
+                                                                         minlength=n_parents))]).astype(np.int64)
+
+    @staticmethod
+    def _locations(locations: list) -> tuple:
+        latitude = np.array([(location or {}).get('lat', np.nan) for location in locations], dtype=np.float64)
+        longitude = np.array([(location or {}).get('lon', np.nan) for location in locations], dtype=np.float64)
+        return latitude, longitude
+
+    @classmethod
+    def from_ids(cls, all_ids: dict) -> 'StationRegistry':
+        """
+        :param all_ids: all parent stations with their name, location and children as in the `all_stations_ids.json`
+        """
+        index = StationIndex.from_ids(all_ids)
+        latitude, longitude = cls._locations([properties['location'] for properties in all_ids.values()])
+        names = np.array([properties['name'] for properties in all_ids.values()], dtype=str)
+        return cls(index.stop_ids, index.parent_rows, index.n_parents, names, latitude, longitude)
+
+    @classmethod
+    def from_json(cls, parent_ids_count: dict) -> 'StationRegistry':
+        """
+        :param parent_ids_count: dict of parent stations with their name, location and stop counts by date as in the
+        `final-stations_with_count.json`
+        """
+        n = len(parent_ids_count)
+        dates = list(next(iter(parent_ids_count.values()))['count']) if parent_ids_count else []
+        counts = np.array([[properties['count'].get(date, 0) for date in dates]
+                           for properties in parent_ids_count.values()], dtype=np.int32).reshape(n, len(dates))
+        latitude, longitude = cls._locations([properties['location'] for properties in parent_ids_count.values()])
+        return cls(np.array(list(parent_ids_count), dtype=str), np.arange(n, dtype=np.int32), n,
+                   np.array([properties['name'] for properties in parent_ids_count.values()], dtype=str),
+                   latitude, longitude, dates, counts)
+
+    @classmethod
+    def from_store(cls, store: StopCountStore, dates: Sequence[str] = None) -> 'StationRegistry':
+        """
+        :param store: the columnar store of the stop counts
+        :param dates: the dates of the stop counts to read, all the stored dates by default
+        """
+        dates = store.dates() if dates is None else list(dates)
+        n = len(store.index['ids'])
+        counts = np.empty((n, len(dates)), dtype=np.int32)
+        for i, date in enumerate(dates):
+            counts[:, i] = store.read_column(date)
+        latitude, longitude = store.read_locations()
+        return cls(np.array(store.index['ids'], dtype=str), np.arange(n, dtype=np.int32), n,
+                   np.array(store.index['names'], dtype=str), np.asarray(latitude), np.asarray(longitude), dates,
+                   counts)
+
+    def save(self, path: str):
+        save_npz(path, stop_ids=self.stop_ids, parent_rows=self.parent_rows, n_parents=self.n_parents,
+                 names=self.names, latitude=self.latitude, longitude=self.longitude,
+                 dates=np.array(self.dates, dtype=str), counts=self.counts)
+
+    @classmethod
+    def load(cls, path: str) -> 'StationRegistry':
+        with np.load(path) as registry:
+            if 'names' not in registry:
+                raise ValueError(f'{path} is a StationIndex without the names and locations of the stations')
+            return cls(registry['stop_ids'], registry['parent_rows'], int(registry['n_parents']), registry['names'],
+                       registry['latitude'], registry['longitude'], registry['dates'].tolist(), registry['counts'])
+
+    @property
+    def names(self) -> np.ndarray:
+        """
+        :return: names of the parent stations in the order of their rows
+        """
+        return self.distinct_names[self.name_codes]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in (self.stop_ids, self.parent_rows, self.distinct_names, self.name_codes,
+                                              self.latitude, self.longitude, self.counts, self.children,
+                                              self.child_offsets))
+
+    def index_of(self, station_id: str) -> int:
+        """
+        :param station_id: id of any stop
+        :return: row of the stop
+        """
+        row = int(self.rows_of([station_id])[0])
+        if row < 0:
+            raise KeyError(station_id)
+        return row
+
+    def children_of(self, station_id: str) -> List[str]:
+        """
+        :param station_id: id of the parent station
+        :return: ids of its child stations, in the order of `all_stations_ids.json`; none for a child station
+        """
+        row = self.index_of(station_id)
+        if row >= self.n_parents:
+            return []
+        return self.stop_ids[self.children[self.child_offsets[row]:self.child_offsets[row + 1]]].tolist()
+
+    def parent_of(self, station_id: str) -> str:
+        return str(self.stop_ids[self.parent_rows[self.index_of(station_id)]])
+
+    def aggregate(self, stop_counts: dict) -> np.ndarray:
+        """
+        Sum the stop counts of the stops to their parent stations.
+        :param stop_counts: dict in the format {stop_id: stop_count}, stops missing in the registry are left out
+        :return: int64 array of the stop counts of the parent stations in the order of their rows
+        """
+        rows = self.rows_of(stop_counts.keys())
+        counts = np.fromiter(stop_counts.values(), dtype=np.int64, count=len(stop_counts))
+        known = rows >= 0
+        return np.bincount(self.parent_rows[rows[known]], weights=counts[known],
+                           minlength=self.n_parents).astype(np.int64)
+
+    def column(self, date: str) -> np.ndarray:
+        """
+        :param date: the selected date from `dates`
+        :return: view of the stop counts of the parent stations for the date
+        """
+        return self.counts[:, self._date_columns[date]]
+
+    def to_frame(self, date: str = None, with_location: bool = True) -> 'pd.DataFrame':
+        """
+        :param date: the selected date, to include its stop counts as the column `stop_count`
+        :param with_location: bool whether to leave out the stations without location
+        :return: Pandas dataframe with the id, name, latitude and longitude of the parent stations, indexed by row
+        """
+        import pandas as pd
+        df = pd.DataFrame({
+            'id': self.stop_ids[:self.n_parents],
+            'name': self.names,
+            'latitude': self.latitude,
+            'longitude': self.longitude,
+        })
+        if date is not None:
+            df['stop_count'] = self.column(date)
+        return df[df['latitude'].notna()] if with_location else df
+
+    def counts_frame(self) -> 'pd.DataFrame':
+        """
+        :return: Pandas dataframe of the stop counts with the parent stations as rows and the dates as columns, backed
+        by the `counts` array without copying it
+        """
+        import pandas as pd
+        return pd.DataFrame(self.counts, index=pd.Index(self.stop_ids[:self.n_parents], name='id'),
+                            columns=self.dates, copy=False)
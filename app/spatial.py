@@ -0,0 +1,191 @@
+import numpy as np
+import pandas as pd
+
+_MAX_LATITUDE = 85.05112878  # ~ the Web Mercator projection of the maps is cut off here
+
+
+def _spread_bits(values: np.ndarray) -> np.ndarray:
+    """
+    Spread the lower 32 bits of the integers apart, to every other bit.
+    """
+    values = values.astype(np.uint64) & np.uint64(0xFFFFFFFF)
+    for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333), (1, 0x5555555555555555)):
+        values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+    return values
+
+
+class GridPyramid:
+    """
+    Pyramid of square grid cells of the Web Mercator projection (as the tiles of the maps), binning the stations at
+    all the levels from 0 (one cell for the whole world) to `max_level` (4^max_level cells). The cells of the
+    stations are computed once as Z-order codes at the finest level, so sorting the stations by the code groups them
+    by their cell at every level at once, and the values of the stations (e.g. the stop counts of a date) are
+    aggregated into the cells of any level in O(n) without sorting again.
+    The level for a map is selected by its zoom, so that a cell is about `cell_pixels` wide on the screen, and the
+    number of the plotted cells is bounded by the size of the screen instead of the number of the stations.
+    """
+
+    def __init__(self, latitude, longitude, names=None, max_level: int = 20, cell_pixels: float = 16.):
+        """
+        :param latitude: latitudes of the stations, stations with NaN are left out
+        :param longitude: longitudes of the stations
+        :param names: names of the stations, used to describe the cells
+        :param max_level: finest level of the pyramid, at most 31
+        :param cell_pixels: width of a cell on the screen
+        """
+        latitude = np.asarray(latitude, dtype=np.float64)
+        longitude = np.asarray(longitude, dtype=np.float64)
+        self.max_level = max_level
+        self.cell_pixels = cell_pixels
+        self.names = np.asarray(names if names is not None else [''] * len(latitude), dtype=object)
+        valid = np.flatnonzero(~np.isnan(latitude) & ~np.isnan(longitude))
+        size = 2 ** max_level
+        x = (longitude[valid] + 180) / 360
+        sin_latitude = np.sin(np.radians(np.clip(latitude[valid], -_MAX_LATITUDE, _MAX_LATITUDE)))
+        y = 0.5 - np.log((1 + sin_latitude) / (1 - sin_latitude)) / (4 * np.pi)
+        column = np.clip((x * size).astype(np.int64), 0, size - 1)
+        row = np.clip((y * size).astype(np.int64), 0, size - 1)
+        codes = _spread_bits(column) | (_spread_bits(row) << np.uint64(1))
+        sort = np.argsort(codes, kind='stable')
+        self.order = valid[sort]  # ~ stations sorted by their cells, the positions in the given arrays
+        self._codes = codes[sort]
+        self.latitude = latitude[self.order]
+        self.longitude = longitude[self.order]
+
+    def level_for_zoom(self, zoom: float) -> int:
+        """
+        :param zoom: zoom of the map, where the world is 512 pixels wide at zoom 0
+        :return: level of the pyramid with cells about `cell_pixels` wide at the zoom
+        """
+        return int(min(max(round(zoom + np.log2(512 / self.cell_pixels)), 0), self.max_level))
+
+    def aggregate(self, values, level: int, how: str = 'sum', bbox: tuple = None) -> pd.DataFrame:
+        """
+        Aggregate the values of the stations into the cells of the level.
+        :param values: values of the stations, in the order of the stations given to the pyramid
+        :param level: level of the pyramid
+        :param how: sum or mean of the values of the stations in a cell
+        :param bbox: optional bounding box (min lon, min lat, max lon, max lat), only the stations inside are used
+        :return: Pandas dataframe with the latitude and longitude (centroid of the stations), the aggregated value,
+        the number of stations and the name (of the station with the largest value, and the number of the others) of
+        the non-empty cells
+        """
+        if how not in ('sum', 'mean'):
+            raise ValueError(f'Invalid aggregation {how}')
+        values = np.asarray(values, dtype=np.float64)[self.order]
+        inside = ~np.isnan(values)
+        if bbox is not None:
+            min_lon, min_lat, max_lon, max_lat = bbox
+            inside &= (self.longitude >= min_lon) & (self.longitude <= max_lon) & \
+                (self.latitude >= min_lat) & (self.latitude <= max_lat)
+        positions = np.flatnonzero(inside)
+        if not len(positions):
+            return pd.DataFrame(columns=['latitude', 'longitude', 'value', 'stations', 'name'])
+        codes = self._codes[positions] >> np.uint64(2 * (self.max_level - level))
+        starts = np.flatnonzero(np.concatenate([[True], codes[1:] != codes[:-1]]))
+        counts = np.diff(np.append(starts, len(positions)))
+        values = values[positions]
+        sums = np.add.reduceat(values, starts)
+        # ~ the first station with the largest value of each cell names the cell
+        maxima = np.repeat(np.maximum.reduceat(values, starts), counts)
+        largest = np.minimum.reduceat(np.where(values == maxima, np.arange(len(values)), len(values)), starts)
+        names = self.names[self.order[positions[largest]]]
+        return pd.DataFrame({
+            'latitude': np.add.reduceat(self.latitude[positions], starts) / counts,
+            'longitude': np.add.reduceat(self.longitude[positions], starts) / counts,
+            'value': sums if how == 'sum' else sums / counts,
+            'stations': counts,
+            'name': [name if count == 1 else f'{name} and {count - 1} more' for name, count in zip(names, counts)],
+        })
+
+
+_EARTH_RADIUS = 6371008.8  # ~ mean radius in meters
+
+
+def haversine(latitude, longitude, center_latitude: float, center_longitude: float) -> np.ndarray:
+    """
+    :return: great-circle distances in meters of the points from the center
+    """
+    latitude, longitude = np.radians(latitude), np.radians(longitude)
+    center_latitude, center_longitude = np.radians(center_latitude), np.radians(center_longitude)
+    a = np.sin((latitude - center_latitude) / 2) ** 2 + \
+        np.cos(latitude) * np.cos(center_latitude) * np.sin((longitude - center_longitude) / 2) ** 2
+    return 2 * _EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.)))
+
+
+class StationGrid:
+    """
+    Spatial index of the stations for the range queries: the stations are sorted by the square cell of the latitude
+    and longitude grid (`cell_degrees` wide) they fall into, row by row, so the stations of a bounding box are found
+    with two binary searches per row of cells it covers, and only those are compared with the box itself.
+    """
+
+    def __init__(self, latitude, longitude, cell_degrees: float = 0.01):
+        """
+        :param latitude: latitudes of the stations, stations with NaN are left out
+        :param longitude: longitudes of the stations
+        :param cell_degrees: size of a cell, about 1 km by default
+        """
+        latitude = np.asarray(latitude, dtype=np.float64)
+        longitude = np.asarray(longitude, dtype=np.float64)
+        self.cell_degrees = cell_degrees
+        valid = np.flatnonzero(~np.isnan(latitude) & ~np.isnan(longitude))
+        self.min_latitude = latitude[valid].min() if len(valid) else 0.
+        self.min_longitude = longitude[valid].min() if len(valid) else 0.
+        rows, columns = self._cells(latitude[valid], longitude[valid])
+        self.n_columns = int(columns.max()) + 1 if len(valid) else 1
+        self.n_rows = int(rows.max()) + 1 if len(valid) else 1
+        keys = rows * self.n_columns + columns
+        sort = np.argsort(keys, kind='stable')
+        self.order = valid[sort]  # ~ stations sorted by their cells, the positions in the given arrays
+        self._keys = keys[sort]
+        self.latitude = latitude[self.order]
+        self.longitude = longitude[self.order]
+
+    def _cells(self, latitude: np.ndarray, longitude: np.ndarray) -> tuple:
+        return (np.floor((latitude - self.min_latitude) / self.cell_degrees).astype(np.int64),
+                np.floor((longitude - self.min_longitude) / self.cell_degrees).astype(np.int64))
+
+    def _sorted_within_bbox(self, bbox: tuple) -> np.ndarray:
+        """
+        :return: positions of the stations inside the bounding box in the sorted arrays
+        """
+        min_lon, min_lat, max_lon, max_lat = bbox
+        (first_row, last_row), (first_column, last_column) = self._cells(np.array([min_lat, max_lat]),
+                                                                         np.array([min_lon, max_lon]))
+        rows = np.arange(max(first_row, 0), min(last_row, self.n_rows - 1) + 1)
+        first_column, last_column = max(first_column, 0), min(last_column, self.n_columns - 1)
+        if not len(rows) or first_column > last_column:
+            return np.zeros(0, dtype=np.int64)
+        starts = np.searchsorted(self._keys, rows * self.n_columns + first_column, side='left')
+        ends = np.searchsorted(self._keys, rows * self.n_columns + last_column, side='right')
+        lengths = ends - starts  # ~ concatenate the ranges of the rows without a loop
+        candidates = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        latitude, longitude = self.latitude[candidates], self.longitude[candidates]
+        inside = (latitude >= min_lat) & (latitude <= max_lat) & (longitude >= min_lon) & (longitude <= max_lon)
+        return candidates[inside]
+
+    def within_bbox(self, bbox: tuple) -> np.ndarray:
+        """
+        :param bbox: bounding box (min lon, min lat, max lon, max lat)
+        :return: positions of the stations inside the bounding box (including its edges), in the given arrays
+        """
+        return self.order[self._sorted_within_bbox(bbox)]
+
+    def within_radius(self, latitude: float, longitude: float, radius: float) -> tuple:
+        """
+        :param latitude: latitude of the center
+        :param longitude: longitude of the center
+        :param radius: radius in meters
+        :return: positions of the stations within the radius from the center, in the given arrays, from the nearest;
+        and their distances in meters
+        """
+        lat_degrees = np.degrees(radius / _EARTH_RADIUS)
+        lon_degrees = lat_degrees / max(np.cos(np.radians(min(abs(latitude) + lat_degrees, 90.))), 1e-12)
+        candidates = self._sorted_within_bbox((longitude - lon_degrees, latitude - lat_degrees,
+                                               longitude + lon_degrees, latitude + lat_degrees))
+        distances = haversine(self.latitude[candidates], self.longitude[candidates], latitude, longitude)
+        near = np.flatnonzero(distances <= radius)
+        near = near[np.argsort(distances[near], kind='stable')]
+        return self.order[candidates[near]], distances[near]
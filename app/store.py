@@ -0,0 +1,254 @@
+import json
+import os
+from contextlib import contextmanager
+from typing import Iterable
+
+import numpy as np
+
+
+@contextmanager
+def atomic_write(path: str, mode: str = 'w', encoding: str = 'utf8'):
+    """
+    Open a temporary `.part` file next to the path for writing, and move it to the path once it is written, so that
+    readers (and the next run after an interrupted one) never see a half written file. The temporary file is removed
+    if the writing fails.
+    :param path: path to the file
+    :param mode: 'w' for text, 'wb' for binary
+    :param encoding: encoding of the text
+    :return: the open temporary file
+    """
+    partial_path = f'{path}.part'
+    try:
+        with open(partial_path, mode, encoding=None if 'b' in mode else encoding) as output_f:
+            yield output_f
+        os.replace(partial_path, path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+
+def save_npz(path: str, **arrays):
+    """
+    Save the arrays into the `.npz` file at exactly the path (`np.savez` would append `.npz` to a path without it).
+    :param path: path to the file
+    :param arrays: the arrays by name
+    """
+    with atomic_write(path, 'wb') as output_f:
+        np.savez(output_f, **arrays)
+
+
+class StopCountStore:
+    """
+    Columnar storage of the stop counts of the parent stations. A directory containing:
+    - `stations.json` with the station ids and names, defining the order of the rows of all the columns,
+    - `lat.npy` and `lon.npy` with the locations (NaN for stations without location),
+    - `count_{date}.npy` with the int32 stop counts for each date,
+    - `hours_{date}.npy` with the int32 departures by hour of shape (number of the stations, 24) for the dates crawled
+      with the hours,
+    - `meta.json` with the list of the stored dates, and of the dates with the hours.
+    The columns are memory-mapped when read, so reading one date reads only that date.
+    """
+
+    def __init__(self, path: str = 'data/stop_count_store'):
+        self.path = path
+        self._index = None
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _save_array(self, name: str, array: np.ndarray):
+        with atomic_write(self._file(f'{name}.npy'), 'wb') as output_f:  # ~ readers never see a half written column
+            np.save(output_f, array)
+
+    def _save_json(self, name: str, data: dict):
+        with atomic_write(self._file(name)) as output_f:
+            json.dump(data, output_f, ensure_ascii=False)
+
+    def files(self, dates: list = ()) -> list:
+        """
+        :param dates: the selected dates
+        :return: paths to the files holding the stations, their locations and the stop counts for the dates
+        """
+        return [self._file(name) for name in ('meta.json', 'stations.json', 'lat.npy', 'lon.npy')] + \
+            [self._file(f'count_{date}.npy') for date in dates]
+
+    def hour_files(self, dates: list = ()) -> list:
+        """
+        :param dates: the selected dates
+        :return: paths to the files holding the stations, their locations and the departures by hour for the dates
+        """
+        return self.files() + [self._file(f'hours_{date}.npy') for date in dates]
+
+    def exists(self) -> bool:
+        return os.path.exists(self._file('meta.json'))
+
+    def create(self, all_ids: dict):
+        """
+        Create an empty store (without any dates) for the parent stations.
+        :param all_ids: all parent stations as in the `all_stations_ids.json`
+        """
+        os.makedirs(self.path, exist_ok=True)
+        self._save_json('stations.json', {
+            'ids': list(all_ids),
+            'names': [properties['name'] for properties in all_ids.values()],
+        })
+        self._save_array('lat', np.array([(p['location'] or {}).get('lat', np.nan) for p in all_ids.values()],
+                                         dtype=np.float64))
+        self._save_array('lon', np.array([(p['location'] or {}).get('lon', np.nan) for p in all_ids.values()],
+                                         dtype=np.float64))
+        if self.exists():
+            for date in self.dates():
+                os.remove(self._file(f'count_{date}.npy'))
+            for date in self.hour_dates():
+                os.remove(self._file(f'hours_{date}.npy'))
+        self._save_json('meta.json', {'dates': [], 'hour_dates': []})
+        self._index = None
+
+    def import_json(self, parent_ids_count: dict):
+        """
+        Create the store from the stations with stop counts in the format of `final-stations_with_count.json`.
+        :param parent_ids_count: dict of parent stations with their location and stop counts by date
+        """
+        self.create(parent_ids_count)
+        dates = list(next(iter(parent_ids_count.values()))['count']) if parent_ids_count else []
+        self.write_columns({date: [properties['count'].get(date, 0) for properties in parent_ids_count.values()]
+                            for date in dates})
+
+    def _meta(self) -> dict:
+        with open(self._file('meta.json'), encoding='utf8') as input_f:
+            return json.load(input_f)
+
+    def dates(self) -> list:
+        return self._meta()['dates']
+
+    def hour_dates(self) -> list:
+        return self._meta().get('hour_dates', [])  # ~ stores from before the hours have none
+
+    @property
+    def index(self) -> dict:
+        """
+        Station ids and names, and the mapping of station ids to the row numbers.
+        """
+        if self._index is None:
+            with open(self._file('stations.json'), encoding='utf8') as input_f:
+                self._index = json.load(input_f)
+            self._index['rows'] = {station_id: i for i, station_id in enumerate(self._index['ids'])}
+        return self._index
+
+    def write_columns(self, columns: dict):
+        """
+        Save the stop counts for the selected dates, replacing any counts already stored for them.
+        :param columns: dict of the stop counts in the order of the stations in the store by date
+        """
+        for date, counts in columns.items():
+            counts = np.asarray(counts, dtype=np.int32)
+            if len(counts) != len(self.index['ids']):
+                raise ValueError(f'Expected {len(self.index["ids"])} stop counts, got {len(counts)}')
+            self._save_array(f'count_{date}', counts)
+        self._add_dates('dates', columns)
+
+    def _add_dates(self, key: str, dates: Iterable[str]):
+        meta = self._meta()
+        if set(dates) - set(meta.get(key, [])):
+            meta[key] = sorted(set(meta.get(key, [])) | set(dates))
+            self._save_json('meta.json', meta)
+
+    def write_hour_columns(self, columns: dict):
+        """
+        Save the departures by hour for the selected dates, replacing any departures already stored for them.
+        :param columns: dict of the departures of shape (number of the stations, 24) in the order of the stations in
+        the store by date
+        """
+        for date, hours in columns.items():
+            hours = np.asarray(hours, dtype=np.int32)
+            if hours.shape != (len(self.index['ids']), 24):
+                raise ValueError(f'Expected departures of shape ({len(self.index["ids"])}, 24), got {hours.shape}')
+            self._save_array(f'hours_{date}', hours)
+        self._add_dates('hour_dates', columns)
+
+    def read_column(self, date: str) -> np.ndarray:
+        """
+        :param date: the selected date from `dates()`
+        :return: memory-mapped stop counts for the date in the order of the stations in the store
+        """
+        return np.load(self._file(f'count_{date}.npy'), mmap_mode='r')
+
+    def read_hours(self, date: str) -> np.ndarray:
+        """
+        :param date: the selected date from `hour_dates()`
+        :return: memory-mapped departures by hour for the date of shape (number of the stations, 24)
+        """
+        return np.load(self._file(f'hours_{date}.npy'), mmap_mode='r')
+
+    def read_locations(self) -> tuple:
+        """
+        :return: memory-mapped latitudes and longitudes in the order of the stations in the store
+        """
+        return np.load(self._file('lat.npy'), mmap_mode='r'), np.load(self._file('lon.npy'), mmap_mode='r')
+
+    def export_json(self) -> dict:
+        """
+        Export the store into the format of `final-stations_with_count.json`.
+        :return: dict of parent stations with their name, location and stop counts by date
+        """
+        lat, lon = self.read_locations()
+        columns = {date: self.read_column(date).tolist() for date in self.dates()}
+        return {
+            station_id: {
+                'name': self.index['names'][i],
+                'location': {'lat': float(lat[i]), 'lon': float(lon[i])} if not np.isnan(lat[i]) else {},
+                'count': {date: column[i] for date, column in columns.items()},
+            } for i, station_id in enumerate(self.index['ids'])
+        }
+
+
+class StationIndex:
+    """
+    Child-parent index of all the stops, built once from the station hierarchy and saved as `.npz`:
+    - `stop_ids` with the parent stations first (in the order of `all_stations_ids.json`), then their children,
+    - `parent_rows` with the row of the parent station of each stop (parent stations point to themselves).
+    """
+
+    def __init__(self, stop_ids: np.ndarray, parent_rows: np.ndarray, n_parents: int):
+        self.stop_ids = stop_ids
+        self.parent_rows = parent_rows
+        self.n_parents = n_parents
+        self._rows = None
+
+    @classmethod
+    def from_ids(cls, all_ids: dict) -> 'StationIndex':
+        """
+        :param all_ids: all parent stations with their children as in the `all_stations_ids.json`
+        """
+        rows = {station_id: i for i, station_id in enumerate(all_ids)}
+        n_parents = len(rows)
+        child_parent = {}
+        for parent_row, properties in enumerate(all_ids.values()):
+            for child_station in properties['children']:
+                if child_station not in rows:
+                    child_parent[child_station] = parent_row
+        stop_ids = np.array(list(rows) + list(child_parent), dtype=str)
+        parent_rows = np.concatenate([np.arange(n_parents), np.fromiter(child_parent.values(), dtype=np.int64,
+                                                                        count=len(child_parent))]).astype(np.int32)
+        return cls(stop_ids, parent_rows, n_parents)
+
+    def save(self, path: str):
+        save_npz(path, stop_ids=self.stop_ids, parent_rows=self.parent_rows, n_parents=self.n_parents)
+
+    @classmethod
+    def load(cls, path: str) -> 'StationIndex':
+        with np.load(path) as index:
+            return cls(index['stop_ids'], index['parent_rows'], int(index['n_parents']))
+
+    @property
+    def parent_ids(self) -> list:
+        return self.stop_ids[:self.n_parents].tolist()
+
+    def rows_of(self, stop_ids) -> np.ndarray:
+        """
+        :param stop_ids: iterable of stop ids
+        :return: array of the rows of the stops, -1 for stops missing in the index
+        """
+        if self._rows is None:
+            self._rows = {station_id: i for i, station_id in enumerate(self.stop_ids.tolist())}
+        return np.fromiter((self._rows.get(station_id, -1) for station_id in stop_ids), dtype=np.int64)
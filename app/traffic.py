@@ -1,7 +1,16 @@
 import requests
-import csv
 import json
+import os
+import tempfile
+import time
+from collections import Counter
+import numpy as np
 import pandas as pd
+from pandas.api.types import is_datetime64_any_dtype
+
+from app.cache import HttpCache
+from app.hourly import HourlyTrafficAggregates
+from app.metrics import staged
 
 pd.set_option('display.expand_frame_repr', False)
 
@@ -13,52 +22,139 @@ class Traffic:
         self.traffic_csv_path = 'data/traffic.csv'
         self.traffic_json_path = 'data/traffic.json'
         self.stops_json_path = 'data/stops_pid.json'
+        self.stops_out_path = 'data/stops_out.json'
+        self.traffic_out_path = 'data/traffic_out.pkl'
         self.final_output_path = 'data/final_traffic.pkl'
+        self.hourly_output_path = 'data/final_traffic_hourly.npz'
+        self.traffic_chunk_size = 100000  # ~ rows of the CSV parsed at once, bounds the memory of the ingestion
+        self.traffic = None
+        # the traffic survey is historical, stops change at most daily
+        self.cache = HttpCache('data/http_cache.sqlite', ttls={self.traffic_url: 30 * 24 * 3600})
+        # set to `app.metrics.Metrics()` (possibly the one of GolemioApiDownloader) to measure the steps and requests
+        self.metrics = None
 
-    def download_data(self):
-        # get traffic records in csv
-        response = requests.get(self.traffic_url)
-        if str(response.status_code) != '200':
-            raise ConnectionError(f'Request failed with {response.status_code}')
+    def _download(self, url: str, file_path: str):
+        # reuse the cached response if it is fresh, otherwise ask the server whether it changed since it was cached
+        cached = self.cache.lookup(url) if self.cache is not None else None
+        if cached is not None and cached.fresh:
+            content = cached.body
+        else:
+            start = time.monotonic()
+            response = requests.get(url, headers=HttpCache.revalidation_headers(cached))
+            if self.metrics is not None:
+                self.metrics.record_request(url.rsplit('/', 1)[-1], response.status_code, len(response.content),
+                                            time.monotonic() - start)
+            if response.status_code == 304 and cached is not None:
+                self.cache.refresh(url)
+                content = cached.body
+            elif str(response.status_code) != '200':
+                raise ConnectionError(f'Request failed with {response.status_code}')
+            else:
+                content = response.content
+                if self.cache is not None:
+                    self.cache.store(url, content, response.headers)
         # save response to file
-        with open(self.traffic_csv_path, 'wb') as f:
-            f.write(response.content)
+        with open(file_path, 'wb') as f:
+            f.write(content)
 
+    @staged('traffic_download')
+    def download_data(self):
+        # get traffic records in csv
+        self._download(self.traffic_url, self.traffic_csv_path)
         # get stops in json
-        response = requests.get(self.stops_url)
-        if str(response.status_code) != '200':
-            raise ConnectionError(f'Request failed with {response.status_code}')
-        # save response to file
-        with open(self.stops_json_path, 'wb') as f:
-            f.write(response.content)
+        self._download(self.stops_url, self.stops_json_path)
 
-    def process_traffic(self):
-        # create new list
-        traf_list = []
-        # process csv data by line
-        with open(self.traffic_csv_path, 'r', encoding='utf-8') as f:
-            reader = csv.reader(f)
-            # skip header
-            next(reader, None)
-            # for every line
-            for row in reader:
-                # create new item in list
-                traf_list.append({
-                    "id": row[14] + "/" + row[15],
-                    "realTime": row[2],
-                    "schTime": row[3],
-                    "entry": int(row[6]) + int(row[7]),
-                    "exit": int(row[12]) + int(row[13]),
-                    "befArr": int(row[10]) + int(row[11]),
-                    "aftDep": int(row[8]) + int(row[9]),
-                })
+    @staticmethod
+    def _parse_times(times: pd.Series) -> pd.Series:
+        """
+        Parse the departure times, missing departures (formatted as '1.1.1900') become NaT.
+        :param times: departure times as strings
+        :return: parsed departure times
+        """
+        # ~ the same times repeat many times, so each distinct time is parsed only once
+        return pd.to_datetime(times.where(times != '1.1.1900'), dayfirst=True, errors='coerce', cache=True)
+
+    def _read_traffic_chunks(self):
+        """
+        Read the traffic records from the CSV in chunks of typed columns.
+        :return: generator of DataFrames with the columns id (categorical), realTime, schTime (datetime), entry, exit,
+        befArr and aftDep (int32)
+        """
+        # ~ empty fields stay empty strings, so a record with an empty stop number gets an id such as 'N/'
+        reader = pd.read_csv(
+            self.traffic_csv_path, header=None, skiprows=1, encoding='utf-8', chunksize=self.traffic_chunk_size,
+            keep_default_na=False,
+            usecols=[2, 3, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15],
+            dtype={**{column: str for column in (2, 3, 14, 15)}, **{column: np.int32 for column in range(6, 14)}},
+        )
+        for chunk in reader:
+            yield pd.DataFrame({
+                'id': (chunk[14] + '/' + chunk[15]).astype('category'),
+                'realTime': self._parse_times(chunk[2]),
+                'schTime': self._parse_times(chunk[3]),
+                'entry': chunk[6] + chunk[7],
+                'exit': chunk[12] + chunk[13],
+                'befArr': chunk[10] + chunk[11],
+                'aftDep': chunk[8] + chunk[9],
+            })
 
-        # sort by id
-        traf_list.sort(key = lambda x: x["id"], reverse = False)
+    @staticmethod
+    def _merge_traffic_partitions(partition_paths: list, id_counts: Counter) -> pd.DataFrame:
+        """
+        Merge the partitions of the traffic records into one DataFrame sorted by id, keeping the order of the records
+        of each stop. Each partition is read once and its records are written straight to their positions in the
+        preallocated columns, so only the output and one partition are held in memory.
+        :param partition_paths: paths to the pickled partitions, in the order of the records
+        :param id_counts: number of the records of each stop in all the partitions
+        :return: DataFrame of all the records
+        """
+        if not partition_paths:
+            return pd.DataFrame(columns=['id', 'realTime', 'schTime', 'entry', 'exit', 'befArr', 'aftDep'])
+        ids = np.array(sorted(id_counts), dtype=object)
+        sizes = np.array([id_counts[stop_id] for stop_id in ids], dtype=np.int64)
+        cursors = np.cumsum(sizes) - sizes  # ~ position of the next record of each stop in the output
+        codes = np.empty(sizes.sum(), dtype=np.int32)
+        columns = None
+        for path in partition_paths:
+            partition = pd.read_pickle(path)
+            partition_codes = np.searchsorted(ids, np.asarray(partition['id'].cat.categories, dtype=object))
+            if (partition['id'].cat.codes.values < 0).any():
+                raise ValueError(f'Traffic records without a stop id in {path}')
+            partition_codes = partition_codes[partition['id'].cat.codes.values]
+            order = np.argsort(partition_codes, kind='mergesort')
+            sorted_codes = partition_codes[order]
+            # ~ the k-th record of a stop in the partition goes k places after the records of the previous partitions
+            positions = np.empty(len(order), dtype=np.int64)
+            positions[order] = cursors[sorted_codes] + np.arange(len(order)) - np.searchsorted(sorted_codes,
+                                                                                               sorted_codes)
+            cursors += np.bincount(partition_codes, minlength=len(ids))
+            if columns is None:
+                columns = {name: np.empty(len(codes), dtype=partition[name].dtype) for name in partition.columns[1:]}
+            codes[positions] = partition_codes
+            for name, column in columns.items():
+                column[positions] = partition[name].values
+        traffic = pd.DataFrame({'id': pd.Categorical.from_codes(codes, ids)})
+        for name in list(columns):  # ~ one column at a time, the constructor would copy them all into blocks
+            traffic[name] = columns.pop(name)
+        return traffic
+
+    @staged('process_traffic')
+    def process_traffic(self):
+        # parse the csv chunk by chunk into partitions on disk, only the typed columns of one chunk are in memory
+        out_dir = os.path.dirname(self.traffic_out_path) or '.'
+        with tempfile.TemporaryDirectory(prefix='traffic_partitions_', dir=out_dir) as partition_dir:
+            partition_paths, id_counts = [], Counter()
+            for chunk in self._read_traffic_chunks():
+                partition_paths.append(os.path.join(partition_dir, f'{len(partition_paths)}.pkl'))
+                chunk.to_pickle(partition_paths[-1])
+                id_counts.update(chunk['id'].value_counts().to_dict())
+            # sort by id, keeping the order of the records of each stop
+            traffic = self._merge_traffic_partitions(partition_paths, id_counts)
+        self.traffic = traffic
         # store in file
-        with open("data/traffic_out.json", "w", encoding = 'utf-8') as f:
-            json.dump(traf_list, f, ensure_ascii = False, indent = 4)
+        traffic.to_pickle(self.traffic_out_path)
 
+    @staged('process_stops')
     def process_stops(self):
         sjf = pd.read_json(self.stops_json_path, encoding = 'utf-8')
         # create new list
@@ -75,53 +171,31 @@ class Traffic:
                     "lon": stop["lon"],
                 })
         # store in file
-        with open("data/stops_out.json", "w", encoding='utf-8') as f:
+        with open(self.stops_out_path, "w", encoding='utf-8') as f:
             json.dump(stop_list, f, ensure_ascii = False, indent = 4)
 
+    @staged('merge_panda')
     def merge_panda(self):
         # panda merge of traffic and stops
-        pd_stops = pd.read_json("data/stops_out.json", encoding = 'utf-8')
-        pd_traffic = pd.read_json("data/traffic_out.json", encoding = 'utf-8')
+        pd_stops = pd.read_json(self.stops_out_path, encoding = 'utf-8')
+        pd_traffic = self.traffic if self.traffic is not None else pd.read_pickle(self.traffic_out_path)
         ST_out = pd.merge(pd_stops, pd_traffic, how = "inner")
         self.ST_out = ST_out
         ST_out.to_pickle(self.final_output_path)
+        # aggregate delay, flow and load by station and hour once, for the queries of any hour range
+        HourlyTrafficAggregates.from_frame(ST_out).save(self.hourly_output_path)
 
     @staticmethod
     def output_col(data: pd.DataFrame, start: int, end: int, out: str):
-        # remove missing scheduled departures (formatted as '1.1.1900')
-        data = data.copy()
-        data = data.loc[data['realTime'] != '1.1.1900',:]
-        # convert departure data to datetime
-        data['schTime'] = pd.to_datetime(data['schTime'], infer_datetime_format = True)
-        data['realTime'] = pd.to_datetime(data['realTime'], infer_datetime_format = True)
-        # get hour from scheduled departure and filter by selected hour range
-        data['schHour'] = pd.DatetimeIndex(data['schTime']).hour
-        data_filtered = data[(data['schHour'] >= start) & (data['schHour'] < end)].copy()
-        if out == "delay":
-            # calculate delay
-            data_filtered['output'] = (data_filtered['realTime'] - data_filtered['schTime']).dt.total_seconds()
-            # early departure treated as on time
-            data_filtered.loc[data_filtered['output'] < 0, 'output'] = 0
-            # mean by station
-            Means = data_filtered[['id','name','output', 'lat', 'lon']].groupby(['id','name', 'lat', 'lon']).mean()
-            Means.reset_index([1, 2, 3], inplace = True)
-            return(Means)
-        if out == 'flow':
-            # calculate flow
-            data_filtered['output'] = data_filtered['entry'] + data_filtered['exit']
-            # mean by station
-            Means = data_filtered[['id', 'name', 'output', 'lat', 'lon']].groupby(['id', 'name', 'lat', 'lon']).mean()
-            Means.reset_index([1, 2, 3], inplace = True)
-            return(Means)
-        if out == 'load':
-            # calculate load
-            data_filtered['output'] = (data_filtered['aftDep'] + data_filtered['befArr']) / 2
-            # mean by station
-            Means = data_filtered[['id', 'name', 'output', 'lat', 'lon']].groupby(['id', 'name', 'lat', 'lon']).mean()
-            Means.reset_index([1, 2, 3], inplace = True)
-            return(Means)
-        else:
+        if out not in HourlyTrafficAggregates.OUTPUTS:
             raise ValueError('Invalid request')
+        # convert departure data to datetime, if processed before the times were parsed on ingestion
+        parsed = {column: Traffic._parse_times(data[column].astype(str)) for column in ('schTime', 'realTime')
+                  if not is_datetime64_any_dtype(data[column])}
+        if parsed:
+            data = data.assign(**parsed)
+        # mean by station for the selected hour range
+        return HourlyTrafficAggregates.from_frame(data).query(start, end, out)
 
 if __name__ == '__main__':
     traf = Traffic()
@@ -1,16 +1,59 @@
 import json
+import os
+import re
 import pandas as pd
 import plotly.express as px
-from app.traffic import Traffic
+from app.cache import DatasetCache
+from app.hourly import HourlyTrafficAggregates
+from app.query import StopCountQueries
+from app.registry import StationRegistry
+from app.spatial import GridPyramid
+from app.store import StopCountStore
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
 
 
 class Visualizer:
+    def __init__(self, store_path: str = 'data/stop_count_store',
+                 data_path: str = 'data/final-stations_with_count.json'):
+        self.store = StopCountStore(store_path)
+        self.data_path = data_path
+        # ~ the loaded data, reloaded when its files change, e.g. after another run of the GolemioApiDownloader
+        self.cache = DatasetCache()
+        self.cell_pixels = 16  # ~ width of the plotted grid cells on the screen
+
     @staticmethod
-    def load_data() -> dict:
-        with open('data/final-stations_with_count.json', encoding='utf-8') as data:
+    def load_data(data_path: str = 'data/final-stations_with_count.json') -> dict:
+        with open(data_path, encoding='utf-8') as data:
             json_data = json.load(data)
         return json_data
 
+    @staticmethod
+    def read_dates(data_path: str = 'data/final-stations_with_count.json') -> list:
+        """
+        Read the dates of the stop counts of the first station in the json data, parsing only the beginning of the
+        file instead of the whole file. All the stations have the stop counts for the same dates.
+        :param data_path: path to the json data
+        :return: list of the dates
+        """
+        decoder = json.JSONDecoder()
+        text = ''
+        with open(data_path, encoding='utf-8') as data:
+            for chunk in iter(lambda: data.read(2 ** 16), ''):
+                text += chunk
+                try:
+                    index = _WHITESPACE.match(text, text.index('{') + 1).end()
+                    if text[index:index + 1] == '}':  # ~ no stations
+                        return []
+                    _, index = decoder.raw_decode(text, index)  # ~ id of the first station
+                    index = _WHITESPACE.match(text, index).end() + 1  # ~ after the colon
+                    station, _ = decoder.raw_decode(text, _WHITESPACE.match(text, index).end())
+                    return list(station['count'])
+                except ValueError:  # ~ the first station is not read whole yet
+                    continue
+        raise ValueError(f'No stations found in {data_path}')
+
     @staticmethod
     def reformat_data(json_data: dict, date: str) -> list:
         """
@@ -29,64 +72,211 @@ class Visualizer:
         } for station_id, data in json_data.items() if data['location']]
         return new_json_data
 
+    def load_date(self, date: str) -> pd.DataFrame:
+        """
+        Load the stations with location and their stop counts for the selected date, reading just the column of the
+        date from the columnar store if there is one, otherwise from the json data, which is kept in memory as a
+        compact `StationRegistry`. The dataframe is kept in memory until the data changes.
+        :param date: selected date for visualization
+        :return: Pandas dataframe with the stations and their stop counts
+        """
+        if not self.store.exists():
+            return self.cache.get(('date', self.data_path, date), [self.data_path],
+                                  lambda: self.load_registry(self.data_path).to_frame(date))
+        return self.cache.get(('date', self.store.path, date), self.store.files([date]), lambda: self._read_date(date))
+
+    def load_registry(self, data_path: str = 'data/final-stations_with_count.json') -> StationRegistry:
+        """
+        Load the stations with their stop counts for all the dates from the json data into a `StationRegistry`, kept
+        in memory until the data changes.
+        :param data_path: path to the json data
+        """
+        return self.cache.get(('registry', data_path), [data_path],
+                              lambda: StationRegistry.from_json(self.load_data(data_path)))
+
+    def queries(self) -> StopCountQueries:
+        """
+        Queries over the stop counts of all the dates (time series, top-k, stations in an area, day-over-day deltas),
+        from the columnar store if there is one, otherwise from the json data. The indexes are built once and kept in
+        memory until the data changes.
+        """
+        if self.store.exists():
+            return self.cache.get(('queries', self.store.path), self.store.files(self.get_possible_dates()),
+                                  lambda: StopCountQueries.from_store(self.store.path))
+        return self.cache.get(('queries', self.data_path), [self.data_path],
+                              lambda: StopCountQueries(self.load_registry(self.data_path)))
+
+    def _read_date(self, date: str) -> pd.DataFrame:
+        store = StopCountStore(self.store.path)  # ~ the stations may have changed since they were read
+        return StationRegistry.from_store(store, [date]).to_frame(date)
+
+    def load_date_hours(self, date: str, start_hour: int = 0, end_hour: int = 24) -> pd.DataFrame:
+        """
+        Load the stations with location and their departures in the selected hour range of the selected date, summed
+        from the departures by hour in the columnar store. The dataframe is kept in memory until the data changes.
+        :param date: the selected date from `get_possible_hour_dates()`
+        :param start_hour: starting hour (inclusive)
+        :param end_hour: ending hour (exclusive)
+        :return: Pandas dataframe with the stations and their departures as the stop counts
+        """
+        if not 0 <= start_hour < end_hour <= 24:
+            raise ValueError(f'Invalid hour range {start_hour}-{end_hour}')
+        if date not in self.get_possible_hour_dates():
+            raise ValueError(f'No departures by hour for {date}, crawl it with `hourly_stop_times` set')
+
+        def read() -> pd.DataFrame:
+            df = self.load_date(date)
+            hours = StopCountStore(self.store.path).read_hours(date)
+            return df.assign(stop_count=hours[df.index.values, start_hour:end_hour].sum(axis=1))
+
+        return self.cache.get(('hours', self.store.path, date, start_hour, end_hour),
+                              self.store.hour_files([date]) + self.store.files([date]), read)
+
+    def get_possible_hour_dates(self) -> list:
+        """
+        Get dates for which there are departures by hour in the columnar store.
+        :return: list of the dates
+        """
+        if not self.store.exists():
+            return []
+        return list(self.cache.get(('hour_dates', self.store.path), self.store.files(), self.store.hour_dates))
+
     def get_possible_dates(self) -> list:
         """
-        Get dates for which there are present stop counts in the json_data downloaded with the GolemioApiDownloader.
+        Get dates for which there are present stop counts in the data downloaded with the GolemioApiDownloader, read
+        from the metadata of the columnar store if there is one, otherwise from the first station of the json data.
         :return: list of the dates
         """
-        return list(next(iter(self.load_data().values()))['count'].keys())
+        if self.store.exists():
+            return list(self.cache.get(('dates', self.store.path), self.store.files(), self.store.dates))
+        return list(self.cache.get(('dates', self.data_path), [self.data_path],
+                                   lambda: self.read_dates(self.data_path)))
 
-    def plot(self, date: str, zoom: int = 7):
+    def _pyramid(self, source: str, paths: list, df: pd.DataFrame, lat: str, lon: str) -> GridPyramid:
+        return self.cache.get(('pyramid', source, self.cell_pixels), paths,
+                              lambda: GridPyramid(df[lat], df[lon], df['name'], cell_pixels=self.cell_pixels))
+
+    def bin_date(self, date: str, zoom: float = 7, bbox: tuple = None, start_hour: int = 0,
+                 end_hour: int = 24) -> pd.DataFrame:
         """
-        Plot the stop counts for the selected date using Plotly Density Mapbox.
+        Sum the stop counts for the selected date in the grid cells of the size suitable for the zoom.
+        :param date: the selected date from possible dates
+        :param zoom: zoom of the map
+        :param bbox: optional bounding box (min lon, min lat, max lon, max lat) of the stations
+        :param start_hour: starting hour (inclusive), the whole day by default
+        :param end_hour: ending hour (exclusive), only the departures in the hour range are summed if it is not the
+        whole day
+        :return: Pandas dataframe with the cells
+        """
+        if (start_hour, end_hour) != (0, 24):
+            df = self.load_date_hours(date, start_hour, end_hour)
+        else:
+            df = self.load_date(date)
+        if self.store.exists():
+            pyramid = self._pyramid(self.store.path, self.store.files(), df, 'latitude', 'longitude')
+        else:  # ~ the stations with location are the same for all the dates of the json data
+            pyramid = self._pyramid(self.data_path, [self.data_path], df, 'latitude', 'longitude')
+        cells = pyramid.aggregate(df['stop_count'], pyramid.level_for_zoom(zoom), bbox=bbox)
+        return cells.rename(columns={'value': 'stop_count'})
+
+    @staticmethod
+    def _center(bbox: tuple, default: dict) -> dict:
+        if bbox is None:
+            return default
+        min_lon, min_lat, max_lon, max_lat = bbox
+        return dict(lat=(min_lat + max_lat) / 2, lon=(min_lon + max_lon) / 2)
+
+    def plot(self, date: str, zoom: int = 7, bbox: tuple = None, start_hour: int = 0, end_hour: int = 24):
+        """
+        Plot the stop counts for the selected date using Plotly Density Mapbox. The stations are binned into grid cells
+        of the size selected by the zoom, so the figure is as large as the screen, not as the number of the stations.
         :param date: the selected date from possible dates
         :param zoom: non-required argument for zooming the default location of the map, 6 by default, use 7 for jupyter
+        :param bbox: optional bounding box (min lon, min lat, max lon, max lat) of the plotted stations, the map is
+        centered on it
+        :param start_hour: optional starting hour (inclusive) of the plotted departures, 0 by default
+        :param end_hour: optional ending hour (exclusive) of the plotted departures, 24 by default; an hour range
+        other than the whole day needs the date to be crawled with `hourly_stop_times`, see `get_possible_hour_dates`
         """
-        json_data = self.reformat_data(self.load_data(), date)
-        df = pd.DataFrame(json_data)
+        df = self.bin_date(date, zoom, bbox, start_hour, end_hour)
         max_stop_count = df['stop_count'].max()
 
         fig = px.density_mapbox(
             data_frame=df, lat='latitude', lon='longitude', z='stop_count', hover_name='name',
+            hover_data=['stations'],
             radius=15,  # sets the thickness of each data point in the map
             color_continuous_midpoint=max_stop_count / 2.4,  # value found by testing to provide good visibility of
             # points with low number of stop counts per day
             color_continuous_scale='inferno', mapbox_style="open-street-map",
-            center=dict(lat=49.80, lon=15.20), zoom=zoom,  # center the map on the Czech Republic
+            center=self._center(bbox, dict(lat=49.80, lon=15.20)), zoom=zoom,  # center the map on the Czech Republic
         )
         fig.show()
 
-    def plot_traffic(self,type: str, zoom: int = 9.5, start_hour: int = 0, end_hour: int = 24, data_path: str = 'data/final_traffic.pkl'):
+    def load_traffic_aggregates(self, data_path: str = 'data/final_traffic.pkl') -> HourlyTrafficAggregates:
+        """
+        Load the hourly aggregates of the traffic data, saved next to the data by `Traffic.merge_panda`, or computed
+        from the data if they are missing or older than the data. Kept in memory until the data changes.
+        :param data_path: path to the traffic data
+        :return: hourly aggregates of delay, flow and load by station
+        """
+        aggregates_path = os.path.splitext(data_path)[0] + '_hourly.npz'
+
+        def load() -> HourlyTrafficAggregates:
+            if os.path.exists(aggregates_path) and os.path.getmtime(aggregates_path) >= os.path.getmtime(data_path):
+                return HourlyTrafficAggregates.load(aggregates_path)
+            return HourlyTrafficAggregates.from_frame(pd.read_pickle(data_path))
+
+        return self.cache.get(('traffic', data_path), [data_path, aggregates_path], load)
+
+    def bin_traffic(self, type: str, zoom: float = 9.5, start_hour: int = 0, end_hour: int = 24,
+                    data_path: str = 'data/final_traffic.pkl', bbox: tuple = None) -> pd.DataFrame:
+        """
+        Average either delay, load or flow of the stations for the selected hour range in the grid cells of the size
+        suitable for the zoom.
+        :return: Pandas dataframe with the cells
+        """
+        aggregates = self.load_traffic_aggregates(data_path)
+        aggregates_path = os.path.splitext(data_path)[0] + '_hourly.npz'
+        pyramid = self._pyramid(data_path, [data_path, aggregates_path], aggregates.stations, 'lat', 'lon')
+        cells = pyramid.aggregate(aggregates.means(start_hour, end_hour, type), pyramid.level_for_zoom(zoom),
+                                  how='mean', bbox=bbox)
+        return cells.rename(columns={'latitude': 'lat', 'longitude': 'lon', 'value': 'output'})
+
+    def plot_traffic(self,type: str, zoom: int = 9.5, start_hour: int = 0, end_hour: int = 24, data_path: str = 'data/final_traffic.pkl',
+                     bbox: tuple = None):
         """
-        Plot either delay, load or flow for the selected hour range using Plotly Density Mapbox and output_col method from Traffic.
+        Plot either delay, load or flow for the selected hour range using Plotly Density Mapbox and the hourly
+        aggregates of the traffic data, binned into grid cells of the size selected by the zoom.
         :param type: depending on what you want to plot select either delay, flow or load
         :param zoom: optional parameter for zooming the default location of the map
         :param start_hour: optional parameter for starting hour (inclusive, 0 by default)
         :param end_hour: optional parameter for ending hour (exclusive, 24 by default)
         :param data_path: optional parameter for choosing data path
+        :param bbox: optional bounding box (min lon, min lat, max lon, max lat) of the plotted stations
         """
 
-        df = pd.read_pickle(data_path)
-        df = Traffic().output_col(data = df, start = start_hour,end = end_hour,out = type)
+        df = self.bin_traffic(type, zoom, start_hour, end_hour, data_path, bbox)
 
         max_output = df['output'].max()
         mean_output = df['output'].mean()
 
         fig = px.density_mapbox(
-            data_frame = df, lat = 'lat', lon = 'lon', z = 'output', hover_name = 'name',
+            data_frame = df, lat = 'lat', lon = 'lon', z = 'output', hover_name = 'name', hover_data = ['stations'],
             radius = 20,  # sets the thickness of each data point in the map
             color_continuous_midpoint = max_output / mean_output,
             # points with low number of stop counts per day
             color_continuous_scale = 'inferno', mapbox_style = "open-street-map",
-            center = dict(lat = 50.07, lon = 14.41), zoom = zoom,  # center the map on Prague
+            center = self._center(bbox, dict(lat = 50.07, lon = 14.41)), zoom = zoom,  # center the map on Prague
         )
         fig.show()
 
 if __name__ == '__main__':
     visualizer = Visualizer()
     # print(visualizer.get_possible_dates())
+    # print(visualizer.queries().top_k(10, '2020-01-02'))
     # visualizer.plot('2020-01-02')
     # visualizer.plot('2019-12-07')
+    # visualizer.plot('2020-01-02', start_hour=6, end_hour=9)
     # visualizer.plot_traffic(type = 'flow')
     # visualizer.plot_traffic(type = 'load', zoom = 8)
     # visualizer.plot_traffic(type = 'delay', start_hour = 10, end_hour = 13)
@@ -0,0 +1,75 @@
+"""
+Aggregation of the stop counts to parent stations on a synthetic dataset: the former per-file dict aggregation
+(rebuilding the child-parent dict for every file) against the index-backed `aggregate_stop_counts`, in one process
+and in a pool of processes.
+
+    python -m benchmarks.bench_aggregate --parents 100000 --dates 2 --workers 4
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from app.downloader import GolemioApiDownloader
+from benchmarks.synthetic import station_ids, write_stop_count_files
+
+
+def aggregate_dicts(all_ids: dict, paths: list) -> dict:
+    all_stops = {}
+    for path in paths:
+        with open(path) as stops_f:
+            stops = json.load(stops_f)
+        child_parent = {}
+        for parent_station, properties in all_ids.items():
+            for child_station in properties['children']:
+                child_parent[child_station] = parent_station
+        for station, count in stops.items():
+            station = child_parent[station] if station not in all_ids else station
+            all_stops[station] = all_stops.get(station, 0) + count
+    return all_stops
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--parents', type=int, default=100000, help='parent stations, each with ~9 children')
+    parser.add_argument('--dates', type=int, default=2)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='processes of the parallel aggregation')
+    args = parser.parse_args()
+    dates = [f'2020-01-{day:02d}' for day in range(1, args.dates + 1)]
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        key_path = os.path.join(data_dir, 'key.json')
+        with open(key_path, 'w') as f:
+            json.dump({'X-Access-Token': ''}, f)
+        golemio = GolemioApiDownloader(key_path)
+        golemio.all_stations_ids_path = os.path.join(data_dir, 'all_stations_ids.json')
+        golemio.station_index_path = os.path.join(data_dir, 'station_index.npz')
+        golemio.all_stop_count_path = os.path.join(data_dir, 'all_stop_count')
+
+        all_ids = station_ids(args.parents)
+        golemio._save_into_json(all_ids, golemio.all_stations_ids_path)
+        paths = {date: write_stop_count_files(all_ids, golemio.all_stop_count_path, date) for date in dates}
+        n_stops = sum(1 + len(properties['children']) for properties in all_ids.values())
+        print(f'{n_stops} stops, {args.parents} parent stations, {sum(map(len, paths.values()))} files, '
+              f'{len(dates)} dates')
+
+        start = time.perf_counter()
+        expected = {date: aggregate_dicts(all_ids, paths[date]) for date in dates}
+        print(f'      dicts: {time.perf_counter() - start:.2f} s')
+
+        start = time.perf_counter()
+        golemio._station_index()
+        print(f'build index: {time.perf_counter() - start:.2f} s (once, in filter_station_ids_enriched)')
+
+        for workers in sorted({1, args.workers}):
+            golemio.aggregate_workers = workers
+            start = time.perf_counter()
+            all_stops, parent_ids = golemio.aggregate_stop_counts(dates)
+            print(f'    indexed: {time.perf_counter() - start:.2f} s ({workers} processes)')
+            for date, counts in zip(dates, all_stops):
+                assert {k: v for k, v in zip(parent_ids, counts.tolist()) if v} == expected[date]
+
+
+if __name__ == '__main__':
+    main()
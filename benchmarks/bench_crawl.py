@@ -0,0 +1,94 @@
+"""
+Wall-clock comparison of the stop-time crawl: the former grequests/gevent crawler (fixed pool of 5, one round of
+requests per page) against the asyncio `AsyncDownloadEngine`, both run against the local mock Golemio server.
+
+    python -m benchmarks.bench_crawl --stations 2000 --latency 0.05
+
+The former crawler needs grequests, which is no longer a dependency of the app: `pip install grequests`.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.mock_golemio import start_server, stop_times_count
+
+DATE = '2020-01-02'
+
+
+def crawl_grequests(base_uri: str, station_ids: list, limit: int = 1000) -> dict:
+    import grequests  # monkey-patches the stdlib, so it is only imported in its own process
+
+    counted, remaining = {}, [(station_id, 0) for station_id in station_ids]
+    while remaining:
+        urls = [f'{base_uri}gtfs/stoptimes/{station_id}?date={DATE}&limit={limit}&offset={offset}'
+                for station_id, offset in remaining]
+        remaining = []
+        for response in grequests.map((grequests.get(u) for u in urls), size=5):
+            stop_times = response.json()
+            if stop_times:
+                station_id = stop_times[0]['stop_id']
+                counted[station_id] = counted.get(station_id, 0) + len(stop_times)
+                remaining.append((station_id, counted[station_id]))
+    return counted
+
+
+def crawl_engine(base_uri: str, station_ids: list, output_dir: str) -> dict:
+    from app import downloader
+    from app.engine import run_coroutine
+    from app.ratelimit import TokenBucket
+
+    key_path = os.path.join(output_dir, 'key.json')
+    with open(key_path, 'w') as f:
+        json.dump({'X-Access-Token': ''}, f)
+    golemio = downloader.GolemioApiDownloader(key_path)
+    golemio.base_uri = base_uri
+    golemio.all_stop_count_path = os.path.join(output_dir, 'all_stop_count')
+    golemio.crawl_journal_path = os.path.join(output_dir, 'crawl_journal.sqlite')
+    golemio.rate_limiter = TokenBucket(rate=10000)  # measure the engine, not the request budget
+    golemio.cache = None
+    chunk = {station_id: {'children': []} for station_id in station_ids}
+    run_coroutine(golemio._count_stop_times([chunk], [DATE], resume=False))
+    with open(f'{golemio.all_stop_count_path}_{DATE}_1.json') as f:
+        return json.load(f)
+
+
+def run_in_subprocess(impl: str, base_uri: str, stations: int) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-m', 'benchmarks.bench_crawl', '--impl', impl, '--base-uri', base_uri,
+                    '--stations', str(stations)], check=True)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stations', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to each mock response')
+    parser.add_argument('--impl', choices=['grequests', 'engine'], help=argparse.SUPPRESS)
+    parser.add_argument('--base-uri', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    station_ids = [f'U{i}Z{i % 7}P' for i in range(args.stations)]
+
+    if args.impl:  # ~ child process measuring one implementation
+        with tempfile.TemporaryDirectory() as output_dir:
+            if args.impl == 'grequests':
+                counted = crawl_grequests(args.base_uri, station_ids)
+            else:
+                counted = crawl_engine(args.base_uri, station_ids, output_dir)
+        expected = {s: stop_times_count(s) for s in station_ids if stop_times_count(s)}
+        assert counted == expected, f'{args.impl} returned wrong stop counts'
+        return
+
+    server = start_server(latency=args.latency)
+    base_uri = f'http://127.0.0.1:{server.server_port}/v1/'
+    print(f'{args.stations} stations, {args.latency * 1000:.0f} ms latency per request')
+    for impl in ['grequests', 'engine']:
+        print(f'{impl:>10}: {run_in_subprocess(impl, base_uri, args.stations):.2f} s')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Building the station hierarchy of `filter_station_ids_enriched` from synthetic stops of growing size: the former
+dict-merging builder (2 levels only) against the linear `StationHierarchy`. Each builder is run once to warm up and
+timed as the best of `--repeat` runs.
+
+The time per stop of `StationHierarchy` still grows with the size (about 2 us at 10k stops, 4.5 us at 100k and
+5.5 us at 1M). That growth is the cost of memory access once the dicts no longer fit into the CPU caches, not extra
+work per stop. A single pass only storing each stop into a dict (`dict pass`) slows down per stop in the same way
+(about 1 us, 3.9 us and 3.9 us), so the ratio of the two (`ratio`) stays bounded, between 1.1 and 2.3, instead of
+growing with the size as the time of the former builder does.
+
+    python -m benchmarks.bench_hierarchy --sizes 10000 100000 1000000 --legacy-max 200000
+"""
+import argparse
+import time
+from typing import Callable
+
+from app.hierarchy import StationHierarchy
+from benchmarks.synthetic import stop_features
+
+
+def build_legacy(features: list) -> dict:
+    all_ids, children = {}, {}
+    for station in features:
+        properties = station['properties']
+        parent_station_id, station_id = properties['parent_station'], properties['stop_id']
+        if parent_station_id:
+            if parent_station_id in children:
+                if station_id not in children[parent_station_id]['children']:
+                    children[parent_station_id]['children'].append(station_id)
+            else:
+                children[parent_station_id] = {'children': [station_id]}
+        else:
+            all_ids[station_id] = {'name': properties['stop_name'], 'children': [],
+                                   'location': {'lat': properties['stop_lat'], 'lon': properties['stop_lon']}}
+    children_of_children, child_parent = {}, {}
+    for parent_station_id, station_children in children.items():
+        if parent_station_id in all_ids:
+            all_ids[parent_station_id]['children'] = station_children['children']
+            child_parent = {**child_parent, **{child: parent_station_id for child in station_children['children']}}
+        else:
+            children_of_children[parent_station_id] = station_children['children']
+    for parent_station_id, station_children in children_of_children.items():
+        in_first = set(all_ids[child_parent[parent_station_id]]['children'])
+        all_ids[child_parent[parent_station_id]]['children'].extend(set(station_children) - in_first)
+    return all_ids
+
+
+def single_pass(features: list) -> dict:
+    """
+    Lower bound of a builder: one pass storing each stop with its parent, location and name into a dict.
+    """
+    stops = {}
+    for station in features:
+        properties = station['properties']
+        stops[properties['stop_id']] = (properties['parent_station'], properties['stop_name'],
+                                        {'lat': properties['stop_lat'], 'lon': properties['stop_lon']})
+    return stops
+
+
+def timed(function: Callable, features: list, repeat: int) -> float:
+    function(features)  # ~ warm up
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(features)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def build(features: list) -> dict:
+    hierarchy = StationHierarchy()
+    for station in features:
+        properties = station['properties']
+        hierarchy.add(properties['stop_id'], properties['parent_station'],
+                      {'lat': properties['stop_lat'], 'lon': properties['stop_lon']}, properties['stop_name'])
+    all_ids, _ = hierarchy.resolve()
+    return all_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000], help='number of stops')
+    parser.add_argument('--legacy-max', type=int, default=200000, help='largest size to run the former builder on')
+    parser.add_argument('--depth', type=int, default=2, help='levels of child stations')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs of each builder, the best is reported')
+    args = parser.parse_args()
+
+    print(f'{"stops":>9} {"legacy":>9} {"linear":>9} {"us/stop":>8} {"dict pass":>10} {"ratio":>6}')
+    for size in args.sizes:
+        features = stop_features(size // 10, depth=args.depth)
+        legacy = ''
+        if len(features) <= args.legacy_max and args.depth <= 2:
+            start = time.perf_counter()
+            expected = build_legacy(features)
+            legacy = f'{time.perf_counter() - start:.2f} s'
+        all_ids = build(features)
+        elapsed = timed(build, features, args.repeat)
+        reference = timed(single_pass, features, args.repeat)
+        if legacy:
+            assert {k: set(v['children']) for k, v in all_ids.items()} == \
+                   {k: set(v['children']) for k, v in expected.items()}
+        print(f'{len(features):>9} {legacy:>9} {elapsed:>7.2f} s {elapsed / len(features) * 1e6:>8.2f} '
+              f'{reference / len(features) * 1e6:>7.2f} us {elapsed / reference:>6.2f}')
+
+
+if __name__ == '__main__':
+    main()
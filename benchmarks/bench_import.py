@@ -0,0 +1,47 @@
+"""
+Import time of the modules needed by the commands of the pipeline, each measured in a fresh interpreter, against the
+former eager import of the package (the downloader, the traffic and the visualizer with pandas and plotly), with the
+heavy dependencies each import loads.
+
+    python -m benchmarks.bench_import --repeat 5
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+IMPORTS = [
+    ('eager package (former)', 'import app.downloader, app.traffic, app.visualizer'),
+    ('app', 'import app'),
+    ('app.cli', 'import app.cli'),
+    ('crawl (downloader)', 'from app import GolemioApiDownloader'),
+    ('aggregate', 'import app.aggregation'),
+    ('visualizer', 'from app import Visualizer'),
+]
+DEPENDENCIES = ['numpy', 'requests', 'aiohttp', 'pandas', 'plotly']
+MEASURE = '''
+import json, sys, time
+start = time.perf_counter()
+{statement}
+print(json.dumps([time.perf_counter() - start, [m for m in {dependencies} if m in sys.modules]]))
+'''
+
+
+def measure(statement: str) -> tuple:
+    code = MEASURE.format(statement=statement, dependencies=DEPENDENCIES)
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    return tuple(json.loads(output))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='fresh interpreters per import, the fastest is kept')
+    args = parser.parse_args()
+    for name, statement in IMPORTS:
+        runs = [measure(statement) for _ in range(args.repeat)]
+        seconds = min(seconds for seconds, _ in runs)
+        print(f'{name:>22}: {seconds * 1e3:7.1f} ms, imports {", ".join(runs[0][1]) or "nothing heavy"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""
+Parsing a full page of `gtfs/stoptimes` stop times only to count them: `len(json.loads(body))` (what `res.json()`
+did) against the count-only `count_array_items`.
+
+    python -m benchmarks.bench_parsing --items 1000 --repeat 200
+"""
+import argparse
+import json
+import timeit
+import tracemalloc
+
+from app.parsing import count_array_items
+from benchmarks.mock_golemio import stop_time
+
+
+def peak_memory(function, body: bytes) -> int:
+    tracemalloc.start()
+    function(body)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=1000, help='stop times on the page')
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+    body = json.dumps([stop_time('U1000Z101P', i) for i in range(args.items)]).encode()
+    assert count_array_items(body) == len(json.loads(body)) == args.items
+
+    print(f'page of {args.items} stop times, {len(body) / 1024:.0f} kB')
+    for name, function in [('json.loads', lambda b: len(json.loads(b))), ('count_array_items', count_array_items)]:
+        seconds = min(timeit.repeat(lambda: function(body), number=args.repeat, repeat=5)) / args.repeat
+        print(f'{name:>17}: {seconds * 1e3:.3f} ms, peak {peak_memory(function, body) / 1024:.0f} kB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Queries over the stop count history answered by scanning the nested dicts of `final-stations_with_count.json`
+against the indexes of `StopCountQueries`: time series of a station, top-k stations for a date and a range of dates,
+stations in a bounding box and within a radius, and the largest day-over-day changes.
+
+    python -m benchmarks.bench_query --parents 50000 --dates 30
+"""
+import argparse
+import heapq
+import json
+import time
+
+from app.query import StopCountQueries
+from app.registry import StationRegistry
+from app.spatial import haversine
+from benchmarks.bench_registry import parent_ids_with_count
+
+
+def timed(function, repeat: int = 5) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--parents', type=int, default=50000, help='parent stations')
+    parser.add_argument('--dates', type=int, default=30)
+    parser.add_argument('-k', type=int, default=10, help='number of the stations of the top-k queries')
+    args = parser.parse_args()
+    stations = json.loads(json.dumps(parent_ids_with_count(args.parents, args.dates)))
+    station_id = list(stations)[args.parents // 2]
+    start = time.perf_counter()
+    queries = StopCountQueries(StationRegistry.from_json(stations))
+    print(f'{args.parents} parent stations, {args.dates} dates, indexes built in '
+          f'{(time.perf_counter() - start) * 1e3:.1f} ms')
+
+    dates = queries.dates
+    first, last = dates[0], dates[-1]
+    bbox = (14.40, 50.05, 14.45, 50.10)  # ~ (min lon, min lat, max lon, max lat)
+    center, radius = (50.08, 14.42), 1000
+
+    def scan_range(properties: dict) -> int:
+        return sum(properties['count'][date] for date in dates)
+
+    def scan_bbox() -> list:
+        return [station for station, properties in stations.items() if properties['location'] and
+                bbox[1] <= properties['location']['lat'] <= bbox[3] and
+                bbox[0] <= properties['location']['lon'] <= bbox[2]]
+
+    def scan_radius() -> list:
+        return [station for station, properties in stations.items() if properties['location'] and
+                haversine(properties['location']['lat'], properties['location']['lon'], *center) <= radius]
+
+    def scan_day_over_day() -> list:
+        return heapq.nlargest(args.k, stations, key=lambda station: abs(
+            stations[station]['count'][last] - stations[station]['count'][dates[-2]]))
+
+    cases = [
+        ('time series', lambda: {date: stations[station_id]['count'][date] for date in dates},
+         lambda: queries.time_series(station_id)),
+        ('top-k date', lambda: heapq.nlargest(args.k, stations, key=lambda s: stations[s]['count'][last]),
+         lambda: queries.top_k(args.k, last)),
+        ('top-k range', lambda: heapq.nlargest(args.k, stations, key=lambda s: scan_range(stations[s])),
+         lambda: queries.top_k(args.k, first, last)),
+        ('bounding box', scan_bbox, lambda: queries.within_bbox(bbox, last)),
+        ('radius', scan_radius, lambda: queries.within_radius(*center, radius, last)),
+    ]
+    if len(dates) > 1:
+        cases.append(('day over day', scan_day_over_day, lambda: queries.day_over_day(last, args.k)))
+    print(f'{"query":>14} {"scan":>10} {"indexed":>10}')
+    for name, scan, indexed in cases:
+        print(f'{name:>14} {timed(scan):8.2f}ms {timed(indexed):8.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Memory of the stations with stop counts held as the nested dicts of `final-stations_with_count.json` against the
+compact `StationRegistry`, and the time to turn them into the dataframe of one date for plotting: the former
+`Visualizer.reformat_data` against `StationRegistry.to_frame`. Also checks the child stations of the registry against
+synthetic `all_stations_ids.json` data, and against a real file if given with `--ids`.
+
+    python -m benchmarks.bench_registry --parents 100000 --dates 10 --ids data/all_stations_ids.json
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+import pandas as pd
+
+from app.registry import StationRegistry
+from app.visualizer import Visualizer
+from benchmarks.synthetic import station_ids
+
+
+def parent_ids_with_count(n_parents: int, n_dates: int) -> dict:
+    dates = [f'2020-01-{day:02d}' for day in range(1, n_dates + 1)]
+    stations = station_ids(n_parents)
+    for i, properties in enumerate(stations.values()):
+        properties['name'] = f'Station {i % (n_parents // 3 + 1)}'  # ~ several stops share a name
+        properties['count'] = {date: (i * 7 + d) % 600 for d, date in enumerate(dates)}
+        del properties['children']
+    return stations
+
+
+def check_children(all_ids: dict):
+    """
+    Check that `children_of` returns the children of each parent station of `all_stations_ids.json`, in their order.
+    A stop listed twice is the child of the first station listing it, as in `StationIndex.from_ids`.
+    """
+    registry = StationRegistry.from_ids(all_ids)
+    assigned = set(all_ids)
+    for station, properties in all_ids.items():
+        children = [child for child in dict.fromkeys(properties['children']) if child not in assigned]
+        assigned.update(children)
+        assert registry.children_of(station) == children, station
+        assert all(registry.parent_of(child) == station for child in children), station
+    assert registry.child_offsets[-1] == len(registry.stop_ids) - registry.n_parents
+
+
+def traced(function):
+    tracemalloc.start()
+    result = function()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--parents', type=int, default=100000, help='parent stations')
+    parser.add_argument('--dates', type=int, default=10)
+    parser.add_argument('--ids', help='path to an all_stations_ids.json to check the child stations against')
+    args = parser.parse_args()
+    check_children(station_ids(args.parents // 10))
+    if args.ids:
+        with open(args.ids, encoding='utf8') as ids_f:
+            check_children(json.load(ids_f))
+        print(f'child stations match {args.ids}')
+    text = json.dumps(parent_ids_with_count(args.parents, args.dates))
+
+    stations, dict_size = traced(lambda: json.loads(text))
+    registry = StationRegistry.from_json(stations)
+    print(f'{args.parents} parent stations, {args.dates} dates')
+    print(f'{"nested dicts":>16}: {dict_size / 2 ** 20:7.1f} MB')
+    print(f'{"StationRegistry":>16}: {registry.nbytes / 2 ** 20:7.1f} MB')
+
+    date = registry.dates[-1]
+    for name, function in [('reformat_data', lambda: pd.DataFrame(Visualizer.reformat_data(stations, date))),
+                           ('to_frame', lambda: registry.to_frame(date))]:
+        start = time.perf_counter()
+        function()
+        print(f'{name:>16}: {(time.perf_counter() - start) * 1e3:7.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
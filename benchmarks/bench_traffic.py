@@ -0,0 +1,109 @@
+"""
+Means of delay, flow and load by station for a sweep of hour ranges on synthetic traffic records: the former
+`output_col` (copy, filter and groupby of all the records for every range) against the queries of the precomputed
+`HourlyTrafficAggregates`. Also checks that `process_traffic` reads a synthetic CSV, including records with an empty
+stop number, into the same records sorted by stop id as the former `csv.reader` loop.
+
+    python -m benchmarks.bench_traffic --records 1000000 --stations 500
+"""
+import argparse
+import csv
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from app.hourly import HourlyTrafficAggregates
+from app.traffic import Traffic
+from benchmarks.synthetic import traffic_records, write_traffic_csv
+
+
+def output_col_legacy(data: pd.DataFrame, start: int, end: int, out: str) -> pd.DataFrame:
+    data = data.copy()
+    data = data.loc[data['realTime'].notna(), :]
+    data['schHour'] = pd.DatetimeIndex(data['schTime']).hour
+    data_filtered = data[(data['schHour'] >= start) & (data['schHour'] < end)].copy()
+    if out == 'delay':
+        data_filtered['output'] = (data_filtered['realTime'] - data_filtered['schTime']).dt.total_seconds()
+        data_filtered.loc[data_filtered['output'] < 0, 'output'] = 0
+    elif out == 'flow':
+        data_filtered['output'] = data_filtered['entry'] + data_filtered['exit']
+    else:
+        data_filtered['output'] = (data_filtered['aftDep'] + data_filtered['befArr']) / 2
+    means = data_filtered[['id', 'name', 'output', 'lat', 'lon']].groupby(['id', 'name', 'lat', 'lon']).mean()
+    means.reset_index([1, 2, 3], inplace=True)
+    return means
+
+
+def process_traffic_legacy(csv_path: str) -> list:
+    """
+    The former `process_traffic` without its json output: the records of the CSV sorted by stop id.
+    """
+    with open(csv_path, encoding='utf-8') as input_f:
+        reader = csv.reader(input_f)
+        next(reader, None)
+        records = [{
+            'id': row[14] + '/' + row[15],
+            'entry': int(row[6]) + int(row[7]),
+            'exit': int(row[12]) + int(row[13]),
+            'befArr': int(row[10]) + int(row[11]),
+            'aftDep': int(row[8]) + int(row[9]),
+        } for row in reader]
+    records.sort(key=lambda record: record['id'])
+    return records
+
+
+def check_process_traffic(n_records: int, n_stations: int, blank_stops: int, chunk_size: int):
+    with tempfile.TemporaryDirectory() as data_dir:
+        traffic = Traffic()
+        traffic.cache = None
+        traffic.traffic_csv_path = os.path.join(data_dir, 'traffic.csv')
+        traffic.traffic_out_path = os.path.join(data_dir, 'traffic_out.pkl')
+        traffic.traffic_chunk_size = chunk_size
+        write_traffic_csv(traffic.traffic_csv_path, n_records, n_stations, blank_stops=blank_stops)
+        start = time.perf_counter()
+        expected = pd.DataFrame(process_traffic_legacy(traffic.traffic_csv_path))
+        print(f'process_traffic: legacy {time.perf_counter() - start:.2f} s', end='')
+        start = time.perf_counter()
+        traffic.process_traffic()
+        print(f', chunked {time.perf_counter() - start:.2f} s ({n_records} records, {blank_stops} without stop number)')
+    result = traffic.traffic
+    assert result['id'].astype(str).tolist() == expected['id'].tolist()
+    for column in ('entry', 'exit', 'befArr', 'aftDep'):
+        assert result[column].tolist() == expected[column].tolist(), column
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=1000000)
+    parser.add_argument('--stations', type=int, default=500)
+    parser.add_argument('--csv-records', type=int, default=100000, help='records of the CSV read by process_traffic')
+    parser.add_argument('--blank-stops', type=int, default=10, help='records of the CSV with an empty stop number')
+    args = parser.parse_args()
+    check_process_traffic(args.csv_records, args.stations, args.blank_stops, chunk_size=args.csv_records // 7 + 1)
+    records = traffic_records(args.records, args.stations)
+    ranges = [(start, end) for start in range(0, 24, 3) for end in range(start + 1, 25, 3)]
+    queries = [(start, end, out) for start, end in ranges for out in HourlyTrafficAggregates.OUTPUTS]
+    print(f'{args.records} records, {args.stations} stations, {len(queries)} queries')
+
+    start = time.perf_counter()
+    expected = [output_col_legacy(records, *query) for query in queries]
+    print(f'output_col: {(time.perf_counter() - start) / len(queries) * 1000:.1f} ms per query')
+
+    start = time.perf_counter()
+    aggregates = HourlyTrafficAggregates.from_frame(records)
+    print(f' aggregate: {time.perf_counter() - start:.2f} s (once, in merge_panda)')
+
+    start = time.perf_counter()
+    results = [aggregates.query(*query) for query in queries]
+    print(f'     query: {(time.perf_counter() - start) / len(queries) * 1000:.2f} ms per query')
+
+    for query, result, legacy in zip(queries, results, expected):
+        assert result.index.tolist() == legacy.index.tolist(), query
+        assert np.allclose(result['output'], legacy['output']), query
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Local stand-in for the `gtfs/stops` and `gtfs/stoptimes/{id}` endpoints of Golemio API, serving synthetic stops and
+deterministic synthetic stop times, with configurable latency, page size and injected errors.
+"""
+import json
+import random
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def stop_times_count(stop_id: str, maximum: int = 2500) -> int:
+    """
+    Deterministic number of stop times of the stop, between 0 and maximum (by default so that some stops span several
+    pages).
+    """
+    return zlib.crc32(stop_id.encode()) % (maximum + 1)
+
+
+def stop_time(stop_id: str, i: int) -> dict:
+    return {
+        'arrival_time': f'{(i // 60) % 24:02d}:{i % 60:02d}:00',
+        'departure_time': f'{(i // 60) % 24:02d}:{i % 60:02d}:30',
+        'shape_dist_traveled': i * 0.5,
+        'stop_id': stop_id,
+        'stop_sequence': i % 40,
+        'trip_id': f'{i}_{stop_id}_200102',
+    }
+
+
+class MockGolemioHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    latency = 0.
+    stops = []  # ~ features served by `gtfs/stops`
+    page_size = None  # ~ largest page served, regardless of the requested limit
+    max_stop_times = 2500
+    error_rate = 0.
+    error_status = 503
+    random = random.Random(0)
+    requests = Counter()  # ~ by endpoint and status
+
+    def _send_json(self, status: int, data, headers: dict = None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        limit = int(query.get('limit', ['1000'])[0])
+        limit = min(limit, self.page_size) if self.page_size else limit
+        offset = int(query.get('offset', ['0'])[0])
+        if url.path == '/v1/gtfs/stops':
+            endpoint = 'gtfs/stops'
+        elif url.path.startswith('/v1/gtfs/stoptimes/'):
+            endpoint = 'gtfs/stoptimes'
+        else:
+            self.send_error(404)
+            return
+        time.sleep(self.latency)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.requests[endpoint, self.error_status] += 1
+            self._send_json(self.error_status, {'error': 'injected'}, {'Retry-After': '0'})
+            return
+        self.requests[endpoint, 200] += 1
+        if endpoint == 'gtfs/stops':
+            self._send_json(200, {'type': 'FeatureCollection', 'features': self.stops[offset:offset + limit]})
+        else:
+            stop_id = url.path[len('/v1/gtfs/stoptimes/'):]
+            end = min(stop_times_count(stop_id, self.max_stop_times), offset + limit)
+            self._send_json(200, [stop_time(stop_id, i) for i in range(offset, end)])
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(latency: float = 0., port: int = 0, stops: list = None, page_size: int = None,
+                 max_stop_times: int = 2500, error_rate: float = 0., error_status: int = 503,
+                 seed: int = 0) -> ThreadingHTTPServer:
+    """
+    Start the mock server in a background thread.
+    :param latency: seconds added to each response
+    :param port: port to listen on, a free one by default
+    :param stops: stops served by `gtfs/stops`, in the format of `benchmarks.synthetic.stop_features`
+    :param page_size: largest page served, by default as large as requested
+    :param max_stop_times: largest number of stop times of a stop
+    :param error_rate: fraction of the requests answered with `error_status` (and `Retry-After: 0`) instead of data
+    :param error_status: status code of the injected errors
+    :param seed: seed of the random generator injecting the errors
+    :return: the running server, its url is `http://127.0.0.1:{server.server_port}/v1/`, the requests served by
+    endpoint and status are counted in `server.RequestHandlerClass.requests`
+    """
+    handler = type('Handler', (MockGolemioHandler,), {
+        'latency': latency, 'stops': stops or [], 'page_size': page_size, 'max_stop_times': max_stop_times,
+        'error_rate': error_rate, 'error_status': error_status, 'random': random.Random(seed), 'requests': Counter(),
+    })
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
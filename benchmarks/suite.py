@@ -0,0 +1,214 @@
+"""
+Benchmark suite timing every step of the pipeline on synthetic data of configurable scale, with the Golemio API
+replaced by the local mock server: download, filter, crawl, aggregate and assign of `GolemioApiDownloader`, then
+process_traffic, merge (process_stops and merge_panda) and output_col of `Traffic`. The timings are saved as JSON and
+can be compared with the timings of a previous run to find regressions.
+
+    python -m benchmarks.suite --stops 10000 100000 --output results.json
+    python -m benchmarks.suite --stops 10000 100000 --compare results.json --threshold 0.2
+
+Steps left out with `--steps` are replaced by writing their synthetic output (download, crawl) or run without being
+timed, e.g. `--steps filter aggregate assign` for 1M stops without 1M requests to the mock server.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from app.downloader import GolemioApiDownloader
+from app.ratelimit import TokenBucket
+from app.traffic import Traffic
+from benchmarks.mock_golemio import start_server, stop_times_count
+from benchmarks.synthetic import stop_features, write_pid_stops, write_stop_count_files, write_traffic_csv
+
+STEPS = ['download', 'filter', 'crawl', 'aggregate', 'assign', 'process_traffic', 'merge_traffic', 'output_col']
+OUTPUT_COL_QUERIES = [(start, start + 3, out) for start in range(0, 24, 3) for out in ('delay', 'flow', 'load')]
+
+
+class PipelineRun:
+    """
+    One run of the pipeline in a temporary directory against its own mock server.
+    """
+
+    def __init__(self, args: argparse.Namespace, n_stops: int, data_dir: str):
+        self.args = args
+        self.data_dir = data_dir
+        self.dates = [f'2020-01-{day:02d}' for day in range(1, args.dates + 1)]
+        self.features = stop_features(max(1, n_stops // 10))  # ~ 10 stops per parent station on average
+        self.timings = {}
+        self.server = start_server(latency=args.latency, stops=self.features, page_size=args.page_size,
+                                   max_stop_times=args.max_stop_times, error_rate=args.error_rate)
+        self.golemio = self._downloader()
+        self.traffic = self._traffic()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.data_dir, name)
+
+    def _downloader(self) -> GolemioApiDownloader:
+        with open(self._path('key.json'), 'w') as output_f:
+            json.dump({'X-Access-Token': ''}, output_f)
+        golemio = GolemioApiDownloader(self._path('key.json'))
+        golemio.base_uri = f'http://127.0.0.1:{self.server.server_port}/v1/'
+        golemio.limit_per_page = self.args.page_size
+        golemio.rate_limiter = TokenBucket(rate=1e6)  # ~ measure the pipeline, not the request budget
+        golemio.cache = None
+        for attribute in ('all_stations_path', 'all_stations_stream_path', 'all_stations_ids_path',
+                          'station_index_path', 'orphaned_stations_path', 'all_stop_count_path',
+                          'parent_ids_with_count_path', 'stop_count_store_path', 'crawl_journal_path'):
+            setattr(golemio, attribute, self._path(os.path.basename(getattr(golemio, attribute))))
+        return golemio
+
+    def _traffic(self) -> Traffic:
+        traffic = Traffic()
+        traffic.cache = None
+        for attribute in ('traffic_csv_path', 'stops_json_path', 'stops_out_path', 'traffic_out_path',
+                          'final_output_path', 'hourly_output_path'):
+            setattr(traffic, attribute, self._path(os.path.basename(getattr(traffic, attribute))))
+        write_traffic_csv(traffic.traffic_csv_path, self.args.records, self.args.traffic_stations)
+        write_pid_stops(traffic.stops_json_path, self.args.traffic_stations)
+        return traffic
+
+    def _step(self, step: str, run, replacement=None):
+        """
+        Run the step, timing it if it is selected, otherwise run its replacement (if any) instead.
+        """
+        if step not in self.args.steps:
+            (replacement or run)()
+            return
+        start = time.perf_counter()
+        run()
+        self.timings[step] = time.perf_counter() - start
+        print(f'{step:>16}: {self.timings[step]:.3f} s')
+
+    def _write_all_stations(self):
+        with open(self.golemio.all_stations_stream_path, 'w', encoding='utf8') as output_f:
+            output_f.writelines(json.dumps(station) + '\n' for station in self.features)
+
+    def _write_stop_counts(self):
+        with open(self.golemio.all_stations_ids_path) as input_f:
+            all_ids = json.load(input_f)
+        for date in self.dates:
+            write_stop_count_files(all_ids, self.golemio.all_stop_count_path, date)
+
+    def _output_col(self):
+        data = self.traffic.ST_out
+        for query in OUTPUT_COL_QUERIES:
+            Traffic.output_col(data, *query)
+
+    def run(self) -> dict:
+        golemio, traffic = self.golemio, self.traffic
+        self._step('download', golemio.download_all_stations, self._write_all_stations)
+        self._step('filter', golemio.filter_station_ids_enriched)
+        self._step('crawl', lambda: golemio.count_stop_times_for_dates(self.dates, assign=False),
+                   self._write_stop_counts)
+        aggregated = []
+        self._step('aggregate', lambda: aggregated.append(golemio.aggregate_stop_counts(self.dates)))
+        self._step('assign', lambda: golemio.assign_stop_counts(self.dates, initial=True))
+        self._step('process_traffic', traffic.process_traffic)
+        self._step('merge_traffic', lambda: (traffic.process_stops(), traffic.merge_panda()))
+        self._step('output_col', self._output_col)
+        if 'crawl' in self.args.steps:  # ~ a broken crawl is not faster
+            expected = sum(stop_times_count(station['properties']['stop_id'], self.args.max_stop_times)
+                           for station in self.features)
+            assert aggregated[0][0].sum(axis=1).tolist() == [expected] * len(self.dates), 'Wrong stop counts'
+        self.server.shutdown()
+        self.server.server_close()
+        return {
+            'timings': self.timings,
+            'requests': {f'{endpoint} {status}': n for (endpoint, status), n in
+                         sorted(self.server.RequestHandlerClass.requests.items())},
+        }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def run_suite(args: argparse.Namespace) -> dict:
+    results = []
+    for n_stops in args.stops:
+        runs = []
+        for repeat in range(args.repeat):
+            print(f'{n_stops} stops, run {repeat + 1}/{args.repeat}')
+            with tempfile.TemporaryDirectory() as data_dir:
+                runs.append(PipelineRun(args, n_stops, data_dir).run())
+        for step in STEPS:
+            if step in runs[0]['timings']:
+                seconds = [run['timings'][step] for run in runs]
+                results.append({'stops': n_stops, 'step': step, 'seconds': min(seconds), 'runs': seconds})
+        results.append({'stops': n_stops, 'step': None, 'requests': runs[0]['requests']})
+    return {
+        'meta': {
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'args': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+        },
+        'results': results,
+    }
+
+
+def compare(suite: dict, baseline: dict, threshold: float) -> list:
+    """
+    Compare the timings with the timings of the baseline run.
+    :param suite: results of this run
+    :param baseline: results of the baseline run
+    :param threshold: relative slowdown reported as a regression, e.g. 0.2 for 20 %
+    :return: list of the regressions (stops, step, ratio)
+    """
+    before = {(r['stops'], r['step']): r['seconds'] for r in baseline['results'] if r['step']}
+    regressions = []
+    print(f'compared with {baseline["meta"]["commit"] or "unknown commit"} ({baseline["meta"]["created"]})')
+    for result in suite['results']:
+        key = (result['stops'], result['step'])
+        if key not in before:
+            continue
+        ratio = result['seconds'] / before[key] if before[key] else float('inf')
+        regressed = ratio > 1 + threshold
+        print(f'{result["stops"]:>9} {result["step"]:>16}: {before[key]:8.3f} s -> {result["seconds"]:8.3f} s '
+              f'({ratio:5.2f}x){"  REGRESSION" if regressed else ""}')
+        if regressed:
+            regressions.append((*key, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stops', type=int, nargs='+', default=[10000], help='scales, number of stops')
+    parser.add_argument('--steps', nargs='+', choices=STEPS, default=STEPS, help='timed steps')
+    parser.add_argument('--dates', type=int, default=1, help='dates crawled, aggregated and assigned')
+    parser.add_argument('--records', type=int, default=100000, help='traffic records')
+    parser.add_argument('--traffic-stations', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0., help='seconds added to each mock response')
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--max-stop-times', type=int, default=300, help='largest number of stop times of a stop')
+    parser.add_argument('--error-rate', type=float, default=0., help='fraction of mock responses failing with 503')
+    parser.add_argument('--repeat', type=int, default=1, help='runs of each scale, the fastest is kept')
+    parser.add_argument('--output', help='path to save the results as JSON')
+    parser.add_argument('--compare', help='path to the results of a previous run')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative slowdown reported as a regression')
+    args = parser.parse_args()
+
+    suite = run_suite(args)
+    if args.output:
+        with open(args.output, 'w') as output_f:
+            json.dump(suite, output_f, indent=2)
+    if args.compare:
+        with open(args.compare) as input_f:
+            regressions = compare(suite, json.load(input_f), args.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
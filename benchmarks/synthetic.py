@@ -0,0 +1,148 @@
+"""
+Synthetic station hierarchies and stop-count files in the formats produced by `GolemioApiDownloader`.
+"""
+import json
+import os
+import random
+
+
+def station_ids(n_parents: int, children_per_parent: int = 9, seed: int = 0) -> dict:
+    """
+    Build stations in the format of `all_stations_ids.json`.
+    :param n_parents: number of parent stations
+    :param children_per_parent: average number of child stations of a parent station
+    :param seed: seed of the random generator
+    :return: dict of parent stations with their children, with about n_parents * (1 + children_per_parent) stops
+    """
+    rnd = random.Random(seed)
+    return {
+        f'U{i}S1': {
+            'name': f'Station {i}',
+            'location': {'lat': round(rnd.uniform(48.6, 51.0), 5), 'lon': round(rnd.uniform(12.1, 18.8), 5)},
+            'children': [f'U{i}Z{j}P' for j in range(rnd.randint(0, 2 * children_per_parent))],
+        } for i in range(n_parents)
+    }
+
+
+def write_stop_count_files(all_ids: dict, all_stop_count_path: str, date: str, chunk_size: int = 4000,
+                           seed: int = 0) -> list:
+    """
+    Write random stop counts of all the stops in the format of `all_stop_count_{date}_{n}.json`, in chunks of parent
+    stations like `count_stop_times_per_day`.
+    :return: list of the written files
+    """
+    rnd = random.Random(f'{seed}{date}')
+    parents = list(all_ids)
+    paths = []
+    for n, start in enumerate(range(0, len(parents), chunk_size), start=1):
+        stops = {}
+        for parent in parents[start:start + chunk_size]:
+            for stop_id in [parent] + all_ids[parent]['children']:
+                count = rnd.randint(0, 600)
+                if count:
+                    stops[stop_id] = count
+        path = f'{all_stop_count_path}_{date}_{n}.json'
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as output_f:
+            json.dump(stops, output_f)
+        paths.append(path)
+    return paths
+
+
+def stop_features(n_parents: int, children_per_parent: int = 9, depth: int = 2, seed: int = 0) -> list:
+    """
+    Build stops in the format of the `gtfs/stops` features of Golemio API, with child stations nested up to the
+    selected depth below their parent stations, shuffled.
+    :param n_parents: number of parent stations
+    :param children_per_parent: average number of child stations of a parent station
+    :param depth: number of levels of child stations (the API itself has 2)
+    :param seed: seed of the random generator
+    :return: list of the stops
+    """
+    rnd = random.Random(seed)
+    features = []
+
+    def stop(stop_id: str, parent_station: str = None) -> dict:
+        return {'properties': {
+            'stop_id': stop_id, 'parent_station': parent_station, 'stop_name': f'Station {stop_id}',
+            'stop_lat': round(rnd.uniform(48.6, 51.0), 5), 'stop_lon': round(rnd.uniform(12.1, 18.8), 5),
+        }}
+
+    for i in range(n_parents):
+        parents = [f'U{i}S1']
+        features.append(stop(parents[0]))
+        for j in range(rnd.randint(0, 2 * children_per_parent)):
+            level = rnd.randint(1, depth)
+            stop_id = f'U{i}Z{j}P'
+            features.append(stop(stop_id, parents[min(level, len(parents)) - 1]))
+            parents.append(stop_id)
+    rnd.shuffle(features)
+    return features
+
+
+def traffic_records(n_records: int, n_stations: int = 500, seed: int = 0):
+    """
+    Build traffic records merged with stops in the format of `final_traffic.pkl` (the output of
+    `Traffic.merge_panda`), with about 5 % of missing real departures.
+    :param n_records: number of the records
+    :param n_stations: number of the stations
+    :param seed: seed of the random generator
+    :return: Pandas dataframe with the records
+    """
+    import numpy as np
+    import pandas as pd
+
+    rnd = np.random.default_rng(seed)
+    station = rnd.integers(0, n_stations, n_records)
+    scheduled = pd.Timestamp('2014-04-24') + pd.to_timedelta(rnd.integers(4 * 3600, 24 * 3600, n_records), unit='s')
+    real = scheduled + pd.to_timedelta(rnd.integers(-60, 600, n_records), unit='s')
+    records = pd.DataFrame({
+        'id': np.array([f'{i}/{i % 4 + 1}' for i in range(n_stations)])[station],
+        'name': np.array([f'Station {i}' for i in range(n_stations)])[station],
+        'lat': rnd.uniform(49.9, 50.2, n_stations)[station],
+        'lon': rnd.uniform(14.2, 14.7, n_stations)[station],
+        'realTime': real.where(rnd.random(n_records) > 0.05),
+        'schTime': scheduled,
+    })
+    for column in ('entry', 'exit', 'befArr', 'aftDep'):
+        records[column] = rnd.integers(0, 60, n_records).astype(np.int32)
+    return records
+
+
+def write_traffic_csv(path: str, n_records: int, n_stations: int = 500, seed: int = 0, blank_stops: int = 0):
+    """
+    Write random traffic records in the format of the TRAM2014 survey CSV read by `Traffic.process_traffic`, for the
+    stops of `write_pid_stops`, with about 5 % of missing real departures.
+    :param path: path to the CSV
+    :param n_records: number of the records
+    :param n_stations: number of the stations
+    :param seed: seed of the random generator
+    :param blank_stops: number of the records with an empty stop number (the second part of the stop id)
+    """
+    import numpy as np
+    import pandas as pd
+
+    records = traffic_records(n_records, n_stations, seed)
+    rnd = np.random.default_rng(seed)
+    columns = {f'c{i}': '' for i in range(16)}
+    columns['c2'] = records['realTime'].dt.strftime('%d.%m.%Y %H:%M:%S').fillna('1.1.1900')
+    columns['c3'] = records['schTime'].dt.strftime('%d.%m.%Y %H:%M:%S')
+    for i in range(6, 14):
+        columns[f'c{i}'] = rnd.integers(0, 30, n_records)
+    columns['c14'] = records['id'].str.split('/').str[0]
+    columns['c15'] = records['id'].str.split('/').str[1]
+    columns['c15'].iloc[rnd.choice(n_records, size=blank_stops, replace=False)] = ''
+    pd.DataFrame(columns).to_csv(path, index=False)
+
+
+def write_pid_stops(path: str, n_stations: int = 500, seed: int = 0):
+    """
+    Write the stops of `traffic_records` in the format of the PID `stops.json` read by `Traffic.process_stops`.
+    """
+    rnd = random.Random(seed)
+    stop_groups = [{'stops': [{
+        'id': f'{i}/{i % 4 + 1}', 'altIdosName': f'Station {i}',
+        'lat': round(rnd.uniform(49.9, 50.2), 6), 'lon': round(rnd.uniform(14.2, 14.7), 6),
+    }]} for i in range(n_stations)]
+    with open(path, 'w', encoding='utf-8') as output_f:
+        json.dump({'stopGroups': stop_groups}, output_f, ensure_ascii=False)
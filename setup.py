@@ -3,7 +3,10 @@ from setuptools import setup
 setup(
     name='Golemio API public transport frequency',
     version='1.0.0',
-    packages=[''],
+    packages=['app'],
+    entry_points={
+        'console_scripts': ['golemio-frequency = app.cli:main'],
+    },
     url='',
     license='MIT license',
     author='Jame Stitel',